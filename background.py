@@ -0,0 +1,180 @@
+#!python
+import collections
+import numpy
+import dtypes
+from filter import Filter
+
+class Background(Filter):
+  '''This filter subtracts the background noise from each scan line.  A
+     line's background is estimated as the average of its first 'samples'
+     data, which the laser spends before it reaches the sample.  Since the
+     instrument drifts over a run, those estimates can be averaged over a
+     'window' of lines around each line (1 means every line stands alone).
+     The window is centred on the line, so it takes an odd number of lines; a
+     window which isn't odd (the parameter is a float, for the GUI) is
+     rounded down to one which is.  No datum drops below the minimum of its
+     line.'''
+  def __init__(self):
+    Filter.__init__(self)
+    self._name = "Background"
+    self._input = None
+    self._dimensions = None
+    self._output = None
+    self.set_parameter_floatrange("samples", 10.0, 1.0,100.0)
+    self.set_parameter_floatrange("window", 1.0, 1.0,101.0)
+
+  def set_input(self, raw_data, dims):
+    self._dimensions = dims
+    self._input = raw_data
+    self._output = None
+
+  def get_output(self):
+    if self._output is None:
+      self.execute()
+    return self._output
+
+  def _half_window(self):
+    '''How many lines either side of a line its window reaches.'''
+    return max(int(self.get_parameter("window")) - 1, 0) // 2
+
+  def _line_background(self, values):
+    '''The background of each line of 'values', of shape (..., w).'''
+    samples = max(int(self.get_parameter("samples")), 1)
+    return values[...,:samples].mean(axis=-1)
+
+  def _subtract(self, values, background):
+    '''Subtracts a background per line from 'values', of shape (..., w).'''
+    minimum = values.min(axis=-1)[...,numpy.newaxis]
+    return numpy.maximum(minimum, values - background[...,numpy.newaxis])
+
+  def _filter(self, values):
+    '''Filters a map (or a stack of them), of shape (..., h, w).'''
+    backgrounds = self._line_background(values)
+    k = self._half_window()
+    if k > 0:
+      # Average each line's background with those of the k lines either side
+      # of it, as far as there are any.
+      h = values.shape[-2]
+      padded = numpy.zeros(backgrounds.shape[:-1] + (h + 2*k,),
+                           dtype=backgrounds.dtype)
+      padded[...,k:k+h] = backgrounds
+      present = numpy.zeros(h + 2*k, dtype=backgrounds.dtype)
+      present[k:k+h] = 1
+      total = numpy.zeros(backgrounds.shape, dtype=backgrounds.dtype)
+      count = numpy.zeros(h, dtype=backgrounds.dtype)
+      for d in xrange(0, 2*k+1):
+        total += padded[...,d:d+h]
+        count += present[d:d+h]
+      backgrounds = total / count
+    return self._subtract(values, backgrounds)
+
+  def stream(self, rows):
+    '''Filters data one scan line at a time.  'rows' is an iterable of lines,
+    each an array of shape (..., w).  Yields the filtered lines in order.  At
+    most 'window' lines are held at once, and the results are identical to
+    filtering the whole map in one go.'''
+    k = self._half_window()
+    lines = collections.deque() # (index, line, background), oldest first
+    n = 0 # lines read
+    y = 0 # the next line to yield
+    for row in rows:
+      row = dtypes.floats(row)
+      lines.append((n, row, self._line_background(row)))
+      n += 1
+      if n > y + k:
+        yield self._stream_line(lines, y, k)
+        y += 1
+    while y < n:
+      yield self._stream_line(lines, y, k)
+      y += 1
+
+  def _stream_line(self, lines, y, k):
+    '''Filters line 'y', given the lines around it; drops the lines which
+    won't be needed again.'''
+    total = 0.0
+    count = 0
+    for i, row, background in lines:
+      if abs(i - y) <= k:
+        total = total + background
+        count += 1
+      if i == y: line = row
+    while lines and lines[0][0] < y + 1 - k: lines.popleft()
+    return self._subtract(line, total / count if k > 0 else total)
+
+  def execute(self):
+    assert(self._dimensions != None)
+    values = dtypes.floats(self._input)
+    values = values.reshape((self._dimensions[1], self._dimensions[0]))
+    self._output = self._filter(values).ravel()
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestBackground(unittest.TestCase):
+    def _run(self, data, dims, samples=10.0, window=1.0):
+      bgf = Background()
+      bgf.update_value("samples", samples)
+      bgf.update_value("window", window)
+      bgf.set_input(data, dims)
+      return bgf.get_output().tolist()
+
+    def test_per_line(self):
+      data = [1.0, 3.0, 10.0, 12.0,
+              5.0, 5.0, 20.0, 30.0]
+      self.assertEqual(self._run(data, (4,2), samples=2.0),
+                       [1.0, 1.0, 8.0, 10.0,
+                        5.0, 5.0, 15.0, 25.0])
+
+    def test_window(self):
+      data = [2.0, 2.0, 10.0,
+              4.0, 4.0, 10.0,
+              6.0, 6.0, 10.0]
+      out = self._run(data, (3,3), samples=2.0, window=3.0)
+      # backgrounds: 3, 4, 5
+      self.assertEqual(out, [2.0, 2.0, 7.0,
+                             4.0, 4.0, 6.0,
+                             6.0, 6.0, 6.0])
+
+    def test_even_window(self):
+      data = [2.0, 2.0, 10.0,
+              4.0, 4.0, 10.0,
+              6.0, 6.0, 10.0]
+      for window in (2.0, 2.9):
+        self.assertEqual(self._run(data, (3,3), 2.0, window),
+                         self._run(data, (3,3), 2.0, 1.0))
+      self.assertEqual(self._run(data, (3,3), 2.0, 4.0),
+                       self._run(data, (3,3), 2.0, 3.0))
+
+    def test_float32(self):
+      data = numpy.array([1.0, 3.0, 10.0, 12.0,
+                          5.0, 5.0, 20.0, 30.0], dtype=numpy.float32)
+      for window in (1.0, 3.0):
+        bgf = Background()
+        bgf.update_value("samples", 2.0)
+        bgf.update_value("window", window)
+        bgf.set_input(data, (4,2))
+        self.assertEqual(bgf.get_output().dtype, numpy.float32)
+        self.assertEqual(bgf.get_output().tolist(),
+                         self._run(data.astype(numpy.float64), (4,2), 2.0,
+                                   window))
+
+    def test_stream(self):
+      import random
+      random.seed(7)
+      data = numpy.array([random.random() * 10.0 for i in xrange(7*9)])
+      data = data.reshape((9,7))
+      for window in (1.0, 2.0, 3.0, 5.0, 25.0):
+        bgf = Background()
+        bgf.update_value("samples", 3.0)
+        bgf.update_value("window", window)
+        lines = list(bgf.stream(data))
+        self.assertEqual(len(lines), 9)
+        self.assertEqual(numpy.array(lines).tolist(),
+                         bgf._filter(data).tolist())
+        # several elements at once
+        stacked = numpy.array([data, data * 2.0])
+        lines = list(bgf.stream(stacked[:,y,:] for y in xrange(9)))
+        self.assertEqual(lines[8][1].tolist(),
+                         bgf._filter(stacked[1])[8].tolist())
+
+  unittest.main()
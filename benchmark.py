@@ -0,0 +1,158 @@
+#!python
+# Benchmarks the main stages of BUB on synthetic data: parsing, filtering,
+# rendering and export.
+#
+# Results are written as JSON, so that runs on different versions (or
+# machines) can be compared by a script:
+#
+#   python benchmark.py --files 200 --points 1000 --output results.json
+#
+# Every benchmark is run several times; we report the best and the median
+# time, and the throughput of the best run in data points per second.
+from __future__ import with_statement
+from optparse import OptionParser
+import imp
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy
+
+import colormap
+import dtypes
+import fin
+import findir
+from background import Background
+from outlier import Outlier
+import resample
+import synthetic
+
+def _cli():
+  '''cli-bub.py, as a module; its name isn't one Python can import.'''
+  here = os.path.dirname(os.path.abspath(__file__))
+  return imp.load_source("cli_bub", os.path.join(here, "cli-bub.py"))
+
+def measure(fn, repeat, setup=None):
+  '''Runs 'fn' 'repeat' times, calling 'setup' (if any) before each run but
+  outside of the timing.  Returns the times, in seconds, sorted.'''
+  times = []
+  for r in xrange(0, repeat):
+    if setup is not None: setup()
+    start = timeit.default_timer()
+    fn()
+    times.append(timeit.default_timer() - start)
+  times.sort()
+  return times
+
+def run(directory, finglob, options):
+  '''Runs every benchmark on the synthetic run in 'directory'.  Returns a dict
+  mapping benchmark name to its results.'''
+  cli = _cli()
+  element = synthetic.element_names(1)[0]
+  dtype = dtypes.TYPES[options.dtype]
+  fdir = findir.FINDir(directory, finglob, dtype=dtype)
+  files = fdir.files()
+  dims = (fdir.x(), fdir.y())
+  n_points = dims[0] * dims[1]
+  data = fdir.element(element)
+  resampler = resample.uniform(dims)
+  out = tempfile.mkdtemp()
+
+  def remove_cache():
+    for f in os.listdir(directory):
+      if f.startswith(".bub-cache"): os.remove(os.path.join(directory, f))
+
+  def filtered(flt):
+    def execute():
+      flt.set_input(data, dims)
+      flt.get_output()
+    return execute
+
+  benchmarks = [
+    ("FIN.element",
+     lambda: [fin.FIN(f, dtype).element(element) for f in files], None),
+    ("FINDir.element",
+     lambda: findir.FINDir(directory, finglob, dtype=dtype).element(element),
+     None),
+    ("FINDir.element (cached)",
+     lambda: findir.FINDir(directory, finglob, cache=True,
+                           dtype=dtype).element(element),
+     lambda: findir.FINDir(directory, finglob, cache=True).table()),
+    ("Outlier", filtered(Outlier()), None),
+    ("Background", filtered(Background()), None),
+    ("colormap.image", lambda: colormap.image(data, dims), None),
+    ("write_image", lambda: cli.write_image(os.path.join(out, "bench.png"),
+                                            dims, data, True, resampler), None),
+    ("write_nrrd", lambda: cli.write_nrrd(os.path.join(out, "bench"), data,
+                                          dims), None),
+  ]
+  results = {}
+  try:
+    for name, fn, setup in benchmarks:
+      if options.only and name not in options.only: continue
+      times = measure(fn, options.repeat, setup)
+      results[name] = {"best": times[0], "median": times[len(times) // 2],
+                       "points_per_second": n_points / max(times[0], 1e-9)}
+      print >> sys.stderr, "%-24s %10.4fs" % (name, times[0])
+  finally:
+    shutil.rmtree(out)
+    remove_cache()
+  return results
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("--files", dest="files", default=100, type="int",
+                    help="Number of FIN files (scan lines) (100).")
+  parser.add_option("--points", dest="points", default=500, type="int",
+                    help="Number of samples per file (500).")
+  parser.add_option("--elements", dest="elements", default=4, type="int",
+                    help="Number of elements, besides Time (4).")
+  parser.add_option("--dtype", dest="dtype", default="float64",
+                    choices=sorted(dtypes.TYPES.keys()),
+                    help="Hold the data as float64 (the default) or float32.")
+  parser.add_option("--repeat", dest="repeat", default=5, type="int",
+                    help="Run each benchmark N times (5).", metavar="N")
+  parser.add_option("--only", dest="only", action="append", metavar="NAME",
+                    help="Only run the named benchmark; may be repeated.")
+  parser.add_option("--data", dest="data", metavar="DIR",
+                    help="Generate the synthetic run in DIR, and keep it.  "
+                         "An existing run there is reused.")
+  parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                    help="Write the JSON results to FILE (stdout).")
+  options, args = parser.parse_args()
+
+  directory = options.data or tempfile.mkdtemp()
+  try:
+    if os.path.isdir(directory) and any([f.endswith("FIN2") for f in
+                                         os.listdir(directory)]):
+      finglob = "*FIN2"
+    else:
+      print >> sys.stderr, "Generating %d x %d x %d run in %s..." % \
+            (options.files, options.points, options.elements, directory)
+      finglob, slsfile = synthetic.write_run(directory, options.files,
+                                             options.points, options.elements)
+    fdir = findir.FINDir(directory, finglob)
+    report = {
+      "scale": {"files": fdir.y(), "points": fdir.x(),
+                "elements": len(fdir.elements()) - 1},
+      "repeat": options.repeat,
+      "dtype": options.dtype,
+      "platform": {"python": platform.python_version(),
+                   "numpy": numpy.__version__,
+                   "machine": platform.machine(),
+                   "system": platform.system()},
+      "results": run(directory, finglob, options),
+    }
+  finally:
+    if options.data is None: shutil.rmtree(directory)
+
+  if options.output is None:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print
+  else:
+    with open(options.output, "w") as f:
+      json.dump(report, f, indent=2, sort_keys=True)
@@ -1,64 +1,98 @@
 #!python
 import logging as log
+import os
 import pygtk
 pygtk.require('2.0')
 import gtk
-from PIL import Image, ImageDraw
+import gobject
+import hashlib
+import json
+import numpy
+import threading
+import time
 
+import colormap
+import dtypes
+import fincache
 import findir
+import lru
+import nrrd
+import pipeline
+import pyramid
+import tileview
+from background import Background
 from outlier import Outlier
 from filter_ui import FilterUI
 
-def lerp(x, x0,x1, y0,y1): return y0 + (x - x0)*(float(y1-y0) / float(x1-x0))
+# How often to look for new scan lines when following a run, in ms.
+FOLLOW_INTERVAL = 2000
 
-def linearcolor(x, color0,color1, data0,data1):
-  '''Generates a color through linear interpolation in a range.
-     color0 is the color at data0; color1 is the color at data1.'''
-  assert(data0 <= x and x <= data1)
-  return (
-    int(lerp(x, data0,data1, color0[0],color1[0])),
-    int(lerp(x, data0,data1, color0[1],color1[1])),
-    int(lerp(x, data0,data1, color0[2],color1[2]))
-  )
+# How often a data set being loaded is redrawn, in seconds.
+LOAD_UPDATE_INTERVAL = 0.25
+
+# Memory budget for parsed elements and their images, in bytes.
+CACHE_BYTES = int(os.getenv("BUB_CACHE_MB", "256")) * 1024 * 1024
+
+# If set, image pyramids are stored next to the data, so that reopening a
+# data set needn't rebuild them.
+PYRAMID_CACHE = os.getenv("BUB_PYRAMID_CACHE") is not None
+
+# The type data are held in: BUB_DTYPE=float32 halves the memory they need.
+DTYPE = dtypes.TYPES.get(os.getenv("BUB_DTYPE"), dtypes.DEFAULT)
+
+# The largest the image area asks to be, initially.
+VIEW_SIZE = (1024, 768)
 
 def create_pil_image(data, dims):
   '''Creates a PIL image from raw, single-component image data.'''
-  w,h = (dims[0], dims[1])
-  img = Image.new('RGB', dims)
-  draw = ImageDraw.Draw(img)
-  minmax = (min(data), max(data))
-
-  five_percent = minmax[0] + (minmax[1]-minmax[0]) * 0.05
-  twenty_percent = minmax[0] + (minmax[1]-minmax[0]) * 0.2
-
-  for y in (xrange(0, dims[1])):
-    for x in (xrange(0, dims[0])):
-      v = data[y*dims[0]+x]
-      c = None # final color
-      if v <= five_percent: c = (0,0,0)
-      elif v <= twenty_percent:
-        c = linearcolor(v, (0,0,0),(254,254,254), five_percent,twenty_percent)
-      else:
-        c = linearcolor(v, (128,255,0),(255,0,100), minmax[0],minmax[1])
-      draw.point((x,y), fill=c)
-
-  return img
+  return colormap.image(data, dims)
+
+class _Load:
+  '''A data set being read in the background; see BUB._load.'''
+  def __init__(self, directory):
+    self.directory = directory
+    self.cancelled = False
+    self.lines = {} # element name -> list of the arrays read so far
+    self.n_lines = 0
+
+  def table(self):
+    return dict([(e, numpy.concatenate(self.lines[e] or [numpy.empty(0)]))
+                 for e in self.lines.keys()])
 
 class BUB:
   """Holds the main BUB window.  The basic layout is a 3-element VBox
      (self._mainvbox).  The first elem of that VBox is the menus; last elem is
      the status bar.  All the real 'meat' is in the middle, configured in
-     self._create_main."""
-  def __init__(self):
+     self._create_main.  The image is shown in a TileView, which is created
+     once; showing another image just hands it a new pyramid."""
+  def __init__(self, cache_bytes=CACHE_BYTES):
     self._findir = None
+    # ("data", element) -> the element's data,
+    # ("data", element, region) -> the data of a region of it, and
+    # ("pyramid", element, lines, region) -> its image pyramid, and the
+    # TileView's colored tiles.
+    self._cache = lru.LRUCache(cache_bytes)
+    # The part of the map we're looking at: ((first line, stop), (first sample,
+    # stop)), or None for all of it.
+    self._region = None
+    self._lines = 0 # number of scan lines loaded or followed so far
+    # element -> the buffer its followed data are a view of; see _extend.
+    self._buffers = {}
+    self._job = None # the _Load in progress, if any
     self._elements = []
     self._active_field = None
+    self._shown = None # the element whose pyramid is in the view, if any
+    # The filters run on the active field so far, as a pipeline; each filter
+    # is run on the output of the one before.  None until a filter is run.
+    self._chain = None
+    self._following = False # following a run as it's being acquired?
+    self._followed = False # has _findir been followed before?
     self._window = gtk.Window(gtk.WINDOW_TOPLEVEL)
     self._window.connect("destroy", self.destroy)
     self._mainvbox = gtk.VBox(False, 0)
     self._window.add(self._mainvbox)
     self._swindow = None
-    self._img = None
+    self._view = tileview.TileView(self._cache)
     self._hb_main = None
     self._vb_channels = None
     self._create_menus()
@@ -74,7 +108,100 @@ class BUB:
 
   def _menu_open(self, arg):
     print "arg:", arg
-    fsel = gtk.FileChooserDialog(title="FIN Directory", parent=self._window,
+    directory = self._choose_directory("FIN Directory")
+    if directory is None: return
+    self._open(directory)
+
+  def _menu_open_results(self, arg):
+    directory = self._choose_directory("Exported Results")
+    if directory is None: return
+    try:
+      self._open_results(directory)
+    except UserWarning, e:
+      self._status.push(self._status.get_context_id("load"), str(e))
+
+  def _menu_open_region(self, arg):
+    '''Opens part of a data set.  Only the FIN files of the lines in the
+       region are read, so this is quick enough to do right here.'''
+    directory = self._choose_directory("FIN Directory")
+    if directory is None: return
+    try:
+      fdir = findir.FINDir(directory, "*FIN2", cache=True, dtype=DTYPE)
+      fdir.x()
+    except (UserWarning, IndexError), e:
+      self._status.push(self._status.get_context_id("load"), str(e))
+      return
+    region = self._choose_region(fdir)
+    if region is None: return
+    self._cancel_load()
+    self._findir = fdir
+    self._region = region
+    self._cache.clear()
+    self._followed = False
+    self._lines = 0
+    self._elements = list(self._findir.elements())
+    self._create_main()
+    self._show_region()
+
+  def _menu_zoom_region(self, arg):
+    '''Shows just a region of the map we have open.'''
+    if self._findir is None or self._job is not None: return
+    region = self._choose_region(self._findir, self._region)
+    if region is None: return
+    self._region = region
+    if self._active_field is not None: self._element(self._active_field)
+    self._show_region()
+
+  def _menu_whole_map(self, arg):
+    self._region = None
+    if self._findir is not None and self._active_field is not None:
+      self._element(self._active_field)
+    self._show_region()
+
+  def _choose_region(self, fdir, region=None):
+    '''Asks the user for a region of the map of 'fdir': the first and last
+       scan line, and the first and last sample of each, starting from
+       'region' (or the whole map).  Returns it as ((first line, stop), (first
+       sample, stop)), or None if they cancel.'''
+    (r0, r1), (c0, c1) = region or ((0, fdir.y()), (0, fdir.x()))
+    dialog = gtk.Dialog(title="Region", parent=self._window,
+                        flags=gtk.DIALOG_MODAL,
+                        buttons=(gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                                 gtk.STOCK_OK, gtk.RESPONSE_OK))
+    table = gtk.Table(2, 3)
+    spins = []
+    for row, (label, first, last, n) in enumerate(
+        [("Lines", r0, r1-1, fdir.y()), ("Samples", c0, c1-1, fdir.x())]):
+      lbl = gtk.Label(label)
+      lbl.show()
+      table.attach(lbl, 0, 1, row, row+1)
+      for col, value in enumerate((first, last)):
+        spin = gtk.SpinButton(gtk.Adjustment(value, 0, n-1, 1, 10))
+        spin.show()
+        table.attach(spin, col+1, col+2, row, row+1)
+        spins.append(spin)
+    table.show()
+    dialog.vbox.pack_start(table)
+    response = dialog.run()
+    first_line, last_line, first_sample, last_sample = \
+      [spin.get_value_as_int() for spin in spins]
+    dialog.destroy()
+    if response != gtk.RESPONSE_OK: return None
+    if last_line < first_line or last_sample < first_sample: return None
+    return ((first_line, last_line+1), (first_sample, last_sample+1))
+
+  def _show_region(self):
+    if self._region is None:
+      message = "Showing the whole map"
+    else:
+      (r0, r1), (c0, c1) = self._region
+      message = "Showing lines %d to %d, samples %d to %d" % \
+                (r0, r1-1, c0, c1-1)
+    self._status.push(self._status.get_context_id("region"), message)
+
+  def _choose_directory(self, title):
+    '''Asks the user for a directory.  Returns None if they cancel.'''
+    fsel = gtk.FileChooserDialog(title=title, parent=self._window,
                                  action=gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER,
                                  buttons=(gtk.STOCK_CANCEL,gtk.RESPONSE_CANCEL,
                                           gtk.STOCK_OPEN, gtk.RESPONSE_OK))
@@ -88,29 +215,192 @@ class BUB:
     else:
       print "inconceivable!"
     fsel.destroy()
-    if directory is None: return
+    return directory
 
-    self._findir = findir.FINDir(directory, "*FIN2")
-    print "Loaded FINDir with date", self._findir.date()
-    print "Elements:", self._findir.elements()
-    self._elements = self._findir.elements()
+  def _open_results(self, directory):
+    '''Opens the nrrds exported by cli-bub.  Their data are memory-mapped, so
+       this is quick enough to do right here.'''
+    self._cancel_load()
+    self._findir = nrrd.Results(directory)
+    self._region = None
+    self._cache.clear()
+    self._followed = False
+    self._lines = 0
+    self._elements = list(self._findir.elements())
+    self._create_main()
+    self._status.push(self._status.get_context_id("load"),
+                      "Opened %d elements from %s" %
+                      (len(self._elements), directory))
+
+  def _open(self, directory):
+    '''Starts loading a data set in the background.'''
+    self._cancel_load()
+    self._region = None
+    self._job = _Load(directory)
+    self._bt_cancel.show()
+    worker = threading.Thread(target=self._load, args=(self._job,))
+    worker.daemon = True
+    worker.start()
+
+  def _load(self, job):
+    '''Body of the loading thread.  Nothing in here may touch GTK; whatever
+       we read is handed to the main loop instead.'''
+    try:
+      fdir = findir.FINDir(job.directory, "*FIN2", cache=True, dtype=DTYPE)
+      # Read the headers now, so the main loop doesn't have to.
+      fdir.date()
+      fdir.x()
+      files = fdir.files()
+      gobject.idle_add(self._load_started, job, fdir)
+
+      batch = []
+      sizes = None
+      n_bytes = 0
+      posted = time.time()
+      for i, row in enumerate(fdir.rows()):
+        if job.cancelled: return
+        # Count what the data actually come from: the FIN files, one per
+        # line, or the sidecar cache, all of it as soon as it's opened.
+        if sizes is None:
+          sizes = [os.path.getsize(f) for f in fdir.sources()]
+        if i < len(sizes): n_bytes += sizes[i]
+        batch.append(row)
+        if time.time() - posted > LOAD_UPDATE_INTERVAL:
+          gobject.idle_add(self._load_lines, job, batch, i+1, len(files),
+                           n_bytes)
+          batch = []
+          posted = time.time()
+      if batch:
+        gobject.idle_add(self._load_lines, job, batch, len(files), len(files),
+                         n_bytes)
+      gobject.idle_add(self._load_finished, job, fdir.sources() == files)
+    except Exception, e:
+      log.exception("Loading %s failed" % job.directory)
+      gobject.idle_add(self._load_failed, job, str(e))
 
+  def _load_started(self, job, fdir):
+    if job is not self._job: return False
+    self._findir = fdir
+    self._cache.clear()
+    self._followed = False
+    self._lines = 0
+    print "Loading FINDir with date", self._findir.date()
+    print "Elements:", self._findir.elements()
+    job.lines = dict([(e, []) for e in fdir.elements()])
+    # copy: we add our own entries to this list.
+    self._elements = list(self._findir.elements())
     self._create_main()
+    return False
+
+  def _load_lines(self, job, rows, n_files, total_files, n_bytes):
+    '''Takes the rows read by the loading thread, and draws them.'''
+    if job is not self._job: return False
+    for row in rows:
+      for e in row.keys(): job.lines[e].append(row[e])
+    first = job.n_lines
+    job.n_lines += len(rows)
+    self._status.push(self._status.get_context_id("load"),
+                      "Loading: %d of %d files, %.1f MB read" %
+                      (n_files, total_files, n_bytes / 1048576.0))
+    if self._active_field in job.lines:
+      self._draw_lines(first, numpy.concatenate([row[self._active_field]
+                                                 for row in rows]))
+    return False
+
+  def _load_finished(self, job, parsed):
+    '''The load is done.  If the FIN files had to be 'parsed', what they
+       held is stored in the sidecar cache, so that next time they needn't
+       be.  That's done before following starts, which changes the files.'''
+    if job is not self._job: return False
+    tbl = self._end_load()
+    if parsed: self._findir.store_cache(tbl)
+    self._status.push(self._status.get_context_id("load"),
+                      "Loaded %d lines" % job.n_lines)
+    if self._following: self._start_following()
+    return False
+
+  def _load_failed(self, job, message):
+    if job is not self._job: return False
+    self._end_load()
+    self._status.push(self._status.get_context_id("load"),
+                      "Loading failed: " + message)
+    return False
+
+  def _cancel_load(self, button=None):
+    '''Stops the loading thread.  Whatever was read so far stays around.'''
+    if self._job is None: return
+    self._job.cancelled = True
+    self._end_load()
+    self._status.push(self._status.get_context_id("load"), "Loading cancelled")
+
+  def _end_load(self):
+    '''Moves what the current load read into the cache.  Following the run
+       carries on from there.  Returns the table of what was read.'''
+    tbl = self._job.table()
+    for e in tbl.keys(): self._cache.put(("data", e), tbl[e])
+    self._lines = self._job.n_lines
+    times = self._job.lines.get("Time")
+    if self._lines > 0 and times:
+      self._findir.mark_read(self._lines, times[-1].max())
+    self._job = None
+    self._bt_cancel.hide()
+    return tbl
 
-  def _outlier_finished(self, outf, data=None):
-    raw_img = self._findir.element(self._active_field)
-    width, height = (self._findir.x(), self._findir.y())
-    self._set_image(outf.get_filter().get_output(), (width,height))
-    outf.destroy()
-
-  def _outlier_filter(self, something):
-    raw_img = self._findir.element(self._active_field)
-    width, height = (self._findir.x(), self._findir.y())
-    outf = Outlier()
-    outf.set_input(raw_img, (width,height))
-    outf_ui = FilterUI(outf)
-    outf_ui.connect("execution-success", self._outlier_finished)
-    outf_ui.create_ui()
+  def _element_data(self, element):
+    '''Data for the given element.  While loading, that's whatever has been
+       read so far.  Otherwise recently used elements are answered from
+       memory, the rest are read from the FINDir.'''
+    if self._job is not None and element in self._job.lines:
+      return numpy.concatenate(self._job.lines[element] or [numpy.empty(0)])
+    if self._region is not None:
+      key = ("data", element, self._region)
+      data = self._cache.get(key)
+      if data is None:
+        data = self._findir.region([element], *self._region)[element]
+        self._cache.put(key, data)
+      return data
+    data = self._cache.get(("data", element))
+    if data is None:
+      data = self._findir.element(element)
+      self._cache.put(("data", element), data)
+    return data
+
+  def _show_cache_stats(self):
+    self._status.push(self._status.get_context_id("cache"),
+                      "Cache: %d hits, %d misses, %.1f of %.1f MB used" %
+                      (self._cache.hits, self._cache.misses,
+                       self._cache.nbytes() / 1048576.0,
+                       self._cache.max_bytes() / 1048576.0))
+
+  def _dimensions(self, data):
+    '''Dimensions of the map for the given element data.  We can't just ask
+       the FINDir for the height: it might have grown since we read it.'''
+    width = self._findir.x()
+    if self._region is not None: width = self._region[1][1] - self._region[1][0]
+    return (width, len(data) / width)
+
+  def _filter_finished(self, flt_ui, data=None):
+    output = flt_ui.get_output()
+    self._set_image(output, self._dimensions(output))
+    # Previews keep the filter window open, so the user can keep tuning.
+    if not flt_ui.is_preview():
+      self._chain = flt_ui.get_stage()
+      flt_ui.destroy()
+
+  def _run_filter(self, flt):
+    '''Opens the UI for running the given filter on the active field, after
+       the filters which were run on it already.  Their results are reused
+       from the cache, as long as it holds them.'''
+    raw_img = self._element_data(self._active_field)
+    width, height = self._dimensions(raw_img)
+    if self._chain is None or self._chain.dimensions() != (width, height):
+      self._chain = pipeline.Source(raw_img, (width, height), self._cache)
+    flt_ui = FilterUI(self._chain.then(flt))
+    flt_ui.connect("execution-success", self._filter_finished)
+    flt_ui.create_ui()
+
+  def _outlier_filter(self, something): self._run_filter(Outlier())
+  def _background_filter(self, something): self._run_filter(Background())
 
   def _create_elements(self):
     if self._vb_channels != None: self._vb_channels.destroy()
@@ -133,40 +423,122 @@ class BUB:
     '''Called when a user wants to change which element is active.'''
     log.info("Button press of %s" % element)
     self._active_field = element
-    raw_img = self._findir.element(element)
-    width, height = (self._findir.x(), self._findir.y())
-    self._set_image(raw_img, (width, height))
-    self._swindow.set_size_request(width+20, height+20)
+    self._chain = None
+    raw_img = self._element_data(element)
+    width, height = self._dimensions(raw_img)
+    key = ("pyramid", element, height, self._region)
+    pyr = self._cache.get(key)
+    if pyr is None:
+      pyr = pyramid.Pyramid(raw_img, (width, height),
+                            self._pyramid_cache(element))
+      self._cache.put(key, pyr)
+    self._view.set_pyramid(pyr)
+    self._shown = element
+    self._swindow.set_size_request(min(width, VIEW_SIZE[0])+20,
+                                   min(height, VIEW_SIZE[1])+20)
+    self._show_cache_stats()
+
+  def _pyramid_cache(self, element):
+    '''Where the pyramid for the given element is kept on disk, if anywhere.
+       The name depends on the FIN files, so it changes when they do.'''
+    if (not PYRAMID_CACHE or self._job is not None or self._following or
+        self._region is not None):
+      return None
+    files = self._findir.files()
+    key = json.dumps([element, fincache.key(files)])
+    return os.path.join(os.path.dirname(files[0]),
+                        ".bub-pyramid-" + hashlib.md5(key).hexdigest()[:12])
 
   def _set_image(self, img_data, dimensions):
-    pil_img = create_pil_image(img_data, dimensions)
-    assert(pil_img.size[0] == dimensions[0])
-    assert(pil_img.size[1] == dimensions[1])
-    is_rgba = (pil_img.mode == 'RGBA')
-    pb = gtk.gdk.pixbuf_new_from_data(pil_img.tostring(),
-                                      gtk.gdk.COLORSPACE_RGB,
-                                      is_rgba, 8, dimensions[0], dimensions[1],
-                                      (is_rgba and 4 or 3) * pil_img.size[0])
-    self._img = gtk.Image()
-    self._img.set_from_pixbuf(pb)
-    self._create_main()
+    self._view.set_pyramid(pyramid.Pyramid(img_data, dimensions))
+    self._shown = None
+
+  def _toggle_follow(self, item):
+    self._following = item.get_active()
+    # if we're loading, we'll start following once that's done.  Exported
+    # results don't grow, so there's nothing to follow.
+    if (self._following and isinstance(self._findir, findir.FINDir) and
+        self._job is None):
+      self._start_following()
+
+  def _start_following(self):
+    if not self._followed and self._lines > 0:
+      # We loaded the run; just read whatever was added since.
+      self._followed = True
+      self._follow(self._findir)
+    elif not self._followed:
+      # The first refresh gives us everything there is so far.
+      table = self._findir.refresh()
+      self._cache.clear()
+      for e in table.keys(): self._cache.put(("data", e), table[e])
+      self._lines = len(table["Time"]) / self._findir.x()
+      self._followed = True
+      if self._active_field is not None: self._element(self._active_field)
+    gobject.timeout_add(FOLLOW_INTERVAL, self._follow, self._findir)
+
+  def _follow(self, fdir):
+    '''Timer callback while following a run: reads any new scan lines, and
+       draws just those.  Returns False, stopping the timer, once we are no
+       longer following this FINDir.'''
+    if not self._following or fdir is not self._findir: return False
+    new = self._findir.refresh()
+    n_lines = len(new["Time"]) / self._findir.x()
+    if n_lines == 0: return True
+    first = self._lines
+    self._lines += n_lines
+    # Elements which aren't cached will be read in full when they're needed.
+    for e in new.keys():
+      self._cache.discard(("pyramid", e, first, None))
+      if ("data", e) in self._cache: self._extend(e, new[e])
+      else: self._buffers.pop(e, None)
+    self._status.push(self._status.get_context_id("follow"),
+                      "Following: %d lines" % self._lines)
+    if self._active_field in new and self._region is None:
+      self._draw_lines(first, new[self._active_field])
+    return True
+
+  def _extend(self, element, values):
+    '''Appends 'values' to the cached data of 'element'.  The data are kept
+       as a view of a buffer with spare room, which is doubled when it fills
+       up (as Pyramid.append does), so each new line is copied once rather
+       than the whole map at every step.'''
+    data = self._cache.get(("data", element))
+    buf = self._buffers.get(element)
+    n = len(data) + len(values)
+    if buf is None or data.base is not buf or len(buf) < n:
+      buf = numpy.empty(max(n, 2 * len(data)), data.dtype)
+      buf[:len(data)] = data
+      self._buffers[element] = buf
+    buf[len(data):n] = values
+    self._cache.put(("data", element), buf[:n])
+
+  def _draw_lines(self, first, lines):
+    '''Draws lines just added to the active field's data, from line 'first'
+       on.  If the field's pyramid is being shown, and ends at 'first', the
+       lines are appended to it, so only the tiles they touch are redrawn;
+       otherwise the field is drawn afresh.'''
+    pyr = self._view.pyramid()
+    if (self._shown != self._active_field or pyr is None or
+        pyr.dimensions()[1] != first):
+      self._element(self._active_field)
+      return
+    self._cache.discard(("pyramid", self._shown, first, self._region))
+    pyr.append(lines)
+    self._cache.put(("pyramid", self._shown, pyr.dimensions()[1],
+                     self._region), pyr)
+    self._view.set_pyramid(pyr)
 
   def _create_swindow(self):
-    if self._swindow != None: self._swindow.destroy()
     self._swindow = gtk.ScrolledWindow()
     self._swindow.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
     self._swindow.set_border_width(10)
-    if self._img != None:
-      self._swindow.add_with_viewport(self._img)
-      self._img.show()
+    self._swindow.add(self._view.widget())
+    self._view.widget().show()
     self._swindow.show()
 
   def _create_hbox(self):
-    if self._hb_main != None: self._hb_main.destroy()
     self._hb_main = gtk.HBox(False, 5)
-    self._create_elements()
     self._create_swindow()
-    self._hb_main.pack_start(self._vb_channels, False)
     self._hb_main.pack_end(self._swindow)
     self._hb_main.show()
 
@@ -177,11 +549,19 @@ class BUB:
 
     m_file = gtk.Menu()
     m_file_open = gtk.MenuItem("Open")
+    m_file_region = gtk.MenuItem("Open region...")
+    m_file_results = gtk.MenuItem("Open results")
     m_file_quit = gtk.MenuItem("Quit")
     m_file.append(m_file_open)
+    m_file.append(m_file_region)
+    m_file.append(m_file_results)
     m_file.append(m_file_quit)
 
     m_file_open.connect_object("activate", self._menu_open, "file.open")
+    m_file_region.connect_object("activate", self._menu_open_region,
+                                 "file.region")
+    m_file_results.connect_object("activate", self._menu_open_results,
+                                  "file.results")
     m_file_quit.connect_object("activate", self.destroy, "file.quit")
 
     m_file_blah = gtk.MenuItem("File")
@@ -194,6 +574,11 @@ class BUB:
     m_filter_outlier.connect_object("activate", self._outlier_filter, "outlier")
     m_filter_outlier.show()
     m_filter.append(m_filter_outlier)
+    m_filter_background = gtk.MenuItem("Background")
+    m_filter_background.connect_object("activate", self._background_filter,
+                                       "background")
+    m_filter_background.show()
+    m_filter.append(m_filter_background)
     m_filter.show()
 
     m_filter_blah = gtk.MenuItem("Filter")
@@ -201,23 +586,59 @@ class BUB:
     m_filter_blah.set_submenu(m_filter)
     m_bar.append(m_filter_blah)
 
+    m_view = gtk.Menu()
+    m_view_follow = gtk.CheckMenuItem("Follow run")
+    m_view_follow.connect("toggled", self._toggle_follow)
+    m_view_follow.show()
+    m_view.append(m_view_follow)
+    for label, action in [("Zoom in", self._view.zoom_in),
+                          ("Zoom out", self._view.zoom_out),
+                          ("Actual size", lambda: self._view.set_zoom(1.0))]:
+      m_view_zoom = gtk.MenuItem(label)
+      m_view_zoom.connect("activate", lambda item, zoom=action: zoom())
+      m_view_zoom.show()
+      m_view.append(m_view_zoom)
+    for label, action in [("Zoom to region...", self._menu_zoom_region),
+                          ("Whole map", self._menu_whole_map)]:
+      m_view_region = gtk.MenuItem(label)
+      m_view_region.connect("activate", action)
+      m_view_region.show()
+      m_view.append(m_view_region)
+    m_view.show()
+
+    m_view_blah = gtk.MenuItem("View")
+    m_view_blah.show()
+    m_view_blah.set_submenu(m_view)
+    m_bar.append(m_view_blah)
+
     m_file_open.show()
+    m_file_region.show()
+    m_file_results.show()
     m_file_quit.show()
     m_bar.show()
 
   def _create_statusbar(self):
     self._status = gtk.Statusbar()
+    self._bt_cancel = gtk.Button("Cancel")
+    self._bt_cancel.connect("clicked", self._cancel_load)
+    self._status.pack_end(self._bt_cancel, False)
     self._status.show()
     self._mainvbox.pack_end(self._status, False)
 
   def _create_main(self):
     """The central part of the window.  On the left, we have a vbox, with each
        entry being a channel in the data.  On the right we have a scrollable
-       image that details the currently selected channel."""
-    self._create_hbox()
-    self._mainvbox.pack_start(self._hb_main)
+       image that details the currently selected channel.  Only the channel
+       list is rebuilt when this is called again, e.g. for a new data set."""
+    if self._hb_main is None:
+      self._create_hbox()
+      self._mainvbox.pack_start(self._hb_main)
+    self._create_elements()
+    self._hb_main.pack_start(self._vb_channels, False)
     self._mainvbox.show()
 
 if __name__ == "__main__":
+  # filter previews run in threads of their own.
+  gobject.threads_init()
   app = BUB()
   gtk.main()
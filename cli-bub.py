@@ -1,13 +1,26 @@
 #!python
 from __future__ import with_statement
 from optparse import OptionParser
-import math
+import ctypes
+import fnmatch
+import json
+import multiprocessing
 import os
 import sys
+import traceback
 
+import numpy
+
+import colormap
+from background import Background
+import dtypes
 import fin
 import findir
+import metrics
+import nrrd
+import resample
 import sls
+from outlier import Outlier
 
 def status(string): print string
 def validate(): return os.getenv("BUB_NO_VALIDATE") is None
@@ -27,136 +40,465 @@ def validate_spot_size(findir, sls):
                       ".  You can set the BUB_NO_VALIDATE environment " +
                       "variable to ignore this warning.")
 
-def lerp(x, x0,x1, y0,y1): return y0 + (x - x0)*(float(y1-y0) / float(x1-x0))
-
-def linearcolor(x, color0,color1, data0,data1):
-  '''Generates a color through linear interpolation in a range.
-     color0 is the color at data0; color1 is the color at data1.'''
-  assert(data0 <= x and x <= data1)
-  return (
-    lerp(x, data0,data1, color0[0],color1[0]),
-    lerp(x, data0,data1, color0[1],color1[1]),
-    lerp(x, data0,data1, color0[2],color1[2])
-  )
-
-def write_nrrd(field, field_data, dims):
-  '''Write out a detached nrrd from the given data.  Assumes the data are
-     64bit FP values, and 2 dimensional.  Also applies a 2.6 scaling factor in
-     X.'''
-  # write raw data
-  import numpy
-  numpy.array(field_data).tofile(field)
-
-  # now write the header.
-  with open(field + ".nhdr", "w") as nhdr:
-    nhdr.write("NRRD0001\n") # or 1?  5?  no idea.
-    nhdr.write("dimension: 2\n")
-    nhdr.write("type: double\n")
-    nhdr.write("encoding: raw\n")
-    nhdr.write("endian: %s\n" % sys.byteorder)
-    nhdr.write("content: %s\n" % field)
-    nhdr.write("min: %f\n" % min(field_data))
-    nhdr.write("max: %f\n" % max(field_data))
-    nhdr.write("datafile: %s\n" % field)
-    nhdr.write("sizes: %d %d\n" % (dims[0], dims[1]))
-    nhdr.write("spacings: 1.0 2.6\n")
-
-def background(data, dimensions):
-  '''Calculates the average background noise value.'''
-  n=0
-  total=0.0
-  for y in xrange(0, dimensions[1]):
-    idx = y*dimensions[0]
-    total += sum(data[idx:idx+10])
-    n += 10
-  return total / n
-
-def subtract_background(data, dimensions):
-  '''Subtracts out the background noise from the data.'''
-  bg = background(data, dimensions)
-  minimum = min(data)
-  for i in xrange(0, dimensions[0]*dimensions[1]):
-    # use max to ensure we don't get negative values
-    data[i] = max(minimum, data[i] - bg)
-    
-def write_image(filename, dimensions, data, color):
+def write_nrrd(field, field_data, dims, nrrd_type="double", encoding="raw",
+               spacings=(1.0, 2.6)):
+  '''Write out a detached nrrd from the given data, which are 2 dimensional.
+     The samples are written as they are; 'spacings' says how far apart they
+     are in X and Y.  Returns the nrrd.Writer.'''
+  return nrrd.write(field, [field], field_data, dims, nrrd_type, encoding,
+                    spacings)
+
+def write_volume(filename, table, fields, dims, options, spacings=(1.0, 2.6)):
+  '''Writes every field into one multi-channel nrrd, a scan line at a time,
+     so the only copy made is of one line of each field.'''
+  width = dims[0]
+  writer = nrrd.Writer(filename, fields, width, options.nrrd_type,
+                       options.nrrd_encoding, spacings)
+  for y in xrange(0, dims[1]):
+    writer.write([table[f][y*width:(y+1)*width] for f in fields])
+  writer.close()
+  return writer
+
+def count_input(fdir, prof, dimensions=None):
+  '''Counts the data of a run as read, for the profile: the files 'fdir'
+  last read from (the sidecar cache, if it answered; see FINDir.sources),
+  giving data of 'dimensions'.'''
+  if not prof.enabled(): return
+  files = fdir.sources()
+  dimensions = dimensions or (fdir.x(), fdir.y())
+  prof.count("files_read", len(files))
+  prof.count("bytes_read", sum([os.path.getsize(f) for f in files]))
+  prof.count("rows_parsed", dimensions[0] * dimensions[1])
+
+def count_output(filenames, prof):
+  '''Counts the given files as written, for the profile.'''
+  if not prof.enabled(): return
+  prof.count("bytes_written", sum([os.path.getsize(f) for f in filenames
+                                   if os.path.exists(f)]))
+
+def render_field(field, dimensions, data, resampler, prof):
+  '''Writes the image of one field, as the profile stage "write_image".'''
+  with prof.stage("write_image", field):
+    size = write_image(field + ".png", dimensions, data, True, resampler)
+    if size is not None:
+      prof.count("pixels_rendered", size[0] * size[1])
+      count_output([field + ".png"], prof)
+
+def background_filter(options):
+  '''The background filter, set up as the options ask.'''
+  bgf = Background()
+  bgf.update_value("samples", float(options.background_samples))
+  bgf.update_value("window", float(options.background_window))
+  return bgf
+
+def write_image(filename, dimensions, data, color, resampler=None):
+  '''Renders the data into a PNG, resampled onto square pixels by the
+     'resampler' (see resample.py).  Without one, the lines are assumed to be
+     resample.ASPECT samples apart.  Returns the size of the image, or None if
+     it could not be written.'''
   try:
-    from PIL import Image, ImageDraw
+    from PIL import Image
   except ImportError:
     print "PIL not available; skipping Image output."
-    return
+    return None
 
-  img = None
-  if color:
-    img = Image.new('RGB', dimensions)
-  else:
-    img = Image.new('I', dimensions)
-  draw = ImageDraw.Draw(img)
-  minmax = (min(data), max(data))
-  five_percent = minmax[0] + (minmax[1]-minmax[0]) * 0.05
-  twenty_percent = minmax[0] + (minmax[1]-minmax[0]) * 0.2
-
-  for y in xrange(0, dimensions[1]):
-    for x in xrange(0, dimensions[0]):
-      v = data[y*dimensions[0]+x]
-
-      if color:
-        c = None
-        if v <= five_percent:
-          c = (0,0,0)
-        elif v <= twenty_percent:
-          c = linearcolor(v, (0,0,0),(254,254,254), five_percent,twenty_percent)
-        else:
-          c = linearcolor(v, (128,255,0),(255,0,100), minmax[0],minmax[1])
-        draw.point((x,y), fill=(int(c[0]), int(c[1]), int(c[2])))
-      else:
-        # despite being represented internally as 32-bit values, no PIL
-        # exporter (that I can find) can actually write out a 32-bit greyscale
-        # image.  Thus we move the data range to 16-bit.
-        v = ((v - minmax[0]) / (minmax[1]-minmax[0])) * pow(2,16)
-        draw.point((x,y), fill=v)
+  if resampler is None: resampler = resample.uniform(dimensions)
+  img = colormap.image(resampler.resample(data), resampler.dimensions(), color)
 
   with open(filename, "w") as png:
-    # upsample the data to be a size Noel and Tim seem to like.
-    i = img.resize((int(dimensions[0]), int(dimensions[1]*2.6)))
-    i.save(png, 'PNG')
+    img.save(png, 'PNG')
+  return img.size
+
+def parse_range(text):
+  '''Parses a range given as "START:STOP", as for a Python slice: either may
+  be left out, and negative values count from the end.  Returns (start,
+  stop), or None if 'text' is None.  Raises ValueError if it's malformed.'''
+  if text is None: return None
+  bounds = text.split(":")
+  if len(bounds) != 2: raise ValueError("not START:STOP: '%s'" % text)
+  return tuple([int(b) if b.strip() else None for b in bounds])
 
 def validate_options(options):
-  if options.findir is None:
+  if options.batch is not None:
+    if options.findir is not None or options.sls is not None:
+      print >> sys.stderr, "--batch can't be used with --findir or --sls."
+      sys.exit(1)
+  elif options.findir is None:
     print >> sys.stderr, "--findir must be supplied."
     sys.exit(1)
-  if options.sls is None:
+  elif options.sls is None:
     print >> sys.stderr, "--sls must be supplied."
     sys.exit(1)
   if options.finglob is None:
     print >> sys.stderr, "This should not be possible..."
     sys.exit(1)
+  if options.stream and options.outliers_inplace:
+    print >> sys.stderr, "--outliers-inplace can't be used with --stream."
+    sys.exit(1)
+  if options.stream and options.export_jobs != 1:
+    print >> sys.stderr, "--export-jobs can't be used with --stream."
+    sys.exit(1)
+  for name, text in (("--rows", options.rows), ("--columns", options.columns)):
+    try: parse_range(text)
+    except ValueError:
+      print >> sys.stderr, name + " must be of the form START:STOP."
+      sys.exit(1)
+  if options.stream and (options.rows or options.columns):
+    print >> sys.stderr, "--rows and --columns can't be used with --stream."
+    sys.exit(1)
+  if options.background_window < 1 or options.background_window % 2 == 0:
+    print >> sys.stderr, "--background-window must be an odd number of lines."
+    sys.exit(1)
+  if options.dtype not in dtypes.TYPES:
+    print >> sys.stderr, "--dtype must be one of: " + \
+                         ", ".join(sorted(dtypes.TYPES.keys()))
+    sys.exit(1)
+  if options.nrrd_type not in nrrd.TYPES:
+    print >> sys.stderr, "--nrrd-type must be one of: " + \
+                         ", ".join(sorted(nrrd.TYPES.keys()))
+    sys.exit(1)
+  if options.nrrd_encoding not in nrrd.ENCODINGS:
+    print >> sys.stderr, "--nrrd-encoding must be one of: " + \
+                         ", ".join(nrrd.ENCODINGS)
+    sys.exit(1)
+
+def stream_export(fdir, s, fields, options, prof=metrics.NULL):
+  '''Exports every field one scan line at a time, through a pipeline of
+     generators: parse -> outliers -> background -> nrrd.  Only a few lines of
+     each field are ever in memory.  The images need the whole map, so they are
+     rendered afterwards, one field at a time, from the nrrd data (which are
+     memory-mapped, unless they are compressed).  The stages of the pipeline
+     run interleaved, so they are profiled as one, "stream".  's' is the run's
+     SLS.'''
+  # Each stage yields lines of shape (len(fields), width).  The times of the
+  # samples are kept, for the resampler.
+  times = []
+  def parse():
+    for row in fdir.rows(fields + ["Time"]):
+      times.append(row["Time"])
+      yield numpy.array([row[f] for f in fields])
+  lines = parse()
+  if options.outliers:
+    lines = Outlier().stream(lines)
+  if options.background:
+    lines = background_filter(options).stream(lines)
+
+  new_writer = lambda name, channels: nrrd.Writer(name, channels, fdir.x(),
+                                                  options.nrrd_type,
+                                                  options.nrrd_encoding)
+  with prof.stage("stream"):
+    if options.multichannel:
+      writers = [new_writer(options.multichannel, fields)]
+      for line in lines: writers[0].write(line)
+    else:
+      writers = [new_writer(f, [f]) for f in fields]
+      for line in lines:
+        for writer, l in zip(writers, line): writer.write(l)
+    with prof.stage("resample"):
+      resampler = resample.Resampler(s.scanlines(), numpy.concatenate(times),
+                                     writers[0].dimensions())
+    for w in writers:
+      w.set_spacings(resampler.spacings())
+      w.close()
+    count_input(fdir, prof)
+    count_output(sum([w.files() for w in writers], []), prof)
+
+  for i, field in enumerate(fields):
+    status("Rendering field: '%s'..." % field)
+    if options.multichannel:
+      header, data = nrrd.read(options.multichannel + ".nhdr")
+      data = data[...,i]
+    else:
+      header, data = nrrd.read(field + ".nhdr")
+    render_field(field, writers[0].dimensions(), data, resampler, prof)
+
+def export_field(field, field_data, dimensions, options, resampler=None,
+                 prof=metrics.NULL):
+  '''Filters one field as requested by the options, and writes it out; when
+     all fields go into one multi-channel volume, that is left to the caller.
+     The image is resampled by 'resampler'; see write_image.  Returns the
+     filtered data.'''
+  if resampler is None: resampler = resample.uniform(dimensions)
+  if(options.outliers or options.outliers_inplace):
+    with prof.stage("outliers", field):
+      outf = Outlier()
+      outf.update_value("inplace", options.outliers_inplace)
+      outf.set_input(field_data, dimensions)
+      field_data = outf.get_output()
+  if(options.background):
+    with prof.stage("background", field):
+      bgf = background_filter(options)
+      bgf.set_input(field_data, dimensions)
+      field_data = bgf.get_output()
+  render_field(field, dimensions, field_data, resampler, prof)
+  if not options.multichannel:
+    with prof.stage("write_nrrd", field):
+      writer = write_nrrd(field, field_data, dimensions, options.nrrd_type,
+                          options.nrrd_encoding, resampler.spacings())
+      count_output(writer.files(), prof)
+  return field_data
+
+# State shared with export worker processes; see parallel_export.
+_worker = {}
+
+def _init_worker(block, fields, dimensions, options, resampler):
+  data = numpy.ctypeslib.as_array(block)
+  _worker["data"] = data.reshape((len(fields), -1))
+  _worker["fields"] = fields
+  _worker["dimensions"] = dimensions
+  _worker["options"] = options
+  _worker["resampler"] = resampler
+
+def _export_worker(i):
+  '''Exports the i'th field, replacing its data with the filtered data.
+     Returns an error message (or None), and the stages profiled, if any.'''
+  prof = metrics.Profile(enabled=_worker["options"].profile is not None)
+  try:
+    _worker["data"][i] = export_field(_worker["fields"][i], _worker["data"][i],
+                                      _worker["dimensions"], _worker["options"],
+                                      _worker["resampler"], prof)
+  except Exception:
+    return (traceback.format_exc(), prof.stages())
+  return (None, prof.stages())
+
+def parallel_export(table, fields, dimensions, options, jobs, resampler,
+                    prof=metrics.NULL):
+  '''Exports every field using a pool of 'jobs' processes.  The data are
+     copied into a single block of shared memory first, so the workers can all
+     read them without any copying.  The filtered data are put back in
+     'table'.  Status is reported in field order, and the stages the workers
+     profiled are added to 'prof'.  Returns the number of fields which
+     failed.'''
+  n = dimensions[0] * dimensions[1]
+  ctype = {"float32": ctypes.c_float, "float64": ctypes.c_double}[options.dtype]
+  block = multiprocessing.RawArray(ctype, len(fields) * n)
+  shared = numpy.ctypeslib.as_array(block)
+  for i, field in enumerate(fields): shared[i*n:(i+1)*n] = table[field]
+
+  failures = 0
+  pool = multiprocessing.Pool(jobs, _init_worker,
+                              (block, fields, dimensions, options,
+                               resampler))
+  try:
+    results = pool.imap(_export_worker, xrange(0, len(fields)))
+    for field, (error, stages) in zip(fields, results):
+      prof.merge(stages)
+      if error is None:
+        status("Processed field: '%s'" % field)
+      else:
+        failures += 1
+        print >> sys.stderr, "Field '%s' failed:\n%s" % (field, error)
+  finally:
+    pool.close()
+    pool.join()
+  for i, field in enumerate(fields): table[field] = shared[i*n:(i+1)*n]
+  return failures
+
+def process_run(findir_path, sls_path, options, prof=metrics.NULL):
+  '''Processes a single run (a FIN directory and its SLS file), writing the
+     results into the current directory.  The stages are recorded in 'prof'.
+     Returns the number of fields which could not be exported.'''
+  status("Reading table of elements...")
+  fdir = findir.FINDir(findir_path, options.finglob, cache=options.cache,
+                       workers=(options.jobs or None),
+                       dtype=dtypes.TYPES[options.dtype])
+  fields = fdir.elements()
 
-def is_outlier(stencil):
-  '''Identifies if a particular datum is an outlier.  Expects to get the datum
-     as well as neighborhood information.  We expect to receive a 9-point
-     stencil, with the datum at index [4].'''
-  assert(len(stencil) == 9)
-  total = math.fsum(stencil[0:4] + stencil[5:9])
-  avg = total / 9.0
-  diff = math.fabs(stencil[4] - avg)
-  cutoff = 0.95 * avg
-  if diff > cutoff: return True
-  return False
-
-def avg(l): return math.fsum(l) / len(l)
-
-def average_out_outliers(data, dimensions):
-  minimum = min(data)
-  for y in xrange(1, dimensions[1]-1):
-    for x in xrange(1, dimensions[0]-1):
-      idx1 = (y-1)*dimensions[0] + x-1 # line above
-      idx2 = (y-0)*dimensions[0] + x-1
-      idx3 = (y+1)*dimensions[0] + x-1 # line below
-      stencil = data[idx1:idx1+3] + data[idx2:idx2+3] + data[idx3:idx3+3]
-      if is_outlier(stencil):
-        data[idx2+1] = avg(data[idx1:idx1+3] + [data[idx2]] + [data[idx2+2]] +
-                           data[idx3:idx3+3])
+  status("Reading SLS information...")
+  with prof.stage("validate_spot_size"):
+    s = sls.SLS(sls_path)
+    validate_spot_size(fdir, s)
+
+  rows, columns = parse_range(options.rows), parse_range(options.columns)
+  cropped = rows is not None or columns is not None
+  if cropped:
+    rows = findir.bounds(rows, fdir.y())
+    columns = findir.bounds(columns, fdir.x())
+    dimensions = (columns[1] - columns[0], rows[1] - rows[0])
+    if dimensions[0] == 0 or dimensions[1] == 0:
+      raise UserWarning("The region %s of the %dx%d map is empty." %
+                        (`(rows, columns)`, fdir.x(), fdir.y()))
+  else:
+    dimensions = (fdir.x(), fdir.y())
+  fields = [f for f in fields if f != "Time"]
+  prof.note("findir", findir_path)
+  prof.note("dimensions", dimensions)
+  prof.note("fields", fields)
+
+  if options.stream:
+    status("Streaming FIN data...")
+    stream_export(fdir, s, fields, options, prof)
+    return 0
+
+  status("Reading FIN data...")
+  with prof.stage("parse"):
+    if cropped:
+      prof.note("region", {"rows": rows, "columns": columns})
+      table = fdir.region(fields + ["Time"], rows, columns)
+    else:
+      table = fdir.table(fields + ["Time"])
+    count_input(fdir, prof, dimensions)
+  # Work out where every sample goes, once; every field is resampled the same.
+  with prof.stage("resample"):
+    if cropped:
+      start, stop = resample.lines(s.scanlines(), fdir.y(), rows)
+      resampler = resample.Resampler({"start": start, "stop": stop},
+                                     table.pop("Time"), dimensions,
+                                     fdir.time_spans(rows))
+    else:
+      resampler = resample.Resampler(s.scanlines(), table.pop("Time"),
+                                     dimensions)
+
+  failures = 0
+  if options.export_jobs != 1:
+    jobs = options.export_jobs or multiprocessing.cpu_count()
+    status("Processing %d fields with %d processes..." % (len(fields), jobs))
+    with prof.stage("export"):
+      failures = parallel_export(table, fields, dimensions, options, jobs,
+                                 resampler, prof)
+  else:
+    for field in fields:
+      status("Processing field: '%s'..." % field)
+      table[field] = export_field(field, table[field], dimensions, options,
+                                  resampler, prof)
+
+  if options.multichannel and failures == 0:
+    status("Writing volume: '%s'..." % options.multichannel)
+    with prof.stage("write_nrrd"):
+      writer = write_volume(options.multichannel, table, fields, dimensions,
+                            options, resampler.spacings())
+      count_output(writer.files(), prof)
+  return failures
+
+def new_profile(options):
+  '''A Profile to record a run in, if the options ask for one.'''
+  if options.profile is None: return metrics.NULL
+  return metrics.Profile()
+
+def read_manifest(filename, outdir):
+  '''Reads a batch manifest: one run per line, given as the FIN directory,
+     the SLS file and (optionally) the directory to write results to.  Blank
+     lines and lines starting with '#' are ignored.  Relative paths are
+     relative to the manifest.  Returns a list of (findir, sls, output) runs.'''
+  base = os.path.dirname(os.path.abspath(filename))
+  runs = []
+  with open(filename, "r") as manifest:
+    for n, line in enumerate(manifest):
+      fields = line.split()
+      if len(fields) == 0 or fields[0].startswith("#"): continue
+      if len(fields) not in (2, 3):
+        raise UserWarning("%s:%d: expected 'FINDIR SLS [OUTPUT]'." %
+                          (filename, n+1))
+      fdir, slsfile = [os.path.join(base, f) for f in fields[0:2]]
+      if len(fields) == 3: output = os.path.join(outdir, fields[2])
+      else: output = os.path.join(outdir, os.path.basename(fdir.rstrip(os.sep)))
+      runs.append((fdir, slsfile, output))
+  return runs
+
+def find_runs(root, finglob, outdir):
+  '''Finds every run under 'root': directories which contain FIN files (per
+     'finglob') and an SLS file.  Results for a run go to the same relative
+     path under 'outdir'.  Returns a list of (findir, sls, output) runs; a run
+     whose SLS file is missing or ambiguous is given an SLS of None.'''
+  runs = []
+  for directory, subdirs, files in os.walk(root):
+    subdirs.sort()
+    if len(fnmatch.filter(files, finglob)) == 0: continue
+    slsfiles = [f for f in files if f.lower().endswith(".sls")]
+    slsfile = None
+    if len(slsfiles) == 1: slsfile = os.path.join(directory, slsfiles[0])
+    output = os.path.join(outdir, os.path.relpath(directory, root))
+    runs.append((directory, slsfile, output))
+  return runs
+
+class BatchState:
+  '''Remembers which runs of a batch have been completed, in a JSON file, so
+     that an interrupted batch can pick up where it stopped.'''
+  def __init__(self, filename):
+    self._filename = filename
+    self._runs = {}
+    if os.path.exists(filename):
+      with open(filename, "r") as f: self._runs = json.load(f)
+
+  def done(self, run): return self._runs.get(run[2], {}).get("status") == "done"
+
+  def record(self, run, error):
+    '''Records the outcome of a run; 'error' is None if it succeeded.  Runs
+       are identified by their output directory.'''
+    self._runs[run[2]] = {"status": error is None and "done" or "failed",
+                          "findir": run[0], "sls": run[1], "error": error}
+    tmp = self._filename + ".tmp"
+    with open(tmp, "w") as f: json.dump(self._runs, f, indent=2)
+    os.rename(tmp, self._filename)
+
+# The options every batch worker process uses; see run_batch.
+_batch_options = {}
+
+def _init_batch(options): _batch_options["options"] = options
+
+def _batch_worker(run):
+  '''Processes one batch run, logging to a file in its output directory.
+     Returns the run and an error message (or None, on success).'''
+  findir_path, sls_path, output = run
+  stdout = sys.stdout
+  try:
+    if sls_path is None:
+      raise UserWarning("No SLS file, or more than one, in " + findir_path)
+    if not os.path.isdir(output): os.makedirs(output)
+    os.chdir(output)
+    sys.stdout = open("bub.log", "w")
+    options = _batch_options["options"]
+    prof = new_profile(options)
+    try:
+      failures = process_run(findir_path, sls_path, options, prof)
+    finally:
+      if prof.enabled(): prof.write(os.path.basename(options.profile))
+    if failures > 0:
+      return (run, "Some fields failed; see bub.log.")
+  except UserWarning, e:
+    return (run, str(e))
+  except Exception:
+    return (run, traceback.format_exc())
+  finally:
+    if sys.stdout is not stdout:
+      sys.stdout.close()
+      sys.stdout = stdout
+  return (run, None)
+
+def run_batch(path, options):
+  '''Processes every run listed in the manifest 'path', or found in the
+     directory tree 'path', using a pool of processes.  Runs which completed in
+     an earlier invocation are skipped.  Returns the number of runs which
+     failed.'''
+  outdir = os.path.abspath(options.batch_output)
+  if os.path.isdir(path):
+    runs = find_runs(os.path.abspath(path), options.finglob, outdir)
+  else:
+    runs = read_manifest(path, outdir)
+  if not os.path.isdir(outdir): os.makedirs(outdir)
+  state = BatchState(os.path.join(outdir, "bub-batch-state.json"))
+  todo = [r for r in runs if not state.done(r)]
+  status("%d runs; %d already done." % (len(runs), len(runs) - len(todo)))
+
+  # Each run gets one process; don't let them spawn pools of their own.
+  options.jobs = 1
+  options.export_jobs = 1
+  jobs = options.batch_jobs or multiprocessing.cpu_count()
+  failures = 0
+  pool = multiprocessing.Pool(jobs, _init_batch, (options,))
+  try:
+    for run, error in pool.imap_unordered(_batch_worker, todo):
+      state.record(run, error)
+      if error is None:
+        status("Finished: %s" % run[0])
+      else:
+        failures += 1
+        print >> sys.stderr, "FAILED: %s\n%s" % (run[0], error)
+  finally:
+    pool.close()
+    pool.join()
+  status("%d runs failed." % failures)
+  return failures
 
 if __name__ == "__main__":
   parser = OptionParser()
@@ -168,26 +510,87 @@ if __name__ == "__main__":
                     help="Filename glob to use for FIN files ('*FIN2').")
   parser.add_option("-o", "--outliers", dest="outliers", default=False,
                     action="store_true", help="Average out the outliers.")
+  parser.add_option("--outliers-inplace", dest="outliers_inplace",
+                    default=False, action="store_true",
+                    help="Average out the outliers with the old, in-place "
+                         "algorithm.  Slow; only useful for reproducing old "
+                         "results exactly.")
+  parser.add_option("-b", "--background", dest="background", default=False,
+                    action="store_true",
+                    help="Subtract the background noise from each line.")
+  parser.add_option("--background-samples", dest="background_samples",
+                    default=10, type="int", metavar="N",
+                    help="Estimate the background of a line from its first N "
+                         "samples (10).")
+  parser.add_option("--background-window", dest="background_window",
+                    default=1, type="int", metavar="N",
+                    help="Average the background estimates over N lines "
+                         "centred on each line (1), to follow instrument "
+                         "drift.  N must be odd.")
+  parser.add_option("--stream", dest="stream", default=False,
+                    action="store_true",
+                    help="Process the data a scan line at a time, so that "
+                         "memory use does not grow with the size of the map.")
+  parser.add_option("--rows", dest="rows", metavar="START:STOP",
+                    help="Only export scan lines START to STOP-1, counting "
+                         "from 0; either may be left out.  Only their FIN "
+                         "files are read.")
+  parser.add_option("--columns", dest="columns", metavar="START:STOP",
+                    help="Only export samples START to STOP-1 of each scan "
+                         "line, counting from 0; either may be left out.")
+  parser.add_option("--multichannel", dest="multichannel", metavar="NAME",
+                    help="Write every field into one multi-channel nrrd "
+                         "volume, NAME.nhdr, instead of a nrrd per field.")
+  parser.add_option("--nrrd-type", dest="nrrd_type", default="double",
+                    metavar="TYPE",
+                    help="Write nrrd data as 'double' (the default) or "
+                         "'float'.")
+  parser.add_option("--nrrd-encoding", dest="nrrd_encoding", default="raw",
+                    metavar="ENC",
+                    help="Write nrrd data 'raw' (the default) or 'gzip' "
+                         "compressed.")
+  parser.add_option("--dtype", dest="dtype", default="float64", metavar="TYPE",
+                    help="Hold the data as 'float64' (the default) or "
+                         "'float32', which needs half the memory.")
+  parser.add_option("-j", "--jobs", dest="jobs", default=1, type="int",
+                    help="Parse FIN files with N processes (1).  0 uses one "
+                         "process per core.", metavar="N")
+  parser.add_option("--export-jobs", dest="export_jobs", default=1,
+                    type="int", metavar="N",
+                    help="Filter and write out fields with N processes (1).  "
+                         "0 uses one process per core.")
+  parser.add_option("--batch", dest="batch", metavar="PATH",
+                    help="Process many runs.  PATH is either a manifest with "
+                         "lines of 'FINDIR SLS [OUTPUT]', or a directory "
+                         "tree which is searched for FIN directories with "
+                         "an SLS file.  Completed runs are recorded, and "
+                         "skipped if the batch is restarted.")
+  parser.add_option("--batch-jobs", dest="batch_jobs", default=0, type="int",
+                    metavar="N",
+                    help="Process N runs at once (0, one per core).  Each "
+                         "run uses a single process.")
+  parser.add_option("--batch-output", dest="batch_output", default=".",
+                    metavar="DIR",
+                    help="Write batch results under DIR ('.').")
+  parser.add_option("--no-cache", dest="cache", default=True,
+                    action="store_false",
+                    help="Don't read or write the parsed-data cache which "
+                         "is kept alongside the FIN files.")
+  parser.add_option("--profile", dest="profile", metavar="FILE",
+                    help="Record the time, CPU time, memory use and I/O of "
+                         "each stage, per field, and write them to FILE as "
+                         "JSON.  In a batch, each run writes FILE in its "
+                         "output directory.")
   options,args = parser.parse_args()
 
   validate_options(options)
 
-  status("Reading table of elements...")
-  fdir = findir.FINDir(options.findir, options.finglob)
-  fields = fdir.elements()
-
-  status("Reading SLS information...")
-  s = sls.SLS(options.sls)
-  validate_spot_size(fdir, s)
-
-  dimensions = (fdir.x(), fdir.y())
-
-  for field in fields:
-    if field != "Time":
-      status("Processing field: '%s'..." % field)
-      field_data = fdir.element(field)
-      if(options.outliers):
-        average_out_outliers(field_data, dimensions)
-      use_color = True
-      write_image(field + ".png", dimensions, field_data, use_color)
-      write_nrrd(field, field_data, dimensions)
+  if options.batch is not None:
+    if run_batch(options.batch, options) > 0: sys.exit(1)
+  else:
+    prof = new_profile(options)
+    try:
+      failures = process_run(options.findir, options.sls, options, prof)
+    finally:
+      if prof.enabled(): prof.write(options.profile)
+    if failures > 0: sys.exit(1)
@@ -0,0 +1,90 @@
+#!python
+# Maps single-component data onto images, for display and for export.
+#
+# The color transfer function is the one Noel and Tim settled on: everything
+# at or below 5% of the data range is black, 5%-20% is a black to white ramp,
+# and everything above that is colored on a green to red ramp over the full
+# data range.  The whole array goes through the transfer function at once;
+# there are no per-pixel Python loops in here.
+import numpy
+
+# (color at the low end, color at the high end) of each ramp.
+GREY_RAMP = ((0,0,0), (254,254,254))
+COLOR_RAMP = ((128,255,0), (255,0,100))
+
+def lerp(x, x0,x1, y0,y1):
+  '''Maps x from [x0,x1] onto [y0,y1].  An empty range maps everything to
+  y0.'''
+  if x1 == x0: return numpy.zeros_like(x) + y0
+  return y0 + (x - x0)*(float(y1-y0) / float(x1-x0))
+
+def _grid(data, dims):
+  '''Reshapes the flat data into a (height, width) array of doubles.'''
+  return numpy.asarray(data, dtype=numpy.float64).reshape((dims[1], dims[0]))
+
+def rgb(data, dims, minmax=None):
+  '''Runs the data through the color transfer function.  Returns a C-ordered
+  (height, width, 3) array of 8bit RGB values, suitable for handing straight
+  to PIL or GTK.  The transfer function is scaled to the range of the data,
+  unless 'minmax' gives another range -- e.g. that of the whole map, when only
+  some lines of it are being colored.'''
+  values = _grid(data, dims)
+  if minmax is None: minmax = (values.min(), values.max())
+  five_percent = minmax[0] + (minmax[1]-minmax[0]) * 0.05
+  twenty_percent = minmax[0] + (minmax[1]-minmax[0]) * 0.2
+
+  # Anything not covered by a ramp stays black.
+  out = numpy.zeros(values.shape + (3,), dtype=numpy.uint8)
+  grey = (values > five_percent) & (values <= twenty_percent)
+  color = values > twenty_percent
+  grey_v = values[grey]
+  color_v = values[color]
+  for c in xrange(0, 3):
+    channel = out[...,c]
+    # Assigning into a uint8 array truncates, just like int() would.
+    if grey_v.size:
+      channel[grey] = lerp(grey_v, five_percent,twenty_percent,
+                           GREY_RAMP[0][c],GREY_RAMP[1][c])
+    if color_v.size:
+      channel[color] = lerp(color_v, minmax[0],minmax[1],
+                            COLOR_RAMP[0][c],COLOR_RAMP[1][c])
+  return out
+
+def grey(data, dims):
+  '''Scales the data to 16 bits.  Returns a (height, width) array of 32bit
+  integers.  No PIL exporter (that I can find) can actually write out a 32-bit
+  greyscale image, which is why we don't use the whole range.'''
+  values = _grid(data, dims)
+  minmax = (values.min(), values.max())
+  if minmax[1] == minmax[0]: return numpy.zeros(values.shape, numpy.int32)
+  scaled = ((values - minmax[0]) / (minmax[1]-minmax[0])) * pow(2,16)
+  return scaled.astype(numpy.int32)
+
+def image(data, dims, color=True):
+  '''Creates a PIL image from raw, single-component image data.  Color images
+  are RGB; greyscale images are PIL's 32bit integer 'I' mode.'''
+  from PIL import Image
+  if color:
+    return Image.fromarray(rgb(data, dims), 'RGB')
+  return Image.fromarray(grey(data, dims), 'I')
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestColormap(unittest.TestCase):
+    def test_ramps(self):
+      out = rgb(numpy.arange(0.0, 101.0), (101,1))
+      self.assertEqual(out.shape, (1, 101, 3))
+      self.assertEqual(out[0,0].tolist(), [0, 0, 0])
+      self.assertEqual(out[0,100].tolist(), list(COLOR_RAMP[1]))
+      self.assertEqual(grey([0.0, 1.0], (2,1)).tolist(), [[0, pow(2,16)]])
+
+    def test_constant(self):
+      # A dead channel: every value the same.  It's drawn black.
+      data = numpy.zeros(12)
+      self.assertEqual(rgb(data, (4,3)).max(), 0)
+      self.assertEqual(rgb(numpy.ones(2), (2,1), (1.0, 1.0)).max(), 0)
+      self.assertEqual(grey(data, (4,3)).max(), 0)
+      self.assertEqual(image(data, (4,3)).size, (4, 3))
+
+  unittest.main()
@@ -0,0 +1,50 @@
+#!python
+# The types BUB holds data in.
+#
+# Data are kept in contiguous numpy arrays: float64 by default, or float32,
+# which halves the memory (and memory bandwidth) every map needs, at the cost
+# of precision beyond 7 or so digits.  That is plenty for counts per second,
+# but not for times: "Time" is always float64, since times accumulate over a
+# run.  Every stage keeps whatever float type it is given, so the choice only
+# needs to be made where the data are read.
+import numpy
+
+DEFAULT = numpy.float64
+TYPES = {"float32": numpy.float32, "float64": numpy.float64}
+
+def floats(data, dtype=None):
+  '''The data as a contiguous array of floats, of type 'dtype' or, if that is
+  None, of the type the data already have if it is one of TYPES (float64
+  otherwise).  Lists are accepted; arrays are only copied if they must be.'''
+  if dtype is None:
+    dtype = getattr(data, "dtype", None)
+    if dtype not in TYPES.values(): dtype = DEFAULT
+  return numpy.ascontiguousarray(data, dtype=dtype)
+
+def column(element, dtype):
+  '''The type to hold the given element's data in.'''
+  if element == "Time": return numpy.float64
+  return dtype
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestFloats(unittest.TestCase):
+    def test_list(self):
+      data = floats([1, 2, 3])
+      self.assertEqual(data.dtype, numpy.float64)
+      self.assertEqual(data.tolist(), [1.0, 2.0, 3.0])
+      self.assertEqual(floats([1.5], numpy.float32).dtype, numpy.float32)
+
+    def test_keeps_type(self):
+      single = numpy.arange(6, dtype=numpy.float32)
+      self.assertTrue(floats(single) is single)
+      self.assertEqual(floats(numpy.arange(6)).dtype, numpy.float64)
+      strided = numpy.arange(12.0)[::2]
+      self.assertTrue(floats(strided).flags["C_CONTIGUOUS"])
+
+    def test_column(self):
+      self.assertEqual(column("Time", numpy.float32), numpy.float64)
+      self.assertEqual(column("Li7", numpy.float32), numpy.float32)
+
+  unittest.main()
@@ -1,4 +1,5 @@
 #!python
+import copy
 
 class Filter:
   '''A filter on some data.  Filters must define 'set_input', 'get_output', and
@@ -7,12 +8,15 @@ class Filter:
   def __init__(self):
     self._parameters = {}
     self._name = "UnnamedFilter"
+    self._output = None
 
   def set_parameter(self, key, value, ptype):
     self._parameters[key] = [value, ptype]
 
   def update_value(self, key, value):
     self._parameters[key][0] = value
+    # the output (if any) was computed with the old value.
+    self._output = None
 
   # convenience method to not specify the type
   def set_parameter_floatrange(self, key, value, minval,maxval):
@@ -27,3 +31,11 @@ class Filter:
     return self._parameters
 
   def name(self): return self._name
+
+  def clone(self):
+    '''A copy of this filter which shares its input, but has its own parameters
+       and output: changing the parameters of one won't affect the other.'''
+    other = copy.copy(self)
+    other._parameters = copy.deepcopy(self._parameters)
+    other._output = None
+    return other
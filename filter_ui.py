@@ -3,19 +3,41 @@ import pygtk
 pygtk.require('2.0')
 import gtk
 import gobject
+import threading
+import traceback
+
+# How long the controls must be left alone before a preview runs, in ms.
+PREVIEW_DELAY = 250
 
 def event_hs_changed(get, set):
   set.page_size = get.page_size
   
 
 class FilterUI(gobject.GObject):
+  '''Controls for the parameters of the filter of a pipeline Stage (see
+     pipeline.py).  'execution-success' is emitted whenever there is new
+     output; get_output() gives it.  Outputs are remembered by the pipeline,
+     so going back to parameters which have been run before is free, and
+     nothing upstream of the filter is run again.
+
+     In preview mode, the filter is rerun in a background thread whenever the
+     parameters change, once they've been left alone for PREVIEW_DELAY ms.
+     Only one preview runs at a time.  A run can't be interrupted, but if the
+     parameters change while it is running its output is thrown away, and a
+     new run is started with the latest parameters.'''
   __gsignals__ = {
     'execution-success' : (gobject.SIGNAL_RUN_LAST, gobject.TYPE_NONE, ())
   }
-  def __init__(self, in_filter):
+  def __init__(self, stage):
     gobject.GObject.__init__(self)
-    self._filter = in_filter
+    self._stage = stage
+    self._filter = stage.get_filter()
     self._window = None
+    self._preview = False
+    self._emitting_preview = False
+    self._pending = None # timeout id of the next preview, if one is scheduled
+    self._running = False # is a preview running?
+    self._generation = 0 # bumped whenever the parameters change
 
   def create_ui(self, parent=None):
     self._window = gtk.Window(gtk.WINDOW_TOPLEVEL)
@@ -62,9 +84,11 @@ class FilterUI(gobject.GObject):
       self._vbox.pack_start(hbox)
 
     hb = gtk.HBox(True, 0)
-    lbl_nothing = gtk.Label()
-    lbl_nothing.show()
-    hb.pack_start(lbl_nothing)
+    cb_preview = gtk.CheckButton(label="Preview")
+    cb_preview.set_active(self._preview)
+    cb_preview.connect("toggled", self._toggle_preview)
+    cb_preview.show()
+    hb.pack_start(cb_preview)
     btn_execute = gtk.Button("Execute", stock=gtk.STOCK_EXECUTE)
     btn_execute.set_alignment(1.0, 0.5) # push it to the right
     btn_execute.connect("clicked", self._execute)
@@ -79,8 +103,19 @@ class FilterUI(gobject.GObject):
     self._window.show()
 
   def get_filter(self): return self._filter
+  def get_stage(self): return self._stage
+
+  def get_output(self):
+    '''The output for the current parameters.'''
+    return self._stage.output()
+
+  def is_preview(self):
+    '''True while 'execution-success' is being emitted for a preview, as
+       opposed to the user pressing 'Execute'.'''
+    return self._emitting_preview
 
   def destroy(self):
+    self._cancel_pending()
     self._window.destroy()
     self._window = None
 
@@ -88,11 +123,84 @@ class FilterUI(gobject.GObject):
     print "Running filter '%s' with parameters:" % self._filter.name()
     for k in self._filter.get_all_parameters().keys():
       print "\t", k, "->", self._filter.get_parameter(k)
-    self._filter.execute()
+    self._cancel_pending()
+    # The preview may well have done the work for us already.
+    self._stage.output()
     self.emit("execution-success")
 
   def _update_float(self, sbar, parameter_name):
     self._filter.update_value(parameter_name, sbar.get_value())
+    self._changed()
 
   def _update_boolean(self, srcobj, parameter_name):
     self._filter.update_value(parameter_name, srcobj.get_active())
+    self._changed()
+
+  def _toggle_preview(self, cbox):
+    self._preview = cbox.get_active()
+    if self._preview: self._schedule_preview()
+    else: self._cancel_pending()
+
+  def _changed(self):
+    self._generation += 1
+    if self._preview: self._schedule_preview()
+
+  def _schedule_preview(self):
+    '''(Re)starts the timer for the next preview, so we only run once the
+       sliders have stopped moving.'''
+    self._cancel_pending()
+    self._pending = gobject.timeout_add(PREVIEW_DELAY, self._start_preview)
+
+  def _cancel_pending(self):
+    if self._pending is not None:
+      gobject.source_remove(self._pending)
+      self._pending = None
+
+  def _start_preview(self):
+    self._pending = None
+    # If one is already running, _preview_done will start another.
+    if self._running: return False
+    # Run on a copy, so the sliders can keep changing the parameters.  The
+    # pipeline is only touched here, in the main loop: the copy is given the
+    # upstream output now, and its result is stored when it's done.
+    stage = self._stage.upstream().then(self._filter.clone())
+    if stage.cached() is not None:
+      self._show_preview()
+      return False
+    stage.get_filter().set_input(stage.upstream().output(),
+                                 stage.dimensions())
+    self._running = True
+    worker = threading.Thread(target=self._run_preview,
+                              args=(stage, self._generation))
+    worker.daemon = True
+    worker.start()
+    return False
+
+  def _run_preview(self, stage, generation):
+    '''Body of the preview thread.  Nothing in here may touch GTK or the
+       pipeline; the result is handed back to the main loop instead.'''
+    try:
+      output = stage.get_filter().get_output()
+    except Exception:
+      traceback.print_exc()
+      output = None
+    gobject.idle_add(self._preview_done, stage, generation, output)
+
+  def _preview_done(self, stage, generation, output):
+    self._running = False
+    if self._window is None: return False
+    if output is not None: stage.store(output)
+    if generation != self._generation:
+      # Stale: the parameters changed while we were running.
+      if self._preview and self._pending is None: self._start_preview()
+      return False
+    if output is None: return False
+    self._show_preview()
+    return False
+
+  def _show_preview(self):
+    self._emitting_preview = True
+    try:
+      self.emit("execution-success")
+    finally:
+      self._emitting_preview = False
@@ -3,9 +3,30 @@
 # spectrometer out at BU.  These are basically simple text files.
 from __future__ import with_statement
 
+import numpy
+
+import dtypes
+
+# How much of the end of a file to read at a time, looking for its last line.
+TAIL_BLOCK = 4096
+
+def _slice_lines(text, start, stop):
+  '''Lines 'start' to 'stop' (exclusive) of 'text'.'''
+  if stop <= start: return ""
+  ends = numpy.flatnonzero(numpy.frombuffer(text, dtype=numpy.uint8) ==
+                           ord("\n"))
+  begin = 0
+  if start > 0: begin = ends[start-1] + 1
+  end = len(text)
+  if stop-1 < len(ends): end = ends[stop-1]
+  return text[begin:end]
+
 class FIN:
-  def __init__(self, filename):
+  def __init__(self, filename, dtype=dtypes.DEFAULT):
+    '''A FIN file.  Its data are returned as arrays of 'dtype', float32 or
+    float64; "Time" is always float64 (see dtypes.py).'''
     self._finfile = filename
+    self._dtype = dtype
     self._header = None
     self._date = None
     self._time_offset = None
@@ -29,30 +50,121 @@ class FIN:
     self._time_offset = offset
 
   def element(self, element_name):
-    '''Gets just the given field from the FIN file.  Raises IndexError if the
-    element does not exist in the FIN file.  For this method, "Time" is
-    considered an element.'''
-    with open(self._finfile, "r") as fin:
+    '''Gets just the given field from the FIN file, as an array.  Raises
+    IndexError if the element does not exist in the FIN file.  For this
+    method, "Time" is considered an element.'''
+    return self.table([element_name])[element_name]
+
+  def table(self, element_names=None, lines=None):
+    '''Gets a set of fields from the FIN file, reading the file only once.
+    Returns a dict which maps each element name to an array of its values.  If
+    'element_names' is None, every column in the file is returned.  'lines'
+    may give a (start, stop) range, as for a slice, of the lines of data to
+    return; the others are not converted at all.  Raises IndexError if any of
+    the elements do not exist in the FIN file.'''
+    return self._table(element_names, lines, self._data())
+
+  def scan(self, element_names=None, lines=None):
+    '''The 'summary' and the 'table' of the file, reading it only once.'''
+    data = self._data()
+    return self._summary(data), self._table(element_names, lines, data)
+
+  def _table(self, element_names, lines, data):
+    '''Implements 'table', given the data section (see '_data').'''
+    rows = self._rows(data, lines)
+    if element_names is None: element_names = self._header
+    indices = [self._index(e) for e in element_names]
+
+    data = {}
+    for e, idex in zip(element_names, indices):
+      data[e] = rows[:,idex].astype(dtypes.column(e, self._dtype))
+    if "Time" in data and self._time_offset is not None:
+      data["Time"] += self._time_offset
+    return data
+
+  def _data(self):
+    '''Reads the header, and returns the data section of the file as a string,
+    along with the number of lines in it.'''
+    with open(self._finfile, "rb") as fin:
       self._read_header(fin)
+      # One read of the whole data section.  Converting it copies it once more
+      # (see '_rows'), so parsing needs about twice the file's size in memory.
+      text = fin.read()
+    n_lines = text.count("\n")
+    if text and not text.endswith("\n"): n_lines += 1
+    return text, n_lines
+
+  def summary(self):
+    '''Describes the file without parsing its data, which is much cheaper than
+    'table'.  Returns a dict of its "elements", "date" and "run_filename" (from
+    the header), the number of "rows" of data, and the first and last "times"
+    in it (without any time offset); "times" is None if there are no data.'''
+    return self._summary(self._data())
 
-      # Yes, we could simply read every field and return out the one the user
-      # wanted.  However the memory bound on this approach is the size of the
-      # element they want plus the size of a line, as opposed to the file size.
-      idex = 0
+  def _summary(self, data):
+    '''Implements 'summary', given the data section (see '_data').'''
+    text, n_lines = data
+    times = None
+    first = text.lstrip("\n").split("\n", 1)[0]
+    if first:
+      time = self._index("Time")
+      last = text.rstrip("\n").rsplit("\n", 1)[-1]
       try:
-        idex = self._header.index(element_name)
-      except ValueError:
-        raise IndexError(element_name + " does not exist in " + self._finfile +
-                         ".  Try one of " + " ".join(self._header))
+        times = (float(first.split(",")[time]), float(last.split(",")[time]))
+      except (IndexError, ValueError):
+        raise ValueError("Malformed data in " + self._finfile)
+    return {"elements": self._header, "date": self._date,
+            "run_filename": self._run_file, "rows": n_lines, "times": times}
 
-      data = []
-      if(element_name is "Time" and self._time_offset is not None):
-        data = [float(x.strip().split(",")[idex])+self._time_offset
-                for x in fin.readlines()]
-      else:
-        data = [float(x.strip().split(",")[idex]) for x in fin.readlines()]
+  def last_time(self):
+    '''The last time in the file (without any time offset), as in the
+    'summary', or None if there are no data.  Only the header and the last
+    line are read: the file is read backwards from its end.'''
+    with open(self._finfile, "rb") as fin:
+      self._read_header(fin)
+      start = fin.tell()
+      fin.seek(0, 2)
+      end = fin.tell()
+      tail = ""
+      while end > start and "\n" not in tail.rstrip("\n"):
+        size = min(TAIL_BLOCK, end - start)
+        end -= size
+        fin.seek(end)
+        tail = fin.read(size) + tail
+    last = tail.rstrip("\n").rsplit("\n", 1)[-1]
+    if not last: return None
+    try:
+      return float(last.split(",")[self._index("Time")])
+    except (IndexError, ValueError):
+      raise ValueError("Malformed data in " + self._finfile)
+
+  def _rows(self, data, lines=None):
+    '''Parses the data section of the file (as from '_data') into a 2D array,
+    with one row per line of the file (or of the range of lines given) and one
+    column per element.'''
+    text, n_lines = data
+    if lines is not None:
+      start, stop, step = slice(*lines).indices(n_lines)
+      text = _slice_lines(text, start, stop)
+      n_lines = max(stop - start, 0)
+    n_columns = len(self._header)
+    # Newlines become separators too, so that numpy can convert the whole data
+    # section in one go.  It stops at the first thing which isn't a number, so
+    # we know the file is malformed if we don't get every value.
+    values = numpy.fromstring(text.replace("\n", ","), dtype=numpy.float64,
+                              sep=",")
+    if values.size != n_lines * n_columns:
+      raise ValueError("Malformed data in " + self._finfile + ": expected " +
+                       `n_lines` + " lines of " + `n_columns` + " values.")
+    return values.reshape((n_lines, n_columns))
 
-      return data
+  def _index(self, element_name):
+    '''Column index of the given element.  The header must already be read.'''
+    try:
+      return self._header.index(element_name)
+    except ValueError:
+      raise IndexError(element_name + " does not exist in " + self._finfile +
+                       ".  Try one of " + " ".join(self._header))
 
   def date(self):
     """Returns the date of this FIN file's creation, as output by the scanner.
@@ -132,24 +244,69 @@ if __name__ == "__main__":
     def test_parse(self):
       fin = FIN(self.testfile)
       # first column
-      self.assertEqual(fin.element("Time"), [0.695, 1.388])
-      self.assertEqual(fin.element("Li7"), [53733.5, 46771.5])
+      self.assertEqual(fin.element("Time").tolist(), [0.695, 1.388])
+      self.assertEqual(fin.element("Li7").tolist(), [53733.5, 46771.5])
       # last column
-      self.assertEqual(fin.element("P31"), [1069296.0, 1506640.0])
+      self.assertEqual(fin.element("P31").tolist(), [1069296.0, 1506640.0])
+
+    def test_table(self):
+      fin = FIN(self.testfile)
+      tbl = fin.table()
+      self.assertEqual(sorted(tbl.keys()), sorted(self.elems))
+      self.assertEqual(tbl["Time"].tolist(), [0.695, 1.388])
+      self.assertEqual(tbl["P31"].tolist(), [1069296.0, 1506640.0])
+      self.assertTrue(tbl["P31"].flags["C_CONTIGUOUS"])
+
+    def test_float32(self):
+      fin = FIN(self.testfile, numpy.float32)
+      fin.set_time_offset(198.880997)
+      tbl = fin.table(["Li7", "Time"])
+      self.assertEqual(tbl["Li7"].dtype, numpy.float32)
+      self.assertEqual(tbl["Li7"].tolist(), [53733.5, 46771.5])
+      self.assertEqual(tbl["Time"].dtype, numpy.float64)
+      self.assertEqual(tbl["Time"].tolist(),
+                       [x + 198.880997 for x in [0.695, 1.388]])
+
+    def test_scan(self):
+      summary, tbl = FIN(self.testfile).scan(["Li7"], (1, 2))
+      self.assertEqual(summary, FIN(self.testfile).summary())
+      self.assertEqual(tbl["Li7"].tolist(), [46771.5])
+
+    def test_table_lines(self):
+      fin = FIN(self.testfile)
+      self.assertEqual(fin.table(["Li7"], (1, 2))["Li7"].tolist(), [46771.5])
+      self.assertEqual(fin.table(["Li7"], (0, 1))["Li7"].tolist(), [53733.5])
+      self.assertEqual(fin.table(["Li7"], (None, None))["Li7"].tolist(),
+                       [53733.5, 46771.5])
+      self.assertEqual(len(fin.table(["P31"], (2, 5))["P31"]), 0)
+
+    def test_table_subset(self):
+      fin = FIN(self.testfile)
+      fin.set_time_offset(1.0)
+      tbl = fin.table(["Li7", "Time"])
+      self.assertEqual(sorted(tbl.keys()), ["Li7", "Time"])
+      self.assertEqual(tbl["Li7"].tolist(), [53733.5, 46771.5])
+      self.assertEqual(tbl["Time"].tolist(), [x + 1.0 for x in [0.695, 1.388]])
+      self.assertRaises(IndexError, fin.table, ["Li7", "JunkColumn"])
 
     def test_invalid_elem(self):
       fin = FIN(self.testfile)
       self.assertRaises(IndexError, fin.element, "JunkColumn")
 
+    def test_malformed(self):
+      with open(self.testfile, "a") as fin: fin.write("2.1,17,garbage\n")
+      fin = FIN(self.testfile)
+      self.assertRaises(ValueError, fin.element, "Li7")
+
     def test_offset(self):
       '''Make sure we properly apply time offsets.'''
       fin = FIN(self.testfile)
       offset = 198.880997
       fin.set_time_offset(offset)
       lst = [x + offset for x in [0.695, 1.388]]
-      self.assertEqual(fin.element("Time"), lst)
+      self.assertEqual(fin.element("Time").tolist(), lst)
       # make sure we don't add the offset to other fields
-      self.assertEqual(fin.element("P31"), [1069296.0, 1506640.0])
+      self.assertEqual(fin.element("P31").tolist(), [1069296.0, 1506640.0])
 
     def test_elements(self):
       fin = FIN(self.testfile)
@@ -161,4 +318,26 @@ if __name__ == "__main__":
       fin = FIN(self.testfile)
       self.assertEqual(fin.time(), 1.388 - 0.695)
 
+    def test_summary(self):
+      summary = FIN(self.testfile).summary()
+      self.assertEqual(summary["elements"], self.elems)
+      self.assertEqual(summary["run_filename"], "101510lm2.FIN")
+      self.assertEqual(summary["rows"], 2)
+      self.assertEqual(summary["times"], (0.695, 1.388))
+
+    def test_last_time(self):
+      global TAIL_BLOCK
+      self.assertEqual(FIN(self.testfile).last_time(), 1.388)
+      # lines longer than a block, and trailing blank lines
+      block = TAIL_BLOCK
+      TAIL_BLOCK = 7
+      try:
+        with open(self.testfile, "a") as fin: fin.write("\n\n")
+        self.assertEqual(FIN(self.testfile).last_time(), 1.388)
+      finally:
+        TAIL_BLOCK = block
+      header = open(self.testfile).readlines()[:8]
+      with open(self.testfile, "w") as fin: fin.writelines(header)
+      self.assertEqual(FIN(self.testfile).last_time(), None)
+
   unittest.main()
@@ -0,0 +1,94 @@
+#!python
+# Sidecar cache for parsed FIN directories.
+#
+# Parsing a directory full of FIN text files is slow, and we tend to look at
+# the same data set many times.  Once a directory has been parsed, we store
+# every column in a binary .npy file next to the FIN files, along with a small
+# JSON file holding the header metadata.  The .npy file is memory-mapped when
+# it is loaded, so reopening a data set costs little more than a stat() of each
+# FIN file.
+#
+# The cache is keyed on the names, sizes and modification times of the FIN
+# files; if any of them change (or files appear/disappear), the cache is
+# considered stale and the caller should re-parse and store it again.
+from __future__ import with_statement
+import hashlib
+import json
+import os
+
+import numpy
+
+# Bump this whenever the on-disk layout changes.
+VERSION = 1
+
+def key(files):
+  '''Generates the cache key for a list of files: the name, size and
+  modification time of each of them.'''
+  k = []
+  for f in files:
+    st = os.stat(f)
+    k.append([os.path.basename(f), st.st_size, st.st_mtime])
+  return k
+
+class Cache:
+  def __init__(self, directory, pattern):
+    '''A cache for the FIN files in 'directory' which match 'pattern'.
+    Different patterns in the same directory get different caches.'''
+    tag = hashlib.md5(pattern).hexdigest()[:12]
+    base = os.path.join(directory, ".bub-cache-" + tag)
+    self._meta_file = base + ".json"
+    self._data_file = base + ".npy"
+
+  def data_file(self):
+    '''The .npy file holding the cached columns.'''
+    return self._data_file
+
+  def load(self, files):
+    '''Returns a (metadata, columns) tuple if the cache is valid for the given
+    list of files, or None if there is no usable cache.  'columns' is a
+    read-only, memory-mapped 2D array with one row per element, in the order
+    given by metadata["elements"].'''
+    try:
+      with open(self._meta_file, "r") as mf:
+        meta = json.load(mf)
+    except (IOError, OSError, ValueError):
+      return None
+    if meta.get("version") != VERSION or meta.get("key") != key(files):
+      return None
+    try:
+      columns = numpy.load(self._data_file, mmap_mode="r")
+    except (IOError, OSError, ValueError):
+      return None
+    meta["elements"] = [str(e) for e in meta["elements"]]
+    meta["date"] = str(meta["date"])
+    meta["run_filename"] = str(meta["run_filename"])
+    if columns.ndim != 2 or columns.shape[0] != len(meta["elements"]):
+      return None
+    return meta, columns
+
+  def store(self, files, meta, table):
+    '''Writes the given table (a dict of element name -> data) to the cache.
+    'meta' holds the header information for the data set; it must have (at
+    least) an "elements" key giving the column order.  Failures to write (e.g.
+    a read-only data directory) are silently ignored; we'll just parse again
+    next time.'''
+    meta = dict(meta)
+    meta["version"] = VERSION
+    meta["key"] = key(files)
+    columns = numpy.array([table[e] for e in meta["elements"]],
+                          dtype=numpy.float64)
+    try:
+      # Remove the metadata first: it's what marks the cache as valid, and we
+      # don't want it to ever describe a half-written data file.
+      if os.path.exists(self._meta_file): os.remove(self._meta_file)
+      self._write(self._data_file, lambda f: numpy.save(f, columns))
+      self._write(self._meta_file, lambda f: json.dump(meta, f))
+    except (IOError, OSError):
+      pass
+
+  def _write(self, filename, writer):
+    '''Writes to a temporary file and moves it in place when done, so readers
+    never see a partial file.'''
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f: writer(f)
+    os.rename(tmp, filename)
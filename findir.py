@@ -12,21 +12,63 @@
 # handle this by figuring out the max time code, and using our FIN() classes'
 # set_time_offset method to get the appropriate time code.
 import glob
+import itertools
 import math
+import multiprocessing
 import os
 
+import numpy
+
+import dtypes
 import fin
+import fincache
 
 def validate(): return os.getenv("BUB_NO_VALIDATE") is None
 def equalf(a,b): EPSILON=1E-2; return math.fabs(a-b) < EPSILON
 
+def _read_fin(args):
+  '''Parses a single FIN file, without any time offset.  This is a module-level
+  function so that it can be sent to worker processes.  Returns a tuple of the
+  file's elements, run filename, date, and the table of the requested
+  columns.'''
+  filename, columns, dtype = args
+  ff = fin.FIN(filename, dtype)
+  tbl = ff.table(columns)
+  return (ff.elements(), ff.run_filename(), ff.date(), tbl)
+
+def bounds(r, n):
+  '''The (start, stop) bounds, within [0, n), of a range given as for a slice:
+  either may be None, and negative values count from the end.  A range of
+  None is all of [0, n).'''
+  start, stop, step = slice(*(r or (None, None))).indices(n)
+  return start, max(start, stop)
+
+def _end_time(entry):
+  '''The last time in the file of a manifest entry, without any offset; 0 if
+  it has no data.  The entry must be filled in, or have had its "end" read;
+  see FINDir._time_offset.'''
+  if "times" in entry: end = entry["times"] and entry["times"][1]
+  else: end = entry["end"]
+  return end or 0.0
+
 class FINDir:
-  def __init__(self, directory, pattern):
+  def __init__(self, directory, pattern, cache=False, workers=1,
+               dtype=dtypes.DEFAULT):
     '''Initializes a FIN directory.  The 'directory' parameter should be a
     path, and 'pattern' should be a glob string which matches the set of FIN
-    files you care about.'''
+    files you care about.  If 'cache' is true, parsed data are stored in a
+    binary sidecar file in the directory (see fincache.py), and reused as long
+    as none of the FIN files change.  'workers' is the number of processes
+    used to parse FIN files; None means one per core.  Data are returned as
+    arrays of 'dtype', float32 or float64 ("Time" is always float64).
+
+    The directory is listed once, when it is first needed, into a manifest
+    (see 'manifest'); everything but 'refresh' works from that listing.'''
     self._directory = directory
     self._pattern = pattern
+    self._workers = workers
+    self._dtype = dtype
+    if self._workers is None: self._workers = multiprocessing.cpu_count()
     self._date = None
     self._elements = None
     self._runfilename = None
@@ -34,70 +76,368 @@ class FINDir:
     self._points_per_file = None
     if not os.path.exists(self._directory):
       raise UserWarning("Invalid path: %s" % self._directory)
+    self._cache = None
+    if cache: self._cache = fincache.Cache(self._directory, self._pattern)
+    # Files we've read so far, and where their times ended; see 'refresh'.
+    self._seen = []
+    self._last_time = 0.0
+    self._manifest = None # see _entries
+    self._sources = [] # see sources
+
+  def sources(self):
+    '''The files the last 'table', 'region' or 'rows' read its data from:
+    the cache's data file if the cache answered, or else the FIN files it
+    parsed.'''
+    return self._sources
 
   def _files(self):
+    '''Lists the directory afresh.'''
     files = glob.glob(self._directory + os.sep + self._pattern)
     files.sort()
     return files
 
-  def element(self, element_name):
-      '''Gets the full data for the given element, by parsing every FIN file in
-      the directory.  This will take some time!'''
-      data = []
-      last_time = 0.0
-      for f in self._files():
-        ff = fin.FIN(f)
-        ff.set_time_offset(last_time)
-
-        # Cache some metadata clients sometimes want to query.
-        if self._elements is None: self._elements = ff.elements()
-        if self._runfilename is None: self._runfilename = ff.run_filename()
-        if self._scan_time is None: self._scan_time = ff.time()
-
-        # All the run filenames should be the same... else the user is mixing
-        # data from different data sets.
-        if validate() and self._runfilename != ff.run_filename():
-          raise UserWarning("I saw a 'run filename' (3rd line of a FIN file) "
-                            "of " + self._runfilename + ", but I'm looking at "
-                            + f + " right now, and it has a run filename of "
-                            + ff.run_filename() + ".  This probably means you "
-                            "are mixing FIN files from logically separate "
-                            "data sets.\n"
-                            "You can set the environment variable "
-                            "'BUB_NO_VALIDATE' to get around this, but you're "
-                            "probably processing unassociated data together, "
-                            "which does not make sense.")
-        if validate() and not equalf(self._scan_time, ff.time()):
-          raise UserWarning("Scan times are changing.")
-
-        elem = ff.element(element_name)
-        if element_name is "Time": last_time = max(elem)
-        if self._points_per_file is None: self._points_per_file = len(elem)
-        if validate() and self._points_per_file != len(elem):
-          raise UserWarning("Points per file changing.")
-        data.extend(elem)
-
-      return data
+  def files(self):
+    '''The FIN files in the directory, in the order they are read.'''
+    return [e["path"] for e in self._entries()]
+
+  def _entries(self):
+    '''The manifest, built from a listing of the directory the first time it
+    is needed.  Entries are only scanned on demand; see '_entry'.'''
+    if self._manifest is None: self._update_manifest(self._files())
+    return self._manifest
+
+  def _update_manifest(self, files):
+    '''Makes the manifest describe 'files'.  Entries for files which have not
+    changed (by size and modification time) are kept as they are.'''
+    old = dict([(e["path"], e) for e in self._manifest or []])
+    manifest = []
+    for f in files:
+      st = os.stat(f)
+      e = old.get(f)
+      if e is None or (e["size"], e["mtime"]) != (st.st_size, st.st_mtime):
+        e = {"path": f, "size": st.st_size, "mtime": st.st_mtime}
+      manifest.append(e)
+    self._manifest = manifest
+
+  def _entry(self, i):
+    '''The i'th entry of the manifest, scanned (see fin.FIN.summary) if
+    parsing the file hasn't already filled it in.'''
+    e = self._entries()[i]
+    if "rows" not in e: e.update(fin.FIN(e["path"]).summary())
+    return e
+
+  def manifest(self):
+    '''Describes every FIN file, without parsing their data, and validates
+    them against each other.  Returns a list with a dict per file, in the
+    order they are read, holding its "path", "size", "mtime", "elements",
+    "date", "run_filename", number of "rows" and first and last "times".
+    Files are only scanned once; parsing a file also fills in its entry.'''
+    entries = [self._entry(i) for i in xrange(0, len(self._entries()))]
+    for e in entries: self._check(e)
+    return entries
+
+  def _check(self, e):
+    '''Validates a manifest entry against the first file, unless that has
+    already been done.'''
+    if not validate() or e.get("validated"): return
+    # All the run filenames should be the same... else the user is mixing
+    # data from different data sets.
+    if self.run_filename() != e["run_filename"]:
+      raise UserWarning("I saw a 'run filename' (3rd line of a FIN file) "
+                        "of " + self.run_filename() + ", but I'm looking at "
+                        + e["path"] + " right now, and it has a run filename "
+                        "of " + e["run_filename"] + ".  This probably means "
+                        "you are mixing FIN files from logically separate "
+                        "data sets.\n"
+                        "You can set the environment variable "
+                        "'BUB_NO_VALIDATE' to get around this, but you're "
+                        "probably processing unassociated data together, "
+                        "which does not make sense.")
+    times = e["times"] or (0.0, 0.0)
+    if not equalf(self.scanning_time_per_line(), times[1] - times[0]):
+      raise UserWarning("Scan times are changing.")
+    if self._data_points_per_line() != e["rows"]:
+      raise UserWarning("Points per file changing.")
+    e["validated"] = True
 
+  def element(self, element_name):
+    '''Gets the full data for the given element, by parsing every FIN file in
+    the directory.  This will take some time!'''
+    return self.table([element_name])[element_name]
+
+  def table(self, element_names=None):
+    '''Gets the full data for a set of elements, reading each FIN file in the
+    directory only once.  Returns a dict mapping element name to an array of
+    values for the whole directory.  If 'element_names' is None, every
+    element is returned.'''
+    if self._cache is None: return self._parse(element_names)
+
+    files = self.files()
+    cached = self._load_cache(files)
+    if cached is None:
+      # Parse everything, so that the cache can answer any future request.
+      tbl = self._parse(None)
+      self._cache.store(files, self._metadata(), tbl)
+      column = lambda e: tbl[e]
+    else:
+      meta, columns = cached
+      self._set_metadata(meta)
+      self._sources = [self._cache.data_file()]
+      column = lambda e: numpy.array(columns[self._elements.index(e)],
+                                     dtype=dtypes.column(e, self._dtype))
+
+    if element_names is None: element_names = self.elements()
+    self._check_elements(element_names)
+    return dict([(e, column(e)) for e in element_names])
+
+  def region(self, element_names=None, rows=None, columns=None):
+    '''Gets part of the map of a set of elements: the scan lines (i.e. files)
+    in the range 'rows', and of those, the samples in the range 'columns'.
+    Ranges are (start, stop) pairs, as for a slice; None means all of them.
+    Only the files in 'rows' are read, each of them once, and only the
+    samples in 'columns' are converted.  Times are offset as in 'table'; see
+    '_time_offset'.  Returns a dict like 'table', of flat arrays of the
+    region.'''
+    if element_names is None: element_names = self.elements()
+    self._check_elements(element_names)
+    r0, r1 = bounds(rows, self.y())
+    c0, c1 = bounds(columns, self.x())
+    data = dict([(e, []) for e in element_names])
+    cached = None
+    if self._cache is not None: cached = self._load_cache(self.files())
+    if cached is not None:
+      meta, parsed = cached
+      self._set_metadata(meta)
+      self._sources = [self._cache.data_file()]
+      for e in element_names:
+        lines = parsed[self._elements.index(e)].reshape((-1, self.x()))
+        data[e] = [lines[r0:r1, c0:c1].ravel()]
+    else:
+      offset = self._time_offset(r0)
+      self._sources = [e["path"] for e in self._entries()[r0:r1]]
+      for entry in self._entries()[r0:r1]:
+        ff = fin.FIN(entry["path"], self._dtype)
+        if "rows" in entry:
+          tbl = ff.table(element_names, (c0, c1))
+        else:
+          # Having read the file, we know everything its manifest entry holds.
+          summary, tbl = ff.scan(element_names, (c0, c1))
+          entry.update(summary)
+        self._check(entry)
+        if "Time" in element_names: tbl["Time"] += offset
+        offset += _end_time(entry)
+        for e in element_names: data[e].append(tbl[e])
+
+    for e in element_names:
+      empty = numpy.empty(0, dtypes.column(e, self._dtype))
+      data[e] = numpy.array(numpy.concatenate(data[e] or [empty]),
+                            dtype=dtypes.column(e, self._dtype))
+    return data
+
+  def time_spans(self, rows=None):
+    '''The first and last Time of each scan line in the range 'rows' (see
+    'region'), with the offsets applied as in 'table'.  Returns an array of
+    shape (lines, 2).  The files are not parsed; see 'manifest'.  Raises
+    UserWarning if any of the lines has no data.'''
+    r0, r1 = bounds(rows, self.y())
+    if self._cache is not None:
+      cached = self._load_cache(self.files())
+      if cached is not None:
+        meta, parsed = cached
+        self._set_metadata(meta)
+        times = parsed[self._elements.index("Time")].reshape((-1, self.x()))
+        return numpy.array(times[r0:r1][:,[0, -1]])
+    offset = self._time_offset(r0)
+    spans = []
+    for i in xrange(r0, r1):
+      entry = self._entry(i)
+      if entry["times"] is None:
+        raise UserWarning(entry["path"] + " has no data, so there is no "
+                          "telling where its scan line starts or stops.")
+      spans.append((entry["times"][0] + offset, entry["times"][1] + offset))
+      offset += _end_time(entry)
+    return numpy.array(spans).reshape((-1, 2))
+
+  def _time_offset(self, stop):
+    '''The Time offset of file 'stop': where the times of the files before it
+    ended, exactly as in 'table'.  This comes from their manifest entries;
+    of files which haven't been scanned or parsed, only the last line is
+    read (see fin.FIN.last_time), and kept in the entry as its "end".'''
+    offset = 0.0
+    for entry in self._entries()[:stop]:
+      if "times" not in entry and "end" not in entry:
+        entry["end"] = fin.FIN(entry["path"]).last_time()
+      offset += _end_time(entry)
+    return offset
+
+  def store_cache(self, tbl):
+    '''Stores 'tbl', a table of every element (e.g. assembled from 'rows'),
+    in the sidecar cache, so later reads needn't parse.  Does nothing if
+    caching is off or the cache is already up to date.'''
+    if self._cache is None: return
+    files = self.files()
+    if self._load_cache(files) is None:
+      self._cache.store(files, self._metadata(), tbl)
+
+  def _check_elements(self, element_names):
+    '''Raises IndexError if any of the given elements are not in our data.'''
+    for e in element_names:
+      if e not in self.elements():
+        raise IndexError(e + " does not exist in " + self._directory +
+                         ".  Try one of " + " ".join(self.elements()))
+
+  def _load_cache(self, files):
+    '''Loads the cache, unless it is stale.  A cache which was built without
+    validating the data is stale if we are validating now.'''
+    cached = self._cache.load(files)
+    if cached is not None and validate() and not cached[0].get("validated"):
+      return None
+    return cached
+
+  def _metadata(self):
+    '''The header information we store in the cache, alongside the data.'''
+    return {"elements": self.elements(), "date": self.date(),
+            "run_filename": self.run_filename(),
+            "scan_time": self.scanning_time_per_line(),
+            "points_per_file": self._data_points_per_line(),
+            "validated": validate()}
+
+  def _set_metadata(self, meta):
+    self._elements = meta["elements"]
+    self._date = meta["date"]
+    self._runfilename = meta["run_filename"]
+    self._scan_time = meta["scan_time"]
+    self._points_per_file = meta["points_per_file"]
+
+  def rows(self, element_names=None):
+    '''Reads the directory one FIN file -- i.e. one scan line -- at a time.
+    Yields, in order, a dict per file which maps each element name to an array
+    of that line's values.  "Time" has the offsets applied, as in 'table'.
+    Unlike 'table', only a few lines are ever held in memory.'''
+    if element_names is None: element_names = self.elements()
+    if self._cache is not None:
+      cached = self._load_cache(self.files())
+      if cached is not None:
+        meta, columns = cached
+        self._set_metadata(meta)
+        self._check_elements(element_names)
+        self._sources = [self._cache.data_file()]
+        indices = [self._elements.index(e) for e in element_names]
+        width = self._points_per_file
+        for start in xrange(0, columns.shape[1], width):
+          yield dict([(e, numpy.array(columns[i, start:start+width],
+                                      dtype=dtypes.column(e, self._dtype)))
+                      for e, i in zip(element_names, indices)])
+        return
+
+    self._sources = self.files()
+    for f, row, last_time in self._read(self.files(), element_names, 0.0):
+      yield row
+
+  def refresh(self, element_names=None):
+    '''Reads the FIN files which have appeared since the last call; this is
+    for following a run while the spectrometer is still writing it.  Only the
+    new files are parsed, and their times carry on from the last file we saw.
+    Returns a table (as from 'table') of just the new lines.  The first call
+    returns every line.  A file which can't be read yet (presumably because it
+    is still being written) is left for the next call; until then, it is not
+    in the manifest, so the other methods only see the files read so far.'''
+    if element_names is None: element_names = self.elements()
+    self._check_elements(element_names)
+    files = self._files()
+    if files[:len(self._seen)] != self._seen:
+      raise UserWarning("The FIN files in " + self._directory + " changed "
+                        "while following the run; please reopen it.")
+    self._update_manifest(files)
+    new = files[len(self._seen):]
+
+    lines = []
+    try:
+      for f, row, last_time in self._read(new, element_names, self._last_time):
+        lines.append(row)
+        self._seen.append(f)
+        self._last_time = last_time
+    except (IndexError, ValueError, UserWarning):
+      if len(self._seen) != len(files) - 1: raise
+      self._manifest = self._manifest[:len(self._seen)]
+
+    data = {}
+    for e in element_names:
+      empty = numpy.empty(0, dtypes.column(e, self._dtype))
+      data[e] = numpy.concatenate([l[e] for l in lines] or [empty])
+    return data
+
+  def mark_read(self, n_files, last_time):
+    '''Tells 'refresh' that the first 'n_files' files have been read already
+    (e.g. through 'rows'), and that their times ended at 'last_time'.  It will
+    only return the lines after them.'''
+    self._seen = self.files()[:n_files]
+    self._last_time = last_time
+
+  def _read(self, files, element_names, last_time):
+    '''Parses the given FIN files, whose Time offsets start at 'last_time'.
+    Yields, in order, the filename, the row dict (see 'rows') and the time
+    offset for the following file.'''
+    # We always need "Time", to compute the offset of the next file.
+    columns = list(element_names)
+    if "Time" not in columns: columns.append("Time")
+
+    jobs = [(f, columns, self._dtype) for f in files]
+    entries = dict([(e["path"], e) for e in self._entries()])
+    pool = None
+    if self._workers > 1 and len(files) > 1:
+      pool = multiprocessing.Pool(min(self._workers, len(files)))
+      parsed = pool.imap(_read_fin, jobs)
+    else:
+      parsed = itertools.imap(_read_fin, jobs)
+
+    try:
+      # Stitch the files together, in order.  The time offset of each file is
+      # the last time in the previous one.
+      for f, (elements, runfilename, date, tbl) in itertools.izip(files,
+                                                                  parsed):
+        # Having parsed the file, we know everything its manifest entry holds.
+        entry = entries.get(f, {"path": f})
+        times = tbl["Time"]
+        entry.update({"elements": elements, "run_filename": runfilename,
+                      "date": date, "rows": len(times),
+                      "times": (times[0], times[-1]) if len(times) else None})
+        self._check(entry)
+
+        tbl["Time"] += last_time
+        if len(times): last_time = tbl["Time"].max()
+        yield (f, dict([(e, tbl[e]) for e in element_names]), last_time)
+    finally:
+      if pool is not None:
+        # terminate, not close: the consumer might have stopped early.
+        pool.terminate()
+        pool.join()
+
+  def _parse(self, element_names):
+    '''Implements 'table' by parsing the FIN files.'''
+    if element_names is None: element_names = self.elements()
+    data = dict([(e, []) for e in element_names])
+    for row in self.rows(element_names):
+      for e in element_names: data[e].append(row[e])
+
+    for e in element_names:
+      if data[e]: data[e] = numpy.concatenate(data[e])
+      else: data[e] = numpy.empty(0, dtypes.column(e, self._dtype))
+    return data
+
+  # The header information comes from the cache, if it has been loaded, or
+  # else from the first file's manifest entry.
   def date(self):
     '''Returns the date in the first FIN file.'''
-    if self._date is None:
-      # User hasn't called 'element' yet; we need to parse it =(
-      ff = fin.FIN(self._files()[0])
-      self._date = ff.date()
+    if self._date is None: self._date = self._entry(0)["date"]
     assert(self._date is not None)
     return self._date
 
-  def time_per_scanline(self):
-    if self._scan_time is None:
-      self.element("Time") # could be anything, we just need to read data.
-    return self._scan_time
+  def time_per_scanline(self): return self.scanning_time_per_line()
 
   def elements(self):
     '''Returns the list of elements in this data set.'''
-    if self._elements is None:
-      ff = fin.FIN(self._files()[0])
-      self._elements = ff.elements()
+    if self._elements is None: self._elements = self._entry(0)["elements"]
     return self._elements
 
   def run_filename(self):
@@ -105,24 +445,21 @@ class FINDir:
     (i.e. all the associated files in a FINDir), all the run filenames should
     be the same.'''
     if self._runfilename is None:
-      ff = fin.FIN(self._files()[0])
-      self._runfilename = ff.run_filename()
+      self._runfilename = self._entry(0)["run_filename"]
     return self._runfilename
 
   def scanning_time_per_line(self):
     if self._scan_time is None:
-      ff = fin.FIN(self._files()[0])
-      self._scan_time = ff.time()
+      times = self._entry(0)["times"]
+      self._scan_time = times[1] - times[0]
     return self._scan_time
 
   def _data_points_per_line(self):
     if self._points_per_file is None:
-      ff = fin.FIN(self._files()[0])
-      # we know "Time" will always exist.
-      self._points_per_file = len(ff.element("Time"))
+      self._points_per_file = self._entry(0)["rows"]
     return self._points_per_file
 
-  def _n_files(self): return len(self._files())
+  def _n_files(self): return len(self._entries())
 
   def x(self): return self._data_points_per_line()
   def y(self): return self._n_files()
@@ -193,4 +530,249 @@ if __name__ == "__main__":
       self.assertEqual(self._fd.x(), 287)
       self.assertEqual(self._fd.y(), 77)
 
+  class TestFINDirTable(unittest.TestCase):
+    '''Tests which generate their own (tiny) directory of FIN files.'''
+    elems = ["Time", "Li7", "Zn66"]
+
+    def setUp(self):
+      import tempfile
+      self._dir = tempfile.mkdtemp()
+      for f in xrange(0, 3):
+        name = os.sep.join([self._dir, "ABC%03d.FIN2" % f])
+        with open(name, "w") as fin:
+          fin.write("Finnigan MAT ELEMENT Raw Data\n")
+          fin.write("Friday, October 15, 2010 21:49:14\n")
+          fin.write("101510lm2.FIN\n")
+          fin.write("4\n0\n16,16\nCPS\n")
+          fin.write(",".join(self.elems) + "\n")
+          for p in xrange(1, 5):
+            fin.write("%f,%f,%f\n" % (p * 0.5, f * 10.0 + p, f * -10.0 - p))
+      self._fd = FINDir(self._dir, "ABC*FIN2")
+
+    def tearDown(self):
+      import shutil
+      shutil.rmtree(self._dir)
+
+    def assertTablesEqual(self, a, b):
+      self.assertEqual(sorted(a.keys()), sorted(b.keys()))
+      for k in a.keys(): self.assertEqual(a[k].tolist(), b[k].tolist())
+
+    def test_table(self):
+      tbl = self._fd.table()
+      self.assertEqual(sorted(tbl.keys()), sorted(self.elems))
+      for e in self.elems: self.assertEqual(len(tbl[e]), 12)
+      self.assertEqual(tbl["Li7"][4:8].tolist(), [11.0, 12.0, 13.0, 14.0])
+
+    def test_table_matches_element(self):
+      tbl = self._fd.table(["Zn66", "Time"])
+      self.assertEqual(tbl["Zn66"].tolist(), self._fd.element("Zn66").tolist())
+      self.assertEqual(tbl["Time"].tolist(), self._fd.element("Time").tolist())
+
+    def test_table_time_increasing(self):
+      t = self._fd.table(["Li7"])
+      self.assertEqual(t.keys(), ["Li7"])
+      t = self._fd.table(["Time"])["Time"]
+      for i in xrange(1, len(t)): self.assertTrue(t[i-1] < t[i])
+
+    def test_table_invalid_element(self):
+      self.assertRaises(IndexError, self._fd.table, ["Li7", "ThisIsGarbage!"])
+
+    def test_workers(self):
+      parallel = FINDir(self._dir, "ABC*FIN2", workers=2)
+      self.assertTablesEqual(parallel.table(), self._fd.table())
+      self.assertEqual(parallel.scanning_time_per_line(),
+                       self._fd.scanning_time_per_line())
+
+    def test_rows(self):
+      rows = list(self._fd.rows(["Li7", "Time"]))
+      self.assertEqual(len(rows), 3)
+      self.assertEqual(rows[1]["Li7"].tolist(), [11.0, 12.0, 13.0, 14.0])
+      tbl = self._fd.table(["Li7", "Time"])
+      for e in ("Li7", "Time"):
+        self.assertEqual(numpy.concatenate([r[e] for r in rows]).tolist(),
+                         tbl[e].tolist())
+
+    def test_refresh(self):
+      import shutil
+      live = FINDir(self._dir, "ABC*FIN2")
+      last = os.sep.join([self._dir, "ABC002.FIN2"])
+      shutil.move(last, last + ".partial")
+      self.assertEqual(len(live.refresh()["Li7"]), 8)
+      self.assertEqual(len(live.refresh()["Li7"]), 0)
+      # a file which is still being written is left for later.
+      with open(last, "w") as f: f.write("Finnigan MAT ELEMENT Raw Data\n")
+      self.assertEqual(len(live.refresh()["Li7"]), 0)
+      partial = open(last + ".partial").read().split("\n")
+      with open(last, "w") as f: f.write("\n".join(partial[:10]) + "\n")
+      self.assertEqual(len(live.refresh()["Li7"]), 0)
+      self.assertEqual((live.y(), len(live.files())), (2, 2))
+      self.assertEqual(len(live.element("Li7")), 8)
+      shutil.move(last + ".partial", last)
+      new = live.refresh(["Li7", "Time"])
+      tbl = self._fd.table(["Li7", "Time"])
+      self.assertEqual(new["Li7"].tolist(), tbl["Li7"][8:].tolist())
+      self.assertEqual(new["Time"].tolist(), tbl["Time"][8:].tolist())
+
+    def test_mark_read(self):
+      live = FINDir(self._dir, "ABC*FIN2")
+      rows = list(live.rows(["Time"]))[:2]
+      live.mark_read(2, rows[-1]["Time"].max())
+      new = live.refresh(["Time"])
+      self.assertEqual(new["Time"].tolist(),
+                       self._fd.table(["Time"])["Time"][8:].tolist())
+
+    def test_cache(self):
+      cached = FINDir(self._dir, "ABC*FIN2", cache=True)
+      tbl = cached.table()
+      self.assertTablesEqual(tbl, self._fd.table())
+      self.assertEqual(cached.sources(), cached.files())
+      # second time around, it should come from the cache.
+      reopened = FINDir(self._dir, "ABC*FIN2", cache=True)
+      reopened._parse = None
+      self.assertTablesEqual(reopened.table(["Li7"]), {"Li7": tbl["Li7"]})
+      self.assertEqual(reopened.sources(), [reopened._cache.data_file()])
+      self.assertEqual(reopened.x(), 4)
+      self.assertEqual(reopened.run_filename(), "101510lm2.FIN")
+      self.assertRaises(IndexError, reopened.table, ["ThisIsGarbage!"])
+      rows = list(reopened.rows(["Li7"]))
+      self.assertEqual(len(rows), 3)
+      self.assertEqual(numpy.concatenate([r["Li7"] for r in rows]).tolist(),
+                       tbl["Li7"].tolist())
+
+    def test_store_cache(self):
+      fd = FINDir(self._dir, "ABC*FIN2", cache=True)
+      tbl = {}
+      for row in fd.rows():
+        for e in row.keys(): tbl.setdefault(e, []).append(row[e])
+      fd.store_cache(dict([(e, numpy.concatenate(tbl[e])) for e in tbl]))
+      cached = FINDir(self._dir, "ABC*FIN2", cache=True)
+      self.assertNotEqual(cached._load_cache(cached.files()), None)
+      self.assertTablesEqual(cached.table(), self._fd.table())
+
+    def test_cache_stale(self):
+      FINDir(self._dir, "ABC*FIN2", cache=True).table()
+      with open(os.sep.join([self._dir, "ABC000.FIN2"]), "a") as fin:
+        fin.write("2.5,1.0,2.0\n")
+      fd = FINDir(self._dir, "ABC*FIN2", cache=True)
+      os.environ["BUB_NO_VALIDATE"] = "1"
+      try:
+        self.assertEqual(len(fd.element("Li7")), 13)
+      finally:
+        del os.environ["BUB_NO_VALIDATE"]
+
+    def test_float32(self):
+      fd = FINDir(self._dir, "ABC*FIN2", dtype=numpy.float32)
+      tbl = fd.table(["Li7", "Time"])
+      self.assertEqual(tbl["Li7"].dtype, numpy.float32)
+      self.assertEqual(tbl["Time"].dtype, numpy.float64)
+      self.assertEqual(tbl["Li7"].tolist(), self._fd.element("Li7").tolist())
+      FINDir(self._dir, "ABC*FIN2", cache=True).table()
+      cached = FINDir(self._dir, "ABC*FIN2", cache=True, dtype=numpy.float32)
+      self.assertEqual(cached.element("Zn66").dtype, numpy.float32)
+      self.assertEqual(list(cached.rows(["Li7"]))[0]["Li7"].dtype,
+                       numpy.float32)
+
+    def test_region(self):
+      tbl = self._fd.table(["Li7", "Time"])
+      for fd in (self._fd, FINDir(self._dir, "ABC*FIN2")):
+        part = fd.region(["Li7", "Time"], (1, 3), (1, 3))
+        self.assertEqual(part["Li7"].tolist(), [12.0, 13.0, 22.0, 23.0])
+        self.assertEqual(part["Time"].tolist(),
+                         tbl["Time"].reshape((3,4))[1:3,1:3].ravel().tolist())
+      self.assertEqual(self._fd.region(["Zn66"], (2, None))["Zn66"].tolist(),
+                       self._fd.element("Zn66")[8:].tolist())
+      self.assertEqual(len(self._fd.region(["Li7"], (3, 9))["Li7"]), 0)
+      spans = self._fd.time_spans((1, 3))
+      self.assertEqual(spans.tolist(),
+                       tbl["Time"].reshape((3,4))[1:3][:,[0,3]].tolist())
+      # only the files in the region are read.
+      os.remove(os.sep.join([self._dir, "ABC002.FIN2"]))
+      part = FINDir(self._dir, "ABC*FIN2").region(["Li7"], (0, 1))
+      self.assertEqual(part["Li7"].tolist(), [1.0, 2.0, 3.0, 4.0])
+
+    def test_region_reads(self):
+      original = fin.FIN._data
+      reads = []
+      def counting(ff):
+        reads.append(os.path.basename(ff._finfile))
+        return original(ff)
+      fin.FIN._data = counting
+      try:
+        fd = FINDir(self._dir, "ABC*FIN2")
+        part = fd.region(["Time"], (2, 3))
+        self.assertEqual(reads, ["ABC000.FIN2", "ABC002.FIN2"])
+        self.assertEqual(fd.sources(), fd.files()[2:3])
+        self.assertEqual(part["Time"].tolist(),
+                         self._fd.table(["Time"])["Time"][8:].tolist())
+      finally:
+        fin.FIN._data = original
+
+    def test_region_time_origins(self):
+      # Every line takes the same time, but they don't all start at the same
+      # time.
+      name = os.sep.join([self._dir, "ABC001.FIN2"])
+      lines = open(name).readlines()
+      with open(name, "w") as f:
+        f.writelines(lines[:8])
+        for line in lines[8:]:
+          values = line.split(",")
+          f.write(",".join(["%f" % (float(values[0]) + 0.25)] + values[1:]))
+      original = fin.FIN._data
+      reads = []
+      def counting(ff):
+        reads.append(os.path.basename(ff._finfile))
+        return original(ff)
+      fin.FIN._data = counting
+      try:
+        fd = FINDir(self._dir, "ABC*FIN2")
+        part = fd.region(["Time"], (2, 3))
+        spans = fd.time_spans((2, 3))
+        # ABC001 is not parsed; just its last line is read.
+        self.assertEqual(reads, ["ABC000.FIN2", "ABC002.FIN2"])
+      finally:
+        fin.FIN._data = original
+      times = FINDir(self._dir, "ABC*FIN2").table(["Time"])["Time"]
+      self.assertEqual(part["Time"].tolist(), times[8:].tolist())
+      self.assertEqual(spans.tolist(), [[times[8], times[11]]])
+
+    def test_region_empty_line(self):
+      # Just the header of a file: no data.
+      header = open(os.sep.join([self._dir, "ABC000.FIN2"])).readlines()[:8]
+      with open(os.sep.join([self._dir, "ABC003.FIN2"]), "w") as f:
+        f.writelines(header)
+      fd = FINDir(self._dir, "ABC*FIN2")
+      self.assertEqual(len(fd.time_spans((0, 3))), 3)
+      self.assertRaises(UserWarning, fd.time_spans, (2, 4))
+
+    def test_region_cached(self):
+      tbl = FINDir(self._dir, "ABC*FIN2", cache=True).table()
+      cached = FINDir(self._dir, "ABC*FIN2", cache=True, dtype=numpy.float32)
+      part = cached.region(["Li7", "Time"], (1, 3), (1, 3))
+      self.assertEqual(cached.sources(), [cached._cache.data_file()])
+      self.assertEqual(part["Li7"].dtype, numpy.float32)
+      self.assertEqual(part["Li7"].tolist(), [12.0, 13.0, 22.0, 23.0])
+      self.assertEqual(part["Time"].tolist(),
+                       tbl["Time"].reshape((3,4))[1:3,1:3].ravel().tolist())
+      self.assertEqual(cached.time_spans().tolist(),
+                       self._fd.time_spans().tolist())
+
+    def test_manifest(self):
+      manifest = self._fd.manifest()
+      self.assertEqual([os.path.basename(e["path"]) for e in manifest],
+                       ["ABC000.FIN2", "ABC001.FIN2", "ABC002.FIN2"])
+      self.assertEqual([e["rows"] for e in manifest], [4, 4, 4])
+      self.assertEqual(manifest[1]["times"], (0.5, 2.0))
+      self.assertEqual(manifest[2]["elements"], self.elems)
+      # the accessors answer from the manifest, without listing or reading.
+      self._fd._files = None
+      self._fd._update_manifest = None
+      self.assertEqual((self._fd.x(), self._fd.y()), (4, 3))
+      self.assertEqual(self._fd.scanning_time_per_line(), 1.5)
+
+    def test_manifest_invalid(self):
+      with open(os.sep.join([self._dir, "ABC001.FIN2"]), "a") as fin:
+        fin.write("2.5,1.0,2.0\n")
+      self.assertRaises(UserWarning, FINDir(self._dir, "ABC*FIN2").manifest)
+      self.assertRaises(UserWarning, FINDir(self._dir, "ABC*FIN2").table)
+
   unittest.main()
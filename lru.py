@@ -0,0 +1,134 @@
+#!python
+# A least-recently-used cache, bounded by the memory its values use rather
+# than by the number of entries.
+import collections
+import sys
+
+def nbytes(value):
+  '''Estimates the memory used by 'value'.  numpy arrays (and anything else
+  with an 'nbytes' attribute) know exactly; for lists and tuples we add up
+  their contents.'''
+  if hasattr(value, "nbytes"): return value.nbytes
+  if isinstance(value, (list, tuple)):
+    return sys.getsizeof(value) + sum([nbytes(v) for v in value])
+  return sys.getsizeof(value)
+
+class LRUCache:
+  def __init__(self, max_bytes, size=nbytes):
+    '''A cache which holds at most 'max_bytes' worth of values.  'size' is
+    the function used to measure a value.'''
+    self._max_bytes = max_bytes
+    self._size = size
+    self._entries = collections.OrderedDict() # key -> (value, size)
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    '''Looks up 'key', marking it as recently used.  Returns 'default' if it
+    isn't in the cache.'''
+    if key not in self._entries:
+      self.misses += 1
+      return default
+    self.hits += 1
+    entry = self._entries.pop(key)
+    self._entries[key] = entry
+    return entry[0]
+
+  def put(self, key, value):
+    '''Adds (or replaces) an entry, evicting the least recently used entries
+    until everything fits.  A value bigger than the whole cache is not
+    stored at all.'''
+    self.discard(key)
+    size = self._size(value)
+    if size > self._max_bytes: return
+    self._entries[key] = (value, size)
+    self._bytes += size
+    self._evict()
+
+  def discard(self, key):
+    if key in self._entries:
+      self._bytes -= self._entries.pop(key)[1]
+
+  def clear(self):
+    self._entries.clear()
+    self._bytes = 0
+
+  def set_max_bytes(self, max_bytes):
+    self._max_bytes = max_bytes
+    self._evict()
+
+  def max_bytes(self): return self._max_bytes
+  def nbytes(self): return self._bytes
+
+  def _evict(self):
+    while self._bytes > self._max_bytes:
+      key, (value, size) = self._entries.popitem(last=False)
+      self._bytes -= size
+
+  def __contains__(self, key): return key in self._entries
+  def __len__(self): return len(self._entries)
+
+if __name__ == "__main__":
+  import unittest
+  import numpy
+
+  class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+      # sizes are given by the values themselves.
+      self._cache = LRUCache(10, size=lambda v: v)
+
+    def test_eviction_order(self):
+      self._cache.put("a", 4)
+      self._cache.put("b", 4)
+      self._cache.get("a") # b is now the least recently used.
+      self._cache.put("c", 4)
+      self.assertTrue("a" in self._cache)
+      self.assertFalse("b" in self._cache)
+      self.assertTrue("c" in self._cache)
+      self.assertEqual(self._cache.nbytes(), 8)
+
+    def test_too_big(self):
+      self._cache.put("a", 4)
+      self._cache.put("big", 11)
+      self.assertFalse("big" in self._cache)
+      # nothing was evicted to make room for it, either.
+      self.assertTrue("a" in self._cache)
+      self.assertEqual(self._cache.nbytes(), 4)
+
+    def test_accounting(self):
+      self._cache.put("a", 3)
+      self._cache.put("a", 5) # replaces, rather than adds to, the old size.
+      self.assertEqual(self._cache.nbytes(), 5)
+      self.assertEqual(len(self._cache), 1)
+      self._cache.discard("a")
+      self._cache.discard("missing")
+      self.assertEqual(self._cache.nbytes(), 0)
+      self.assertEqual(len(self._cache), 0)
+
+    def test_set_max_bytes(self):
+      for k in ("a", "b", "c"): self._cache.put(k, 3)
+      self._cache.set_max_bytes(6)
+      self.assertEqual(self._cache.max_bytes(), 6)
+      self.assertFalse("a" in self._cache)
+      self.assertEqual(self._cache.nbytes(), 6)
+      self._cache.set_max_bytes(2)
+      self.assertEqual(len(self._cache), 0)
+      self.assertEqual(self._cache.nbytes(), 0)
+
+    def test_counters(self):
+      self._cache.put("a", 1)
+      self.assertEqual(self._cache.get("a"), 1)
+      self.assertEqual(self._cache.get("b", "none"), "none")
+      self.assertEqual(self._cache.get("b"), None)
+      self.assertEqual((self._cache.hits, self._cache.misses), (1, 2))
+
+    def test_nbytes(self):
+      data = numpy.zeros(16)
+      self.assertEqual(nbytes(data), 128)
+      self.assertTrue(nbytes([data, data]) > 256)
+      cache = LRUCache(200)
+      cache.put("x", data)
+      self.assertEqual(cache.nbytes(), 128)
+
+  unittest.main()
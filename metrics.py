@@ -0,0 +1,214 @@
+#!python
+# Records where the time and memory go while processing a run.
+#
+# Work is divided into stages (parsing, filtering an element, writing an
+# image, ...).  For each stage we note the wall and CPU time it took, the
+# peak memory use of the process during it, and whatever counters the stage
+# bumped (files read, bytes written, ...).  The peak is only available on
+# Linux, where it can be reset as each stage starts; elsewhere we note how
+# much the process's lifetime peak grew during the stage instead.  The whole lot can be written
+# out as JSON.  A disabled Profile (see NULL) records nothing, so code can
+# always be instrumented.
+from __future__ import with_statement
+import contextlib
+import json
+import os
+import resource
+import time
+
+def _cpu():
+  '''CPU time used so far, in seconds: ours, and that of any child processes
+  which have finished.'''
+  t = os.times()
+  return t[0] + t[1] + t[2] + t[3]
+
+def _peak_rss(who=resource.RUSAGE_SELF):
+  '''The most memory the process (or, with RUSAGE_CHILDREN, the largest of its
+  finished children) has used, in kilobytes.'''
+  return resource.getrusage(who).ru_maxrss
+
+def _hwm():
+  '''The most resident memory the process has used since it was last reset
+  (see '_reset_hwm'), in kilobytes; None if we can't tell (i.e. not Linux).'''
+  try:
+    with open("/proc/self/status", "r") as f:
+      for line in f:
+        if line.startswith("VmHWM:"): return int(line.split()[1])
+  except (IOError, OSError, ValueError):
+    pass
+  return None
+
+def _reset_hwm():
+  '''Resets the peak resident memory to what is in use now.  Returns False
+  if that isn't possible here.'''
+  try:
+    with open("/proc/self/clear_refs", "w") as f: f.write("5")
+  except (IOError, OSError):
+    return False
+  return True
+
+class Profile:
+  def __init__(self, enabled=True):
+    self._enabled = enabled
+    self._stages = [] # finished stages, in the order they finished
+    self._open = [] # stages in progress, innermost last
+    self._totals = {} # counter -> total over all stages
+    self._notes = {} # anything else worth reporting, e.g. what was run
+    self._wall = time.time()
+    self._cpu = _cpu()
+    # Resetting the peak (see _peaks) hides it from getrusage, so we keep the
+    # whole run's peak ourselves.
+    self._peak = 0
+    self._per_stage = enabled and _hwm() is not None and _reset_hwm()
+
+  def enabled(self): return self._enabled
+
+  @contextlib.contextmanager
+  def stage(self, name, element=None):
+    '''Times the enclosed block as the stage 'name', for the given element (or
+    for all of them, if None).'''
+    if not self._enabled:
+      yield None
+      return
+    record = {"stage": name, "element": element, "counters": {}}
+    wall, cpu = time.time(), _cpu()
+    if self._per_stage:
+      self._peaks()
+      _reset_hwm()
+    rss = _peak_rss()
+    self._open.append(record)
+    if self._per_stage: self._peaks()
+    try:
+      yield record
+    finally:
+      if self._per_stage: self._peaks()
+      else: record["peak_rss_growth_kb"] = _peak_rss() - rss
+      self._open.remove(record)
+      record["wall"] = time.time() - wall
+      record["cpu"] = _cpu() - cpu
+      self._stages.append(record)
+
+  def _peaks(self):
+    '''Folds the peak memory use since the last reset into the figures of
+    the stages in progress (so that an enclosing stage's peak includes those
+    of the stages within it), and into the whole run's.'''
+    hwm = _hwm() or 0
+    self._peak = max(self._peak, hwm)
+    for record in self._open:
+      record["peak_rss_kb"] = max(record.get("peak_rss_kb", 0), hwm)
+
+  def count(self, counter, n):
+    '''Adds 'n' to the given counter, for the innermost stage in progress.'''
+    if not self._enabled: return
+    if self._open:
+      counters = self._open[-1]["counters"]
+      counters[counter] = counters.get(counter, 0) + n
+    self._totals[counter] = self._totals.get(counter, 0) + n
+
+  def note(self, key, value):
+    '''Adds 'key' to the report; 'value' must be representable in JSON.'''
+    if self._enabled: self._notes[key] = value
+
+  def stages(self): return self._stages
+
+  def merge(self, stages):
+    '''Adds stages recorded elsewhere, e.g. by a worker process.'''
+    if not self._enabled: return
+    for record in stages:
+      self._stages.append(record)
+      for counter, n in record["counters"].items():
+        self._totals[counter] = self._totals.get(counter, 0) + n
+
+  def report(self):
+    '''Everything we recorded, as a dict.  Each stage has its own peak
+    memory use, "peak_rss_kb", where we can tell (see above); otherwise it has
+    "peak_rss_growth_kb", the growth of the whole process's peak during it.'''
+    if self._per_stage: self._peaks()
+    report = dict(self._notes)
+    report.update({"wall": time.time() - self._wall,
+                   "cpu": _cpu() - self._cpu,
+                   "peak_rss_kb": max(self._peak, _peak_rss()),
+                   "peak_rss_children_kb": _peak_rss(resource.RUSAGE_CHILDREN),
+                   "totals": self._totals, "stages": self._stages})
+    return report
+
+  def write(self, filename):
+    with open(filename, "w") as f:
+      json.dump(self.report(), f, indent=2, sort_keys=True)
+
+# Records nothing; the default for code which may be profiled.
+NULL = Profile(enabled=False)
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestProfile(unittest.TestCase):
+    def test_stages(self):
+      prof = Profile()
+      with prof.stage("parse"):
+        prof.count("files_read", 2)
+        with prof.stage("filter", "Li7"):
+          prof.count("pixels", 10)
+        prof.count("files_read", 1)
+      stages = prof.stages()
+      self.assertEqual([(s["stage"], s["element"]) for s in stages],
+                       [("filter", "Li7"), ("parse", None)])
+      self.assertEqual(stages[0]["counters"], {"pixels": 10})
+      self.assertEqual(stages[1]["counters"], {"files_read": 3})
+      report = prof.report()
+      self.assertEqual(report["totals"], {"files_read": 3, "pixels": 10})
+      prof.note("findir", "/data/run1")
+      self.assertEqual(prof.report()["findir"], "/data/run1")
+      self.assertTrue(report["peak_rss_kb"] > 0)
+      self.assertTrue(stages[1]["wall"] >= stages[0]["wall"])
+
+    def _stages(self, prof):
+      with prof.stage("big"):
+        data = "x" * (64 * 1024 * 1024)
+        with prof.stage("inner"): pass
+        del data
+      with prof.stage("small"): pass
+      return prof.stages()
+
+    def test_peak_rss(self):
+      prof = Profile()
+      if not prof._per_stage: return # not on Linux
+      inner, big, small = self._stages(prof)
+      # a later stage doesn't inherit an earlier one's peak, but an enclosing
+      # stage does include the peaks within it.
+      self.assertTrue(small["peak_rss_kb"] < big["peak_rss_kb"] - 32*1024)
+      self.assertTrue(inner["peak_rss_kb"] <= big["peak_rss_kb"])
+      self.assertTrue(prof.report()["peak_rss_kb"] >= big["peak_rss_kb"])
+
+    def test_peak_rss_growth(self):
+      prof = Profile()
+      prof._per_stage = False
+      inner, big, small = self._stages(prof)
+      self.assertTrue("peak_rss_kb" not in big)
+      self.assertTrue(big["peak_rss_growth_kb"] >= inner["peak_rss_growth_kb"])
+      self.assertEqual(small["peak_rss_growth_kb"], 0)
+
+    def test_exception(self):
+      prof = Profile()
+      def fail():
+        with prof.stage("broken"): raise ValueError("oops")
+      self.assertRaises(ValueError, fail)
+      self.assertEqual(prof.stages()[0]["stage"], "broken")
+
+    def test_merge(self):
+      worker = Profile()
+      with worker.stage("write_image", "Zn66"): worker.count("bytes", 5)
+      prof = Profile()
+      prof.merge(worker.stages())
+      self.assertEqual(prof.report()["totals"], {"bytes": 5})
+
+    def test_disabled(self):
+      with NULL.stage("parse") as record:
+        NULL.count("files_read", 1)
+        NULL.note("findir", "/data/run1")
+      self.assertEqual(record, None)
+      self.assertEqual(NULL.stages(), [])
+      self.assertEqual(NULL.report()["totals"], {})
+      self.assertTrue("findir" not in NULL.report())
+
+  unittest.main()
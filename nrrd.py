@@ -0,0 +1,306 @@
+#!python
+# Detached NRRD files: a text header (.nhdr) describing a separate data file.
+#
+# A Writer takes data a scan line at a time, so a map never has to be held in
+# memory to be written out; the header, which needs the size and range of the
+# data, is written when the writer is closed.  One writer can hold several
+# channels (elements), interleaved per sample, as a single 3D volume: channel
+# is the fastest axis, then x, then y.
+from __future__ import with_statement
+import glob
+import gzip
+import os
+import sys
+
+import numpy
+
+import dtypes
+
+# NRRD type names, and the numpy types they map to.
+TYPES = {"double": numpy.float64, "float": numpy.float32}
+ENCODINGS = ("raw", "gzip")
+
+class Writer:
+  def __init__(self, filename, channels, width, nrrd_type="double",
+               encoding="raw", spacings=(1.0, 2.6)):
+    '''Writes a detached NRRD: a header 'filename'.nhdr, and the data in
+    'filename' (raw) or 'filename'.gz (gzip).  'channels' names the channels
+    of the data; 'width' is the number of samples per scan line.  'spacings'
+    are the distances between samples and between lines.'''
+    if nrrd_type not in TYPES:
+      raise ValueError("Unknown NRRD type: " + nrrd_type)
+    if encoding not in ENCODINGS:
+      raise ValueError("Unknown NRRD encoding: " + encoding)
+    self._filename = filename
+    self._channels = list(channels)
+    self._width = width
+    self._type = nrrd_type
+    self._encoding = encoding
+    self._spacings = spacings
+    self._lines = 0
+    self._min = None
+    self._max = None
+    self._datafile = filename
+    if encoding == "gzip":
+      self._datafile = filename + ".gz"
+      self._data = gzip.GzipFile(self._datafile, "wb")
+    else:
+      self._data = open(self._datafile, "wb")
+
+  def write(self, lines):
+    '''Appends one or more scan lines.  'lines' has one row of values per
+    channel: an array of shape (channels, n*width).'''
+    lines = dtypes.floats(lines)
+    lines = lines.reshape((len(self._channels), -1, self._width))
+    if lines.shape[1] == 0: return
+    lo = lines.min(axis=2).min(axis=1)
+    hi = lines.max(axis=2).max(axis=1)
+    if self._min is None: self._min, self._max = lo, hi
+    self._min = numpy.minimum(self._min, lo)
+    self._max = numpy.maximum(self._max, hi)
+    # (channels, lines, width) -> (lines, width, channels)
+    samples = lines.transpose((1, 2, 0)).astype(TYPES[self._type], copy=False)
+    if self._encoding == "raw": samples.tofile(self._data)
+    else: self._data.write(samples.tostring())
+    self._lines += lines.shape[1]
+
+  def close(self):
+    '''Finishes the data file, and writes the header.'''
+    self._data.close()
+    with open(self._filename + ".nhdr", "w") as nhdr:
+      nhdr.write(self.header())
+
+  def set_spacings(self, spacings):
+    '''Changes the spacings; they are only written when the writer closes.'''
+    self._spacings = spacings
+
+  def dimensions(self): return (self._width, self._lines)
+  def files(self): return [self._datafile, self._filename + ".nhdr"]
+
+  def minmax(self, channel=None):
+    '''The range of the data written so far: of the given channel (an index),
+    or of all of them.'''
+    if self._min is None: return (0.0, 0.0)
+    if channel is None: return (self._min.min(), self._max.max())
+    return (self._min[channel], self._max[channel])
+
+  def header(self):
+    minmax = self.minmax()
+    spacings = " ".join([repr(float(s)) for s in self._spacings])
+    # "kinds" and key/value pairs (see the multichannel fields below) need
+    # a later version of the format than the plain fields of a single channel.
+    if len(self._channels) == 1: h = ["NRRD0001"]
+    else: h = ["NRRD0004"]
+    if len(self._channels) == 1:
+      h.append("dimension: 2")
+    else:
+      h.append("dimension: 3")
+    h.append("type: %s" % self._type)
+    h.append("encoding: %s" % self._encoding)
+    h.append("endian: %s" % sys.byteorder)
+    if len(self._channels) == 1:
+      h.append("content: %s" % self._channels[0])
+    else:
+      h.append("content: %s" % os.path.basename(self._filename))
+    h.append("min: %f" % minmax[0])
+    h.append("max: %f" % minmax[1])
+    h.append("datafile: %s" % os.path.basename(self._datafile))
+    if len(self._channels) == 1:
+      h.append("sizes: %d %d" % self.dimensions())
+      h.append("spacings: %s" % spacings)
+    else:
+      sizes = (len(self._channels),) + self.dimensions()
+      h.append("sizes: %d %d %d" % sizes)
+      h.append("spacings: nan %s" % spacings)
+      h.append("kinds: list domain domain")
+      h.append("channels:=%s" % " ".join(self._channels))
+      h.append("channel mins:=%s" % " ".join(["%f" % m for m in self._min]))
+      h.append("channel maxs:=%s" % " ".join(["%f" % m for m in self._max]))
+    return "\n".join(h) + "\n"
+
+def write(filename, channels, data, dims, nrrd_type="double", encoding="raw",
+          spacings=(1.0, 2.6)):
+  '''Writes whole maps out as a detached NRRD.  'data' holds a map per
+  channel, i.e. it is of shape (channels, width*height).'''
+  writer = Writer(filename, channels, dims[0], nrrd_type, encoding, spacings)
+  writer.write(numpy.asarray(data).reshape((len(channels), -1)))
+  writer.close()
+  return writer
+
+def read_header(filename):
+  '''Reads the header of a detached NRRD.  Returns a dict of its fields and
+  key/value pairs, as strings.'''
+  header = {}
+  with open(filename, "r") as nhdr:
+    if not nhdr.readline().startswith("NRRD"):
+      raise ValueError(filename + " is not a NRRD header.")
+    for line in nhdr:
+      line = line.rstrip("\n")
+      if line == "": break
+      if line.startswith("#"): continue
+      if ":=" in line: key, value = line.split(":=", 1)
+      elif ": " in line: key, value = line.split(": ", 1)
+      else: raise ValueError("Bad line in " + filename + ": " + line)
+      header[key] = value
+  return header
+
+def read(filename):
+  '''Reads a detached NRRD written by a Writer.  Returns the header (see
+  'read_header') and the data, of shape (height, width) for a single channel
+  or (height, width, channels).  Raw data are memory-mapped.'''
+  header = read_header(filename)
+  dtype = numpy.dtype(TYPES[header["type"]])
+  if header.get("endian", sys.byteorder) != sys.byteorder:
+    dtype = dtype.newbyteorder()
+  shape = tuple(reversed([int(s) for s in header["sizes"].split()]))
+  datafile = os.path.join(os.path.dirname(filename), header["datafile"])
+  if header["encoding"] == "raw":
+    data = numpy.memmap(datafile, dtype=dtype, mode="r")
+  elif header["encoding"] == "gzip":
+    with open(datafile, "rb") as f:
+      data = numpy.frombuffer(gzip.GzipFile(fileobj=f).read(), dtype=dtype)
+  else:
+    raise ValueError("Unsupported NRRD encoding: " + header["encoding"])
+  return header, data.reshape(shape)
+
+def channels(header):
+  '''The names of the channels described by a header.'''
+  if header.get("dimension") == "3": return header["channels"].split()
+  return [header["content"]]
+
+class Results:
+  def __init__(self, directory):
+    '''The results of an export: the detached NRRDs in 'directory', as
+    written by cli-bub.  Only the headers are read up front; the data of an
+    element are memory-mapped when they are asked for (compressed data have to
+    be read in full).  If an element is in more than one file, the first file
+    (by name) wins.'''
+    self._directory = directory
+    self._files = sorted(glob.glob(os.path.join(directory, "*.nhdr")))
+    if len(self._files) == 0:
+      raise UserWarning("No .nhdr files in " + directory)
+    self._elements = [] # (name, header file, channel index)
+    self._data = {} # header file -> its data, once read
+    self._dims = None
+    for f in self._files:
+      header = read_header(f)
+      sizes = tuple([int(s) for s in header["sizes"].split()[-2:]])
+      if self._dims is None: self._dims = sizes
+      if sizes != self._dims:
+        raise UserWarning("%s is %dx%d, but %s is %dx%d." %
+                          ((f,) + sizes + (self._files[0],) + self._dims))
+      names = [e[0] for e in self._elements]
+      for i, name in enumerate(channels(header)):
+        if name not in names: self._elements.append((name, f, i))
+
+  def files(self): return self._files
+  def elements(self): return [e[0] for e in self._elements]
+
+  def element(self, element_name):
+    '''The data of the given element, as a flat array.'''
+    for name, f, i in self._elements:
+      if name == element_name: break
+    else:
+      raise IndexError(element_name + " does not exist in " + self._directory
+                       + ".  Try one of " + " ".join(self.elements()))
+    if f not in self._data: self._data[f] = read(f)[1]
+    data = self._data[f]
+    if data.ndim == 3: data = data[...,i]
+    return data.ravel()
+
+  def table(self, element_names=None):
+    '''A dict mapping element name to data, for the given elements (or all of
+    them).'''
+    if element_names is None: element_names = self.elements()
+    return dict([(e, self.element(e)) for e in element_names])
+
+  def region(self, element_names=None, rows=None, columns=None):
+    '''Part of the map of the given elements, as for FINDir.region: the rows
+    and columns in the given (start, stop) ranges, or all of them if None.
+    Only the region is copied out of a single-channel file's memory-mapped
+    data.'''
+    if element_names is None: element_names = self.elements()
+    window = (slice(*(rows or (None, None))), slice(*(columns or (None, None))))
+    return dict([(e, numpy.array(self.element(e).reshape(self._dims[::-1])
+                                 [window]).ravel()) for e in element_names])
+
+  def x(self): return self._dims[0]
+  def y(self): return self._dims[1]
+
+if __name__ == "__main__":
+  import shutil
+  import tempfile
+  import unittest
+
+  class TestNrrd(unittest.TestCase):
+    def setUp(self):
+      self._dir = tempfile.mkdtemp()
+      self._name = os.path.join(self._dir, "vol")
+
+    def tearDown(self):
+      shutil.rmtree(self._dir)
+
+    def test_single(self):
+      data = numpy.arange(12.0)
+      write(self._name, ["Li7"], data, (4,3))
+      self.assertEqual(open(self._name, "rb").read(), data.tostring())
+      self.assertEqual(open(self._name + ".nhdr").readline(), "NRRD0001\n")
+      header, back = read(self._name + ".nhdr")
+      self.assertEqual(header["content"], "Li7")
+      self.assertEqual(header["sizes"], "4 3")
+      self.assertEqual(header["spacings"], "1.0 2.6")
+      self.assertEqual((header["min"], header["max"]),
+                       ("0.000000", "11.000000"))
+      self.assertEqual(back.tolist(), data.reshape((3,4)).tolist())
+
+    def test_multichannel(self):
+      li = numpy.arange(12.0)
+      zn = -numpy.arange(12.0) - 1.0
+      writer = Writer(self._name, ["Li7", "Zn66"], 4)
+      for y in xrange(0, 3):
+        writer.write([li[y*4:(y+1)*4], zn[y*4:(y+1)*4]])
+      writer.set_spacings((12.5, 50.0))
+      writer.close()
+      self.assertEqual(writer.minmax(1), (-12.0, -1.0))
+      self.assertEqual(open(self._name + ".nhdr").readline(), "NRRD0004\n")
+      header, back = read(self._name + ".nhdr")
+      self.assertEqual(header["sizes"], "2 4 3")
+      self.assertEqual(header["spacings"], "nan 12.5 50.0")
+      self.assertEqual(header["channels"], "Li7 Zn66")
+      self.assertEqual(header["channel maxs"], "11.000000 -1.000000")
+      self.assertEqual(back.shape, (3, 4, 2))
+      self.assertEqual(back[...,0].ravel().tolist(), li.tolist())
+      self.assertEqual(back[...,1].ravel().tolist(), zn.tolist())
+
+    def test_float_gzip(self):
+      data = numpy.array([numpy.linspace(0.0, 1.0, 20), numpy.ones(20)])
+      write(self._name, ["a", "b"], data, (5,4), "float", "gzip")
+      self.assertTrue(os.path.exists(self._name + ".gz"))
+      header, back = read(self._name + ".nhdr")
+      self.assertEqual((header["type"], header["encoding"]), ("float", "gzip"))
+      self.assertEqual(back.dtype, numpy.float32)
+      self.assertEqual(back[...,0].ravel().tolist(),
+                       data[0].astype(numpy.float32).tolist())
+
+    def test_results(self):
+      li = numpy.arange(12.0)
+      write(os.path.join(self._dir, "Li7"), ["Li7"], li, (4,3))
+      write(self._name, ["Li7", "Zn66"], [li * 2.0, li * 3.0], (4,3), "float")
+      results = Results(self._dir)
+      self.assertEqual(results.elements(), ["Li7", "Zn66"])
+      self.assertEqual((results.x(), results.y()), (4, 3))
+      self.assertTrue(isinstance(results.element("Li7"), numpy.memmap))
+      self.assertEqual(results.element("Li7").tolist(), li.tolist())
+      self.assertEqual(results.table()["Zn66"].tolist(), (li * 3.0).tolist())
+      self.assertRaises(IndexError, results.element, "Cu63")
+      part = results.region(["Zn66"], (1, 3), (2, None))
+      self.assertEqual(part["Zn66"].tolist(), [18.0, 21.0, 30.0, 33.0])
+      write(os.path.join(self._dir, "Cu63"), ["Cu63"], li, (3,4))
+      self.assertRaises(UserWarning, Results, self._dir)
+
+    def test_invalid(self):
+      self.assertRaises(ValueError, Writer, self._name, ["a"], 4, "int")
+      self.assertRaises(ValueError, Writer, self._name, ["a"], 4, "double",
+                        "bzip2")
+
+  unittest.main()
@@ -1,12 +1,41 @@
 #!python
-import copy
 import math
+import numpy
+import dtypes
 from filter import Filter
 
-def avg(l): return math.fsum(l) / len(l)
+def neighborhood(values):
+  '''Computes, for every cell of the 2D array 'values', the sum over its 3x3
+  neighborhood (including the cell itself) and the number of cells in that
+  neighborhood.  Cells on the edges and corners simply have fewer neighbors.
+  'values' may also be a stack of 2D arrays, i.e. of shape (..., h, w).  Both
+  results have the type of 'values', so that dividing one by the other does
+  not promote float32 data to float64.'''
+  h,w = values.shape[-2:]
+  padded = numpy.zeros(values.shape[:-2] + (h+2, w+2), dtype=values.dtype)
+  padded[...,1:-1,1:-1] = values
+  present = numpy.zeros((h+2, w+2), dtype=values.dtype)
+  present[1:-1,1:-1] = 1
+
+  total = numpy.zeros(values.shape, dtype=values.dtype)
+  count = numpy.zeros((h,w), dtype=values.dtype)
+  for dy in xrange(0, 3):
+    for dx in xrange(0, 3):
+      total += padded[...,dy:dy+h, dx:dx+w]
+      count += present[dy:dy+h, dx:dx+w]
+  return total, count
 
 class Outlier(Filter):
-  '''This filter removes outliers within a data set.'''
+  '''This filter removes outliers within a data set.  Every datum is compared
+     to the average of its 3x3 neighborhood in the input; those which differ
+     from it by more than 'cutoff' times that average are replaced by an
+     average of the neighborhood.  All data are judged against the original
+     input, so the order in which the data are visited does not matter.
+     Input may be a list or an array; float32 arrays are filtered as such.
+
+     With 'inplace' set, the old algorithm is used instead (see
+     '_average_in_place'); it is slow, and only useful for reproducing old
+     results exactly.'''
   def __init__(self):
     Filter.__init__(self)
     self._name = "Outlier"
@@ -18,72 +47,198 @@ class Outlier(Filter):
     self.set_parameter_floatrange("cutoff", 0.95, 0.0,1.0)
     # if the averaging out is inclusive of the datum in question
     self.set_parameter("inclusive", False, bool)
+    # visit the data in scan order, changing them as we go: the old algorithm.
+    self.set_parameter("inplace", False, bool)
 
   def set_input(self, raw_data, dims):
     self._dimensions = dims
     self._input = raw_data
+    self._output = None
 
   def get_output(self):
-    if self._output == None:
+    if self._output is None:
       self.execute()
     return self._output
 
-  def _is_outlier(self, value, stencil):
-    '''Identifies if a particular datum is an outlier.  Expects to get the datum
-       as well as neighborhood information.'''
-    total = math.fsum(stencil)
-    avg = total / len(stencil)
-    diff = math.fabs(value - avg)
-    cutoff = self.get_parameter("cutoff") * avg
-    if diff > cutoff: return True
-    return False
+  def _average_out_outliers(self, data, dimensions):
+    values = dtypes.floats(data)
+    values = values.reshape((dimensions[1], dimensions[0]))
+    if self.get_parameter("inplace"):
+      return self._average_in_place(values).ravel()
+    return self._filter(values).ravel()
 
-  def _index(self, x, y):
-    '''Gives the 1D index from the 2D index.'''
-    return y * self._dimensions[0] + x
+  def _average_in_place(self, values):
+    '''The old algorithm, on a 2D array: the data are visited in scan order
+    and changed as we go, so every datum is judged against its already
+    filtered predecessors.  The edges of the map are left alone.  A datum is
+    an outlier if it differs from the sum of its 8 neighbors over 9 by more
+    than 'cutoff' times that; it is replaced by the average of the 8.  The
+    sums are computed exactly as before, in double precision, so that old
+    results are reproduced exactly.  'inclusive' does not apply.'''
+    data = numpy.array(values, dtype=numpy.float64)
+    cutoff = self.get_parameter("cutoff")
+    h,w = data.shape
+    for y in xrange(1, h-1):
+      above, line, below = data[y-1], data[y], data[y+1]
+      for x in xrange(1, w-1):
+        neighbors = math.fsum((above.item(x-1), above.item(x),
+                               above.item(x+1), line.item(x-1),
+                               line.item(x+1), below.item(x-1),
+                               below.item(x), below.item(x+1)))
+        average = neighbors / 9.0
+        if math.fabs(line.item(x) - average) > cutoff * average:
+          line.itemset(x, neighbors / 8.0)
+    return data.astype(values.dtype)
 
-  def _average_out_outliers(self, data, dimensions):
-    out = copy.deepcopy(data)
-    for y in xrange(1, dimensions[1]-1):
-      for x in xrange(1, dimensions[0]-1):
-        idx1 = (y-1)*dimensions[0] + x-1 # line above
-        idx2 = (y-0)*dimensions[0] + x-1
-        idx3 = (y+1)*dimensions[0] + x-1 # line below
-        stencil = out[idx1:idx1+3] + out[idx2:idx2+3] + out[idx3:idx3+3]
-        out[idx2+1] = data[idx2+1]  # copy the datum at first...
-        if self._is_outlier(data[self._index(x,y)], stencil):
-          # replace it with the average if it's an outlier.
-          if self.get_parameter("inclusive"):
-            out[idx2+1] = avg(stencil)
-          else:
-            out[idx2+1] = avg(out[idx1:idx1+3] + [out[idx2]] +
-                              [out[idx2+2]] + out[idx3:idx3+3])
-
-    # get the 4 corners.
-    idx = self._index # to keep it short.
-    x,y = 0,0 # top left
-    stencil = out[idx(x,y):idx(x,y)+2] + out[idx(x,y+1):idx(x,y+1)+2]
-    if self._is_outlier(data[idx(x,y)], stencil): out[idx(x,y)] = avg(stencil)
-
-    x,y = dimensions[0]-1,0 # top right
-    stencil = out[idx(x-2,y):idx(x,y)] + out[idx(x-2,y+1):idx(x,y+1)]
-    if self._is_outlier(data[idx(x,y)], stencil): out[idx(x,y)] = avg(stencil)
-
-    x,y = 0,dimensions[1]-1 # bottom left
-    stencil = out[idx(x,y-1):idx(x+2,y-1)] + out[idx(x,y):idx(x+2,y)]
-    if self._is_outlier(data[idx(x,y)], stencil): out[idx(x,y)] = avg(stencil)
-
-    x,y = dimensions[0]-1,dimensions[1]-1 # bottom right
-    stencil = out[idx(x-2,y-1):idx(x,y-1)] + out[idx(x-2,y):idx(x,y)]
-    if self._is_outlier(data[idx(x,y)], stencil): out[idx(x,y)] = avg(stencil)
-
-    assert(len(out) == len(data))
-    return out
+  def _filter(self, values):
+    '''Filters a 2D array (or a stack of them), of shape (..., h, w).'''
+    total, count = neighborhood(values)
+    average = total / count
+
+    outliers = numpy.abs(values - average) > self.get_parameter("cutoff")*average
+    if self.get_parameter("inclusive"):
+      replacement = average
+    else:
+      # Leave the datum itself out of the average.  A lone datum has no
+      # neighbors to average; leave it alone.
+      outliers &= count > 1
+      replacement = (total - values) / numpy.maximum(count - 1, 1)
+
+    return numpy.where(outliers, replacement, values)
+
+  def stream(self, rows):
+    '''Filters data one scan line at a time.  'rows' is an iterable of lines,
+    each an array of shape (..., w) -- a single element's line, or the same
+    line of several elements stacked together.  Yields the filtered lines in
+    order.  Only three lines are held at once, and the results are identical
+    to filtering the whole map in one go.  The 'inplace' algorithm can't be
+    streamed; it raises ValueError.'''
+    if self.get_parameter("inplace"):
+      raise ValueError("The in-place outlier filter can't be streamed.")
+    above, current = None, None
+    for row in rows:
+      row = dtypes.floats(row)
+      if current is not None:
+        yield self._filter_line(above, current, row)
+      above, current = current, row
+    if current is not None:
+      yield self._filter_line(above, current, None)
+
+  def _filter_line(self, above, line, below):
+    '''Filters 'line', given its neighbors (None at the edges of the map).'''
+    window = [l for l in (above, line, below) if l is not None]
+    # (lines, ..., w) -> (..., lines, w)
+    block = numpy.rollaxis(numpy.array(window), 0, line.ndim)
+    return self._filter(block)[...,int(above is not None),:]
 
   def execute(self):
     assert(self._dimensions != None)
 
+    # keep the input: a parameter change means we'll need to run again.
     self._output = self._average_out_outliers(self._input, self._dimensions)
-    # we don't need the input anymore.
-    del self._input
-    self._input = None
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestOutlier(unittest.TestCase):
+    def _run(self, data, dims, inclusive=False):
+      outf = Outlier()
+      outf.update_value("inclusive", inclusive)
+      outf.set_input(data, dims)
+      return outf.get_output().tolist()
+
+    def test_flat(self):
+      '''Nothing should change in constant data.'''
+      self.assertEqual(self._run([4.0]*12, (4,3)), [4.0]*12)
+
+    def test_interior(self):
+      data = [1.0]*25
+      data[12] = 100.0
+      out = self._run(data, (5,5))
+      self.assertEqual(out, [1.0]*25)
+      out = self._run(data, (5,5), inclusive=True)
+      self.assertAlmostEqual(out[12], 108.0 / 9.0)
+
+    def test_edges_and_corners(self):
+      for idx in (0, 2, 4, 10, 14, 20, 24):
+        data = [2.0]*25
+        data[idx] = 50.0
+        self.assertEqual(self._run(data, (5,5)), [2.0]*25)
+
+    def test_list_or_array(self):
+      data = [1.0, 2.0, 3.0, 4.0, 5.0, 90.0, 7.0, 8.0, 9.0]
+      self.assertEqual(self._run(data, (3,3)),
+                       self._run(numpy.array(data), (3,3)))
+
+    def test_float32(self):
+      data = numpy.ones(25, dtype=numpy.float32)
+      data[12] = 100.0
+      outf = Outlier()
+      outf.set_input(data, (5,5))
+      self.assertEqual(outf.get_output().dtype, numpy.float32)
+      self.assertEqual(outf.get_output().tolist(), [1.0]*25)
+      lines = list(outf.stream(data.reshape((5,5))))
+      self.assertEqual(lines[2].dtype, numpy.float32)
+
+    def test_stream(self):
+      import random
+      random.seed(42)
+      dims = (7,5)
+      data = numpy.array([random.random() * 10.0 for i in xrange(35)])
+      data[[3, 15, 20, 34]] = 100.0
+      outf = Outlier()
+      lines = list(outf.stream(data.reshape((5,7))))
+      self.assertEqual(numpy.concatenate(lines).tolist(), self._run(data, dims))
+      # several elements at once
+      stacked = numpy.array([data, data*2.0]).reshape((2,5,7))
+      lines = list(outf.stream(stacked[:,y,:] for y in xrange(5)))
+      self.assertEqual([l.shape for l in lines], [(2,7)]*5)
+      self.assertEqual(lines[4][1].tolist(), outf._filter(stacked[1])[4].tolist())
+      # a single line
+      self.assertEqual(len(list(outf.stream([data[0:7]]))), 1)
+
+    def test_input_unchanged(self):
+      data = numpy.ones(9)
+      data[4] = 50.0
+      self._run(data, (3,3))
+      self.assertEqual(data[4], 50.0)
+
+    def test_rerun(self):
+      data = [1.0]*25
+      data[12] = 100.0
+      outf = Outlier()
+      outf.set_input(data, (5,5))
+      self.assertEqual(outf.get_output()[12], 1.0)
+      outf.update_value("inclusive", True)
+      self.assertAlmostEqual(outf.get_output()[12], 108.0 / 9.0)
+
+    def test_inplace(self):
+      # The old routine, as it was in cli-bub.
+      def average_out_outliers(data, dimensions):
+        for y in xrange(1, dimensions[1]-1):
+          for x in xrange(1, dimensions[0]-1):
+            idx1 = (y-1)*dimensions[0] + x-1
+            idx2 = (y-0)*dimensions[0] + x-1
+            idx3 = (y+1)*dimensions[0] + x-1
+            stencil = data[idx1:idx1+3] + data[idx2:idx2+3] + data[idx3:idx3+3]
+            avg = math.fsum(stencil[0:4] + stencil[5:9]) / 9.0
+            if math.fabs(stencil[4] - avg) > 0.95 * avg:
+              data[idx2+1] = math.fsum(stencil[0:4] + stencil[5:9]) / 8.0
+      import random
+      random.seed(7)
+      data = [random.random() * 10.0 for i in xrange(48)]
+      for i in (9, 10, 20, 33, 47): data[i] = 100.0
+      old = list(data)
+      average_out_outliers(old, (8,6))
+      outf = Outlier()
+      outf.update_value("inplace", True)
+      outf.set_input(numpy.array(data), (8,6))
+      self.assertEqual(outf.get_output().tolist(), old)
+      # It differs from the default: 10 is judged after 9 was replaced.
+      self.assertNotEqual(self._run(data, (8,6)), old)
+      self.assertRaises(ValueError, list, outf.stream([numpy.ones(8)]))
+      data32 = numpy.array(data, dtype=numpy.float32)
+      outf.set_input(data32, (8,6))
+      self.assertEqual(outf.get_output().dtype, numpy.float32)
+
+  unittest.main()
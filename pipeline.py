@@ -0,0 +1,184 @@
+#!python
+# Chains of filters, evaluated lazily and memoized.
+#
+# A pipeline starts at a Source, which wraps some raw data (e.g. an element
+# from a FINDir), and continues through Stages, each of which runs a Filter on
+# the output of the node before it:
+#
+#   out = Source(data, dims).then(Outlier()).then(SomeOtherFilter())
+#   result = out.output()
+#
+# Nothing runs until output() is called.  Every result is remembered, keyed
+# on the identity of the source plus the name and parameter values of each
+# filter on the way, so after changing a parameter of the last filter only
+# that filter runs again.  Results live in a size-bounded LRU cache.
+import itertools
+
+from lru import LRUCache
+
+# Shared by all pipelines which aren't given a cache of their own.
+default_cache = LRUCache(256 * 1024 * 1024)
+
+_serial = itertools.count()
+
+def _freeze(value):
+  '''Makes the output read-only: it's shared by everyone who asks for it.'''
+  if hasattr(value, "flags"): value.flags.writeable = False
+  return value
+
+class Node:
+  '''Base class for the pieces of a pipeline.  Nodes must define 'key',
+     which identifies their output (equal keys mean equal outputs), and
+     'output'.  This base class only handles chaining.'''
+  def __init__(self, dims, cache):
+    self._dims = dims
+    self._cache = cache
+
+  def then(self, in_filter):
+    '''Appends a filter to the pipeline.  Returns the new end of it.'''
+    return Stage(in_filter, self)
+
+  def dimensions(self): return self._dims
+
+class Source(Node):
+  '''The start of a pipeline: some data, and its dimensions.  Every Source is
+  distinct, even if two of them hold the same data.'''
+  def __init__(self, data, dims, cache=None):
+    if cache is None: cache = default_cache
+    Node.__init__(self, dims, cache)
+    self._data = data
+    self._key = ("source", _serial.next())
+
+  def key(self): return self._key
+  def output(self): return self._data
+
+class Stage(Node):
+  '''Runs a filter on the output of another node.'''
+  def __init__(self, in_filter, upstream):
+    Node.__init__(self, upstream.dimensions(), upstream._cache)
+    self._filter = in_filter
+    self._upstream = upstream
+
+  def get_filter(self): return self._filter
+  def upstream(self): return self._upstream
+
+  def key(self):
+    params = self._filter.get_all_parameters()
+    values = tuple([(k, params[k][0]) for k in sorted(params.keys())])
+    return (self._upstream.key(), self._filter.name(), values)
+
+  def output(self):
+    key = self.key()
+    result = self._cache.get(key)
+    if result is None:
+      self._filter.set_input(self._upstream.output(), self._dims)
+      result = self.store(self._filter.get_output())
+    return result
+
+  def cached(self):
+    '''The output, if it has been computed already; None otherwise.'''
+    return self._cache.get(self.key())
+
+  def store(self, result):
+    '''Remembers 'result' as the output for the filter's current parameters,
+    e.g. when it was computed elsewhere (by a clone of the filter, on another
+    thread).  Returns it, read-only.'''
+    result = _freeze(result)
+    self._cache.put(self.key(), result)
+    return result
+
+if __name__ == "__main__":
+  import unittest
+  import numpy
+  from filter import Filter
+
+  class Scale(Filter):
+    '''Multiplies its input by 'factor', and counts how often it runs.'''
+    def __init__(self):
+      Filter.__init__(self)
+      self._name = "Scale"
+      self._input = None
+      self.runs = 0
+      self.set_parameter_floatrange("factor", 2.0, 0.0,10.0)
+
+    def set_input(self, raw_data, dims):
+      self._input = raw_data
+      self._output = None
+
+    def get_output(self):
+      if self._output is None: self.execute()
+      return self._output
+
+    def execute(self):
+      self.runs += 1
+      self._output = self._input * self.get_parameter("factor")
+
+  class TestPipeline(unittest.TestCase):
+    def setUp(self):
+      self._cache = LRUCache(1024 * 1024)
+      self._source = Source(numpy.arange(6.0), (3,2), self._cache)
+
+    def test_lazy(self):
+      first = Scale()
+      self._source.then(first)
+      self.assertEqual(first.runs, 0)
+
+    def test_chain(self):
+      out = self._source.then(Scale()).then(Scale())
+      self.assertEqual(out.output().tolist(), [0.0, 4.0, 8.0, 12.0, 16.0, 20.0])
+      self.assertEqual(out.dimensions(), (3,2))
+
+    def test_memoized(self):
+      first, second = Scale(), Scale()
+      out = self._source.then(first).then(second)
+      out.output()
+      out.output()
+      self.assertEqual((first.runs, second.runs), (1, 1))
+      # changing the last stage only reruns that stage.
+      second.update_value("factor", 3.0)
+      self.assertEqual(out.output().tolist()[1], 6.0)
+      self.assertEqual((first.runs, second.runs), (1, 2))
+      # ... and changing it back is free.
+      second.update_value("factor", 2.0)
+      out.output()
+      self.assertEqual((first.runs, second.runs), (1, 2))
+      # changing the first stage reruns both.
+      first.update_value("factor", 1.0)
+      self.assertEqual(out.output().tolist()[1], 2.0)
+      self.assertEqual((first.runs, second.runs), (2, 3))
+
+    def test_store(self):
+      stage = self._source.then(Scale())
+      self.assertEqual(stage.cached(), None)
+      # e.g. a preview, run on a clone of the filter.
+      clone = stage.upstream().then(stage.get_filter().clone())
+      clone.get_filter().update_value("factor", 3.0)
+      clone.get_filter().set_input(self._source.output(), (3,2))
+      clone.store(clone.get_filter().get_output())
+      stage.get_filter().update_value("factor", 3.0)
+      self.assertEqual(stage.cached().tolist()[1], 3.0)
+      self.assertEqual(stage.output().tolist()[1], 3.0)
+      self.assertEqual(stage.get_filter().runs, 0)
+
+    def test_sources_distinct(self):
+      other = Source(numpy.arange(6.0), (3,2), self._cache)
+      self.assertNotEqual(self._source.then(Scale()).key(),
+                          other.then(Scale()).key())
+
+    def test_read_only(self):
+      out = self._source.then(Scale()).output()
+      self.assertRaises(ValueError, out.__setitem__, 0, 1.0)
+
+    def test_eviction(self):
+      self._cache.set_max_bytes(6 * 8)
+      first, second = Scale(), Scale()
+      out = self._source.then(first).then(second)
+      out.output()
+      self.assertEqual(len(self._cache), 1)
+      out.output()
+      self.assertEqual((first.runs, second.runs), (1, 1))
+      second.update_value("factor", 3.0)
+      out.output()
+      self.assertEqual((first.runs, second.runs), (2, 2))
+
+  unittest.main()
@@ -0,0 +1,254 @@
+#!python
+# Multi-resolution pyramids of maps, for viewing large maps in tiles.
+#
+# Level 0 of a pyramid is the map itself; every level after that is half the
+# width and height of the one before, each datum being the average of a 2x2
+# block of the level below.  The last level fits within a single tile.  A
+# viewer zoomed out to 1/2^n only ever needs to look at level n, and only at
+# the tiles of it which are on screen.
+from __future__ import with_statement
+import itertools
+import os
+
+import numpy
+
+import dtypes
+
+# Width and height of a tile, in data points.
+TILE_SIZE = 256
+
+_serial = itertools.count()
+
+def downsample(values):
+  '''Halves a 2D array in each dimension, averaging each 2x2 block.  If the
+  array has an odd size, the blocks on the last row/column are averaged over
+  the data they do have.  The result has the same type as 'values'.'''
+  h,w = values.shape
+  shape = ((h+1) // 2, (w+1) // 2)
+  total = numpy.zeros(shape, dtype=numpy.float64)
+  count = numpy.zeros(shape, dtype=numpy.int32)
+  for dy in xrange(0, 2):
+    for dx in xrange(0, 2):
+      part = values[dy::2, dx::2]
+      total[:part.shape[0], :part.shape[1]] += part
+      count[:part.shape[0], :part.shape[1]] += 1
+  return (total / count).astype(values.dtype, copy=False)
+
+class Pyramid:
+  def __init__(self, data, dims, cache=None):
+    '''Builds the pyramid of a map, given its (flat) data and dimensions.  If
+    'cache' is given, it is a path prefix for the levels' files on disk: the
+    levels are read from there if they exist, and written there if not.  The
+    caller is responsible for making sure the prefix changes when the data do;
+    a cache only needs to match the dimensions of the map to be used.'''
+    values = dtypes.floats(data)
+    self._levels = [values.reshape((dims[1], dims[0]))]
+    self._minmax = (values.min(), values.max()) if values.size else (0.0, 0.0)
+    # Identifies this pyramid's tiles; see TileView.
+    self.serial = _serial.next()
+    # level -> {tile row -> the append which last changed it}; see version().
+    self._versions = []
+    self._appends = 0
+
+    if cache is None or not self._load(cache):
+      while max(self._levels[-1].shape) > TILE_SIZE:
+        self._levels.append(downsample(self._levels[-1]))
+      if cache is not None: self._save(cache)
+    # What each level is stored in; levels can grow into spare rows at the
+    # bottom, so that appending lines costs in proportion to the lines.
+    self._buffers = list(self._levels)
+    self.nbytes = sum([l.nbytes for l in self._levels])
+
+  def append(self, data):
+    '''Adds lines to the bottom of the map, e.g. as they are read; 'data' is
+    flat, and holds whole lines.  Only the rows of each level which the new
+    lines affect are rebuilt, and only their tiles change version.'''
+    width = self._levels[0].shape[1]
+    values = dtypes.floats(data, self._levels[0].dtype).reshape((-1, width))
+    if values.size == 0: return
+    first = self._levels[0].shape[0]
+    if first == 0: self._minmax = (values.min(), values.max())
+    else: self._minmax = (min(self._minmax[0], values.min()),
+                          max(self._minmax[1], values.max()))
+    self._appends += 1
+    self._store(0, first, values)
+    row = first
+    n = 1
+    while max(self._levels[n-1].shape) > TILE_SIZE:
+      row //= 2
+      if n == len(self._levels):
+        # The map has grown a level; build all of it.
+        row = 0
+        self._levels.append(numpy.empty((0, 0), self._levels[0].dtype))
+        self._buffers.append(self._levels[-1])
+      self._store(n, row, downsample(self._levels[n-1][row*2:]))
+      n += 1
+    self.nbytes = sum([b.nbytes for b in self._buffers])
+
+  def version(self, n, ty):
+    '''Changes whenever the data of the tiles in row 'ty' of level 'n' do.
+    Tiles are identified by the pyramid's serial and this; see TileView.'''
+    if n >= len(self._versions): return 0
+    return self._versions[n].get(ty, 0)
+
+  def _store(self, n, row, values):
+    '''Replaces level 'n' from 'row' down with 'values'.'''
+    buf = self._buffers[n]
+    rows = row + values.shape[0]
+    # Level 0 starts out as the caller's data, and the others may be mapped
+    # read-only from disk; neither has room to grow, so they're copied first.
+    if (buf.shape[0] < rows or buf.shape[1] != values.shape[1] or
+        not buf.flags.writeable):
+      grown = numpy.empty((max(rows, 2 * buf.shape[0]), values.shape[1]),
+                          values.dtype)
+      if row > 0: grown[:row] = self._levels[n][:row]
+      buf = self._buffers[n] = grown
+    buf[row:rows] = values
+    self._levels[n] = buf[:rows]
+    while len(self._versions) <= n: self._versions.append({})
+    for ty in xrange(row // TILE_SIZE, (rows + TILE_SIZE-1) // TILE_SIZE):
+      self._versions[n][ty] = self._appends
+
+  def levels(self): return len(self._levels)
+
+  def level(self, n):
+    '''The data of level 'n', as a (height, width) array.'''
+    return self._levels[n]
+
+  def dimensions(self, n=0):
+    '''(width, height) of level 'n'.'''
+    return (self._levels[n].shape[1], self._levels[n].shape[0])
+
+  def minmax(self):
+    '''The range of the whole map.  All tiles should be colored with this, so
+    that they agree with each other.'''
+    return self._minmax
+
+  def tiles(self, n):
+    '''The number of tiles across and down level 'n'.'''
+    width, height = self.dimensions(n)
+    return ((width + TILE_SIZE-1) // TILE_SIZE,
+            (height + TILE_SIZE-1) // TILE_SIZE)
+
+  def tile(self, n, tx, ty):
+    '''The data of a tile of level 'n'.  Tiles on the right and bottom edges
+    may be smaller than TILE_SIZE.'''
+    return self._levels[n][ty*TILE_SIZE:(ty+1)*TILE_SIZE,
+                           tx*TILE_SIZE:(tx+1)*TILE_SIZE]
+
+  def _filename(self, prefix, n): return "%s-%d.npy" % (prefix, n)
+
+  def _load(self, prefix):
+    '''Memory-maps the levels above 0 from disk.  Returns false (leaving the
+    pyramid alone) if they are missing or don't fit our map.'''
+    levels = []
+    expected = self._levels[0]
+    try:
+      while max(expected.shape) > TILE_SIZE:
+        level = numpy.load(self._filename(prefix, len(levels)+1), mmap_mode="r")
+        if level.shape != ((expected.shape[0]+1) // 2,
+                           (expected.shape[1]+1) // 2):
+          return False
+        levels.append(level)
+        expected = level
+    except (IOError, OSError, ValueError):
+      return False
+    self._levels.extend(levels)
+    return True
+
+  def _save(self, prefix):
+    '''Writes the levels above 0 to disk.  Failures are ignored: we'll just
+    build the pyramid again next time.'''
+    try:
+      for n in xrange(1, len(self._levels)):
+        filename = self._filename(prefix, n)
+        with open(filename + ".tmp", "wb") as f: numpy.save(f, self._levels[n])
+        os.rename(filename + ".tmp", filename)
+    except (IOError, OSError):
+      pass
+
+if __name__ == "__main__":
+  import shutil
+  import tempfile
+  import unittest
+
+  class TestPyramid(unittest.TestCase):
+    def test_downsample(self):
+      values = numpy.arange(12.0).reshape((3,4))
+      self.assertEqual(downsample(values).tolist(), [[2.5, 4.5], [8.5, 10.5]])
+      values = numpy.arange(9.0).reshape((3,3))
+      self.assertEqual(downsample(values).tolist(), [[2.0, 3.5], [6.5, 8.0]])
+
+    def test_levels(self):
+      dims = (TILE_SIZE*3 + 5, 7)
+      data = numpy.arange(dims[0] * dims[1], dtype=numpy.float64)
+      pyr = Pyramid(data, dims)
+      self.assertEqual(pyr.levels(), 3)
+      self.assertEqual(pyr.dimensions(0), dims)
+      self.assertEqual(pyr.dimensions(1), (TILE_SIZE*3 // 2 + 3, 4))
+      self.assertEqual(pyr.dimensions(2), ((TILE_SIZE*3 // 2 + 4) // 2, 2))
+      self.assertEqual(pyr.tiles(0), (4, 1))
+      self.assertEqual(pyr.tiles(2), (1, 1))
+      self.assertEqual(pyr.minmax(), (0.0, dims[0]*dims[1] - 1.0))
+      self.assertEqual(pyr.tile(0, 3, 0).shape, (7, 5))
+      self.assertEqual(pyr.tile(0, 1, 0)[2,0], 2*dims[0] + TILE_SIZE)
+      self.assertEqual(pyr.level(1)[0,0], (1.0 + dims[0] + dims[0]+1) / 4.0)
+
+    def test_float32(self):
+      data = numpy.arange(600 * 300, dtype=numpy.float32)
+      pyr = Pyramid(data, (600, 300))
+      self.assertEqual(pyr.levels(), 3)
+      for n in xrange(0, pyr.levels()):
+        self.assertEqual(pyr.level(n).dtype, numpy.float32)
+
+    def test_small(self):
+      pyr = Pyramid([1.0, 2.0, 3.0, 4.0], (2,2))
+      self.assertEqual(pyr.levels(), 1)
+      self.assertEqual(pyr.tile(0, 0, 0).tolist(), [[1.0, 2.0], [3.0, 4.0]])
+
+    def test_cache(self):
+      tmp = tempfile.mkdtemp()
+      try:
+        prefix = os.path.join(tmp, "pyr")
+        dims = (TILE_SIZE*2 + 1, 3)
+        data = numpy.random.random(dims[0] * dims[1])
+        built = Pyramid(data, dims, prefix)
+        self.assertTrue(os.path.exists(prefix + "-2.npy"))
+        loaded = Pyramid(data, dims, prefix)
+        self.assertEqual(loaded.levels(), built.levels())
+        self.assertTrue(isinstance(loaded.level(1), numpy.memmap))
+        self.assertEqual(loaded.level(2).tolist(), built.level(2).tolist())
+        # a map of another size doesn't use the cache
+        other = Pyramid(numpy.zeros(TILE_SIZE*4 * 3), (TILE_SIZE*4, 3), prefix)
+        self.assertEqual(other.dimensions(1), (TILE_SIZE*2, 2))
+        self.assertFalse(isinstance(other.level(1), numpy.memmap))
+      finally:
+        shutil.rmtree(tmp)
+
+    def test_append(self):
+      dims = (TILE_SIZE + 10, TILE_SIZE * 2 + 3)
+      data = numpy.random.random(dims[0] * dims[1])
+      whole = Pyramid(data, dims)
+      lines = TILE_SIZE + 100
+      pyr = Pyramid(data[:dims[0] * lines], (dims[0], lines))
+      serial = pyr.serial
+      pyr.append(data[dims[0] * lines:dims[0] * (lines + 1)])
+      pyr.append(data[dims[0] * (lines + 1):])
+      self.assertEqual(pyr.serial, serial)
+      self.assertEqual(pyr.levels(), whole.levels())
+      self.assertEqual(pyr.minmax(), whole.minmax())
+      for n in xrange(0, whole.levels()):
+        self.assertEqual(pyr.level(n).tolist(), whole.level(n).tolist())
+      # Only the tiles below the old bottom of the map changed.
+      self.assertEqual(pyr.version(0, 0), 0)
+      self.assertNotEqual(pyr.version(0, 1), 0)
+      self.assertNotEqual(pyr.version(1, 0), 0)
+
+    def test_append_empty(self):
+      pyr = Pyramid([], (3, 0))
+      pyr.append([1.0, 5.0, 3.0])
+      pyr.append([0.0, 2.0, 2.0])
+      self.assertEqual(pyr.dimensions(), (3, 2))
+      self.assertEqual(pyr.minmax(), (0.0, 5.0))
+
+  unittest.main()
@@ -0,0 +1,236 @@
+#!python
+# Maps scan data onto a uniform, physical grid.
+#
+# The spectrometer gives us a sample per time step along each scan line, and
+# the SLS file says where each line starts and stops.  The samples are rarely
+# square: lines are usually further apart than the samples along them, and
+# they need not even be evenly spaced.  A Resampler works out, once per run,
+# which sample is nearest to each pixel of a grid of square pixels, as small
+# as the finer of the two spacings, so that no sample or line is lost.
+# Resampling a map is then a single gather, so it costs next to nothing per
+# element, and several elements can be resampled at once.
+import numpy
+
+# The ratio of line spacing to sample spacing we assumed before we looked at
+# the SLS geometry.  Only used when there is no geometry to go on.
+ASPECT = 2.6
+
+def _positions(start, stop, times, spans=None):
+  '''Where each sample was taken, along one axis.  'start' and 'stop' are per
+  line, of shape (h,); 'times' are the sample times, of shape (h, w).  The
+  samples of a line are spread from its start to its stop in proportion to
+  their times.  'spans' are the first and last times of each whole line, of
+  shape (h, 2), if 'times' hold only some of its samples.'''
+  h, w = times.shape
+  if spans is None: spans = times[:,[0, -1]]
+  elapsed = times - spans[:,:1]
+  duration = spans[:,1] - spans[:,0]
+  fraction = numpy.empty(times.shape)
+  timed = duration > 0
+  fraction[timed] = elapsed[timed] / duration[timed][:,numpy.newaxis]
+  fraction[~timed] = numpy.linspace(0.0, 1.0, w) if w > 1 else 0.0
+  return start[:,numpy.newaxis] + (stop - start)[:,numpy.newaxis] * fraction
+
+def _pitch(positions, axis=-1):
+  '''The typical distance between neighbouring positions, or None.'''
+  if positions.shape[axis] < 2: return None
+  d = numpy.abs(numpy.diff(positions, axis=axis))
+  d = d[d > 0]
+  if len(d) == 0: return None
+  return float(numpy.median(d))
+
+def _nearest(positions, centers):
+  '''The index of the position nearest to each center.  'positions' must be
+  sorted.'''
+  midpoints = (positions[1:] + positions[:-1]) * 0.5
+  return numpy.searchsorted(midpoints, centers)
+
+def lines(scanlines, h, rows=None):
+  '''The start and stop of each of the 'h' lines of a scan, as arrays of
+  shape (h, 3), or of just the lines in the range 'rows' (as for a slice).
+  If 'scanlines' describes more lines, e.g. for a run which hasn't finished,
+  the first 'h' are used.  If it describes fewer, the lines are spread evenly
+  between the first and the last line it does describe.'''
+  start = numpy.asarray(scanlines["start"], dtype=numpy.float64)
+  stop = numpy.asarray(scanlines["stop"], dtype=numpy.float64)
+  if len(start) > h:
+    start, stop = start[:h], stop[:h]
+  elif len(start) < h:
+    start = numpy.array([numpy.linspace(start[0][i], start[-1][i], h)
+                         for i in (0, 1)]).T
+    stop = numpy.array([numpy.full(h, stop[0][0]), start[:,1]]).T
+  if rows is None: return start, stop
+  return start[slice(*rows)], stop[slice(*rows)]
+
+class Resampler:
+  def __init__(self, scanlines, times, dims, spans=None):
+    '''Maps data of the given dimensions onto a grid of square pixels.
+    'scanlines' is the geometry of each line, as from SLS.scanlines() (only
+    'start' and 'stop' are needed; see lines()), and 'times' are the sample
+    times (the FIN "Time" column), one per datum.  If the data are only part
+    of each line (a region; see FINDir.region), 'spans' gives the first and
+    last time of each whole line, as from FINDir.time_spans().'''
+    w, h = dims
+    self._dims = dims
+    times = numpy.asarray(times, dtype=numpy.float64).reshape((h, w))
+    if spans is not None:
+      spans = numpy.asarray(spans, dtype=numpy.float64).reshape((h, 2))
+    start, stop = lines(scanlines, h)
+
+    x = _positions(start[:,0], stop[:,0], times, spans)
+    y = start[:,1].copy()
+    # Lay the grid out in scan order: the first sample of the first line goes
+    # in the top left corner, whichever way the stage moved.
+    if stop[0,0] < start[0,0]: x = -x
+    if y[-1] < y[0]: y = -y
+
+    self._spacings = (_pitch(x), _pitch(y))
+    if self._spacings[0] is None:
+      self._spacings = (1.0, self._spacings[1])
+    if self._spacings[1] is None:
+      self._spacings = (self._spacings[0], self._spacings[0] * ASPECT)
+    dx, dy = self._spacings
+    self._pixel = min(dx, dy)
+
+    # Each sample covers the pixel around it; each line, a band around it.
+    lo = (x.min() - dx * 0.5, y.min() - dy * 0.5)
+    hi = (x.max() + dx * 0.5, y.max() + dy * 0.5)
+    width = max(int(round((hi[0] - lo[0]) / self._pixel)), 1)
+    height = max(int(round((hi[1] - lo[1]) / self._pixel)), 1)
+    self._grid = (width, height)
+    centers_x = lo[0] + (numpy.arange(width) + 0.5) * self._pixel
+    centers_y = lo[1] + (numpy.arange(height) + 0.5) * self._pixel
+
+    order = numpy.argsort(y, kind="mergesort")
+    rows = order[_nearest(y[order], centers_y)]
+    columns = numpy.empty((h, width), dtype=numpy.intp)
+    for line in numpy.unique(rows):
+      # Lines need not all run the same way (e.g. a serpentine scan).
+      order = numpy.argsort(x[line], kind="mergesort")
+      columns[line] = order[_nearest(x[line][order], centers_x)]
+    # The index of the datum which goes into each pixel.
+    self._index = (rows[:,numpy.newaxis] * w + columns[rows]).ravel()
+
+  def dimensions(self):
+    '''The (width, height) of the resampled maps, in pixels.'''
+    return self._grid
+
+  def spacings(self):
+    '''The distance between samples, and between lines, in the units of the
+    SLS file (microns).'''
+    return self._spacings
+
+  def pixel_size(self): return self._pixel
+
+  def resample(self, data):
+    '''Resamples a map, or a stack of them.  'data' is of shape (..., h*w) or
+    (..., h, w); returns a flat map (or stack) of the resampled dimensions.'''
+    data = numpy.asarray(data)
+    if data.shape[-2:] == (self._dims[1], self._dims[0]):
+      data = data.reshape(data.shape[:-2] + (-1,))
+    return data[...,self._index]
+
+def uniform(dims, aspect=ASPECT):
+  '''A Resampler for data without any geometry: evenly spaced samples, on
+  evenly spaced lines 'aspect' samples apart.'''
+  w, h = dims
+  scanlines = {"start": [(0.0, y * aspect, 0.0) for y in xrange(0, h)],
+               "stop": [(w - 1.0, y * aspect, 0.0) for y in xrange(0, h)]}
+  return Resampler(scanlines, numpy.tile(numpy.arange(float(w)), h), dims)
+
+if __name__ == "__main__":
+  import unittest
+
+  class TestResampler(unittest.TestCase):
+    def _lines(self, ys, x0=0.0, x1=30.0):
+      return {"start": [(x0, y, 0.0) for y in ys],
+              "stop": [(x1, y, 0.0) for y in ys]}
+
+    def test_uniform(self):
+      # 4 samples 10 apart, lines 20 apart: every line becomes 2 rows.
+      times = numpy.tile(numpy.arange(4.0), 3)
+      rs = Resampler(self._lines([0.0, 20.0, 40.0]), times, (4,3))
+      self.assertEqual(rs.dimensions(), (4, 6))
+      self.assertEqual(rs.spacings(), (10.0, 20.0))
+      data = numpy.arange(12.0)
+      out = rs.resample(data).reshape((6,4))
+      self.assertEqual(out[:,0].tolist(), [0.0, 0.0, 4.0, 4.0, 8.0, 8.0])
+      self.assertEqual(out[1].tolist(), [0.0, 1.0, 2.0, 3.0])
+
+    def test_stack(self):
+      rs = uniform((5,4), 2.0)
+      self.assertEqual(rs.dimensions(), (5, 8))
+      data = numpy.arange(20.0)
+      stack = numpy.array([data, data * 2.0])
+      out = rs.resample(stack)
+      self.assertEqual(out.shape, (2, 40))
+      self.assertEqual(out[1].tolist(), (rs.resample(data) * 2.0).tolist())
+      self.assertEqual(rs.resample(data.reshape((4,5))).tolist(),
+                       rs.resample(data).tolist())
+
+    def test_reversed(self):
+      # Scanned right to left and bottom to top: still in scan order.
+      times = numpy.tile(numpy.arange(4.0), 2)
+      rs = Resampler(self._lines([10.0, 0.0], 30.0, 0.0), times, (4,2))
+      out = rs.resample(numpy.arange(8.0)).reshape(rs.dimensions()[::-1])
+      self.assertEqual(out[0].tolist(), [0.0, 1.0, 2.0, 3.0])
+      self.assertEqual(out[-1].tolist(), [4.0, 5.0, 6.0, 7.0])
+
+    def test_serpentine(self):
+      # Every other line is scanned right to left; samples stay in place.
+      times = numpy.tile(numpy.arange(4.0), 3)
+      lines = self._lines([0.0, 20.0, 40.0])
+      lines["start"][1], lines["stop"][1] = (30.0, 20.0, 0.0), (0.0, 20.0, 0.0)
+      rs = Resampler(lines, times, (4,3))
+      out = rs.resample(numpy.arange(12.0)).reshape((6,4))
+      self.assertEqual(out[2].tolist(), [7.0, 6.0, 5.0, 4.0])
+      self.assertEqual(out[4].tolist(), [8.0, 9.0, 10.0, 11.0])
+
+    def test_uneven_lines(self):
+      # The gap between the 2nd and 3rd lines is twice the others.
+      times = numpy.tile(numpy.arange(4.0), 4)
+      rs = Resampler(self._lines([0.0, 10.0, 30.0, 40.0]), times, (4,4))
+      self.assertEqual(rs.dimensions(), (4, 5))
+      out = rs.resample(numpy.arange(16.0)).reshape((5,4))
+      self.assertEqual(out[:,0].tolist(), [0.0, 4.0, 4.0, 8.0, 12.0])
+
+    def test_close_lines(self):
+      # Lines closer than the samples: the pixels follow the lines.
+      times = numpy.tile(numpy.arange(3.0), 3)
+      rs = Resampler(self._lines([0.0, 5.0, 10.0], 0.0, 20.0), times, (3,3))
+      self.assertEqual(rs.pixel_size(), 5.0)
+      self.assertEqual(rs.dimensions(), (6, 3))
+      out = rs.resample(numpy.arange(9.0)).reshape((3,6))
+      self.assertEqual(out[2].tolist(), [6.0, 6.0, 7.0, 7.0, 8.0, 8.0])
+
+    def test_region(self):
+      # The middle two samples of each line land where they did in the whole.
+      times = numpy.tile(numpy.arange(4.0), 3)
+      whole = Resampler(self._lines([0.0, 20.0, 40.0]), times, (4,3))
+      spans = numpy.tile([0.0, 3.0], (3, 1))
+      part = Resampler(self._lines([0.0, 20.0, 40.0]),
+                       times.reshape((3,4))[:,1:3], (2,3), spans)
+      self.assertEqual(part.spacings(), whole.spacings())
+      self.assertEqual(part.dimensions(), (2, 6))
+      out = part.resample(numpy.arange(6.0)).reshape((6,2))
+      self.assertEqual(out[:,0].tolist(), [0.0, 0.0, 2.0, 2.0, 4.0, 4.0])
+
+    def test_missing_geometry(self):
+      # Only the first and last lines are described.
+      times = numpy.tile(numpy.arange(4.0), 3)
+      rs = Resampler(self._lines([0.0, 40.0]), times, (4,3))
+      self.assertEqual(rs.spacings(), (10.0, 20.0))
+      start, stop = lines(self._lines([0.0, 40.0]), 3, (1, 3))
+      self.assertEqual(start[:,1].tolist(), [20.0, 40.0])
+      self.assertEqual(stop[:,0].tolist(), [30.0, 30.0])
+
+    def test_unfinished_run(self):
+      # The SLS file describes lines which haven't been scanned yet.
+      start, stop = lines(self._lines([0.0, 20.0, 40.0, 60.0]), 2)
+      self.assertEqual(start[:,1].tolist(), [0.0, 20.0])
+      times = numpy.tile(numpy.arange(4.0), 2)
+      rs = Resampler(self._lines([0.0, 20.0, 40.0, 60.0]), times, (4,2))
+      self.assertEqual(rs.dimensions(), (4, 4))
+      self.assertEqual(rs.spacings(), (10.0, 20.0))
+
+  unittest.main()
@@ -10,6 +10,8 @@
 from __future__ import with_statement
 import os
 
+import numpy
+
 # should we validate what we're seeing in the files?
 def validate(): return os.getenv("BUB_NO_VALIDATE") is None
 
@@ -21,6 +23,7 @@ class SLS:
     self._energy = None
     self._repetition = None
     self._spot_size = None
+    self._lines = None
 
   def start(self):
     if self._start[0] is None: self._parse()
@@ -38,6 +41,13 @@ class SLS:
     if self._spot_size is None: self._parse()
     return self._spot_size
 
+  def scanlines(self):
+    """The geometry of every scan line, in the order they were scanned, as a
+       dict of arrays: 'start' and 'stop' (each of shape (lines, 3)), and
+       'energy', 'repetition' and 'spot_size' (each of shape (lines,))."""
+    if self._lines is None: self._parse()
+    return self._lines
+
   class IncompleteGroup: pass
 
   def _read_group(self, sls):
@@ -67,6 +77,7 @@ class SLS:
     return self._energy is None
 
   def _parse(self):
+    lines = []
     with open(self._sls, "r") as sls:
 
       while sls:
@@ -78,6 +89,7 @@ class SLS:
           # are associated (all come from a single scan line) until hit the
           # end.  Then we'll back up and read what we're looking for.
           line = self._read_group(sls)
+          lines.append(line)
           if self._uninitialized():
             self._start = line['start']
             self._stop = line['stop']
@@ -110,6 +122,11 @@ class SLS:
             sls.seek(0, os.SEEK_END)
             sls.readline()
 
+    keys = ('start', 'stop', 'energy', 'repetition', 'spot_size')
+    self._lines = dict([(k, numpy.array([l[k] for l in lines],
+                                        dtype=numpy.float64)) for k in keys])
+    for k in ('start', 'stop'): self._lines[k] = self._lines[k].reshape((-1,3))
+
 if __name__ == "__main__":
   import unittest
 
@@ -155,6 +172,14 @@ if __name__ == "__main__":
       s = SLS(self._testfile)
       self.assertEqual(s.spot_size(), 25)
 
+    def test_scanlines(self):
+      lines = SLS(self._testfile).scanlines()
+      self.assertEqual(lines['start'].shape, (6, 3))
+      self.assertEqual(lines['start'][:,1].tolist(),
+                       [14254, 14204, 14154, 14104, 14054, 14004])
+      self.assertEqual(lines['stop'][0].tolist(), [-3306, 14254, -8569])
+      self.assertEqual(lines['spot_size'].tolist(), [25] * 6)
+
     def test_nothing(self): pass
 
   unittest.main()
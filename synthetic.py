@@ -0,0 +1,148 @@
+#!python
+# Generates synthetic runs: a directory of FIN files, and a matching SLS file.
+#
+# The data are made up, but shaped like the real thing: every element has a
+# smooth 'tissue' pattern over the map, some noise, a background that drifts
+# over the run, and the odd spike of an outlier.  They are good for testing
+# and benchmarking at whatever scale we like, without needing real data.
+#
+#   python synthetic.py --files 200 --points 1000 /tmp/run
+#
+# Without a directory, the unit tests are run instead.
+from __future__ import with_statement
+from optparse import OptionParser
+import os
+
+import numpy
+
+# Names for the elements we generate; more than this get numbered copies.
+ELEMENTS = ["Li7", "Na23", "Mg24", "P31", "Ca44", "Mn55", "Fe56", "Co59",
+            "Cu63", "Zn66", "Se78", "Mo95", "Cd111", "Pt195", "Pb208"]
+
+# What the SLS files say about a scan, besides where it is.
+SPOT_SIZE = 25.0
+ENERGY = 100.0
+REPETITION = 20.0
+
+def element_names(n):
+  '''The names of 'n' synthetic elements.'''
+  names = []
+  for i in xrange(0, n):
+    name = ELEMENTS[i % len(ELEMENTS)]
+    if i >= len(ELEMENTS): name += "_%d" % (i // len(ELEMENTS))
+    names.append(name)
+  return names
+
+def _maps(files, points, elements, rng):
+  '''Makes up the data: an array of shape (elements, files, points).'''
+  y, x = numpy.mgrid[0:files, 0:points]
+  y = y / float(max(files-1, 1))
+  x = x / float(max(points-1, 1))
+  maps = numpy.empty((elements, files, points))
+  for e in xrange(0, elements):
+    fx, fy, phase = rng.uniform(1.0, 6.0, 3)
+    scale = 10.0 ** rng.uniform(1.0, 4.0)
+    tissue = (numpy.sin(fx * numpy.pi * x + phase) *
+              numpy.cos(fy * numpy.pi * y) + 1.0) * scale
+    drift = (1.0 + y) * scale * 0.05
+    noise = rng.random_sample((files, points)) * scale * 0.1
+    maps[e] = tissue + drift + noise
+    spikes = rng.random_sample((files, points)) < 0.002
+    maps[e][spikes] *= 20.0
+  return maps
+
+def write_run(directory, files, points, elements, seed=0, prefix="SYN"):
+  '''Writes a synthetic run into 'directory' (which is created if need be):
+  'files' FIN files -- i.e. scan lines -- of 'points' samples each, for
+  'elements' elements plus Time, and an SLS file which describes them.
+  Returns the glob which matches the FIN files, and the SLS filename.'''
+  if not os.path.isdir(directory): os.makedirs(directory)
+  rng = numpy.random.RandomState(seed)
+  names = element_names(elements)
+  maps = _maps(files, points, elements, rng)
+  # Keep each line short enough in time that the spot size looks sane.
+  time_step = 0.7
+  times = numpy.arange(1, points+1) * time_step
+
+  for f in xrange(0, files):
+    filename = os.path.join(directory, "%s%05d.FIN2" % (prefix, f))
+    with open(filename, "w") as fin:
+      fin.write("Finnigan MAT ELEMENT Raw Data\n")
+      fin.write("Friday, October 15, 2010 21:49:14\n")
+      fin.write("%s.FIN\n" % prefix)
+      fin.write("%d\n0\n16,16\nCPS\n" % points)
+      fin.write(",".join(["Time"] + names) + "\n")
+      columns = numpy.vstack([times, maps[:,f,:]]).T
+      numpy.savetxt(fin, columns, fmt="%f", delimiter=",")
+
+  # The scan has to cover at least two spot sizes per point; see cli-bub.
+  width = points * SPOT_SIZE * 4.0
+  slsfile = os.path.join(directory, prefix + ".sls")
+  with open(slsfile, "w") as sls:
+    for f in xrange(0, files):
+      y = 1000.0 - f * SPOT_SIZE * 2.0
+      for v in (0.0, y, 0.0, width, y, ENERGY, REPETITION, SPOT_SIZE):
+        sls.write("%r\n" % v)
+    # the trailer; we don't know what it means.
+    for v in (25, 1, 12, 0, 1.25, 1): sls.write("%r\n" % v)
+  return prefix + "*FIN2", slsfile
+
+if __name__ == "__main__":
+  parser = OptionParser(usage="%prog [options] [DIRECTORY]")
+  parser.add_option("--files", dest="files", default=100, type="int",
+                    help="Number of FIN files (scan lines) (100).")
+  parser.add_option("--points", dest="points", default=500, type="int",
+                    help="Number of samples per file (500).")
+  parser.add_option("--elements", dest="elements", default=4, type="int",
+                    help="Number of elements, besides Time (4).")
+  parser.add_option("--seed", dest="seed", default=0, type="int",
+                    help="Random seed (0).")
+  options, args = parser.parse_args()
+
+  if len(args) > 1: parser.error("only one directory, please.")
+  if args:
+    finglob, slsfile = write_run(args[0], options.files, options.points,
+                                 options.elements, options.seed)
+    print "Wrote %s and %s" % (os.path.join(args[0], finglob), slsfile)
+  else:
+    import shutil
+    import sys
+    import tempfile
+    import unittest
+    import findir
+    import sls
+
+    class TestSynthetic(unittest.TestCase):
+      def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+      def tearDown(self):
+        shutil.rmtree(self._dir)
+
+      def test_names(self):
+        self.assertEqual(element_names(2), ["Li7", "Na23"])
+        names = element_names(len(ELEMENTS) + 1)
+        self.assertEqual(len(set(names)), len(names))
+
+      def test_run(self):
+        finglob, slsfile = write_run(self._dir, 6, 50, 3)
+        fdir = findir.FINDir(self._dir, finglob)
+        self.assertEqual(fdir.elements(), ["Time", "Li7", "Na23", "Mg24"])
+        self.assertEqual((fdir.x(), fdir.y()), (50, 6))
+        self.assertEqual(len(fdir.element("Mg24")), 300)
+        s = sls.SLS(slsfile)
+        self.assertEqual(s.spot_size(), SPOT_SIZE)
+        microns_per_pt = (s.stop()[0] - s.start()[0]) / \
+                         fdir.scanning_time_per_line()
+        self.assertTrue(microns_per_pt >= SPOT_SIZE * 2.0)
+
+      def test_repeatable(self):
+        a = os.path.join(self._dir, "a")
+        b = os.path.join(self._dir, "b")
+        write_run(a, 2, 10, 2, seed=3)
+        write_run(b, 2, 10, 2, seed=3)
+        for f in os.listdir(a):
+          self.assertEqual(open(os.path.join(a, f)).read(),
+                           open(os.path.join(b, f)).read())
+
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,138 @@
+#!python
+# A scrollable, zoomable view of a map, drawn in tiles from a Pyramid.
+#
+# Only the tiles which intersect the part of the view being exposed are drawn,
+# from the pyramid level which matches the zoom; so the cost of a redraw
+# depends on the size of the window, not on the size of the map.  Colored
+# tiles are kept in an LRU cache, so panning back and forth is cheap.
+import math
+import pygtk
+pygtk.require('2.0')
+import gtk
+
+import colormap
+import lru
+from pyramid import TILE_SIZE
+
+# The zoom factors we allow: 1/64 to 8, in powers of two.
+MIN_ZOOM = 1.0 / 64.0
+MAX_ZOOM = 8.0
+
+class TileView:
+  def __init__(self, cache=None):
+    '''A view onto a pyramid.  Colored tiles are kept in 'cache', an LRUCache,
+    if given; otherwise in a cache of our own.'''
+    if cache is None: cache = lru.LRUCache(64 * 1024 * 1024)
+    self._cache = cache
+    self._pyramid = None
+    self._zoom = 1.0
+    self._layout = gtk.Layout()
+    self._layout.connect("expose-event", self._expose)
+    self._layout.connect("scroll-event", self._scroll)
+    self._layout.add_events(gtk.gdk.SCROLL_MASK)
+
+  def widget(self):
+    '''The widget to put in a window.  It scrolls natively, so it should go
+    straight into a ScrolledWindow, without a viewport.'''
+    return self._layout
+
+  def set_pyramid(self, pyr):
+    '''Shows the given pyramid; None clears the view.  Call this again after
+    appending to the pyramid.'''
+    self._pyramid = pyr
+    self._resize()
+
+  def pyramid(self): return self._pyramid
+
+  def zoom(self): return self._zoom
+
+  def set_zoom(self, zoom):
+    '''Sets the zoom factor, keeping the center of the view where it is.'''
+    zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+    hadj = self._layout.get_hadjustment()
+    vadj = self._layout.get_vadjustment()
+    cx = (hadj.value + hadj.page_size / 2.0) / self._zoom
+    cy = (vadj.value + vadj.page_size / 2.0) / self._zoom
+    self._zoom = zoom
+    self._resize()
+    hadj.set_value(min(max(cx * zoom - hadj.page_size / 2.0, 0.0),
+                       max(hadj.upper - hadj.page_size, 0.0)))
+    vadj.set_value(min(max(cy * zoom - vadj.page_size / 2.0, 0.0),
+                       max(vadj.upper - vadj.page_size, 0.0)))
+
+  def zoom_in(self): self.set_zoom(self._zoom * 2.0)
+  def zoom_out(self): self.set_zoom(self._zoom / 2.0)
+
+  def _resize(self):
+    width, height = (0, 0)
+    if self._pyramid is not None:
+      width, height = self._pyramid.dimensions()
+    self._layout.set_size(int(math.ceil(width * self._zoom)),
+                          int(math.ceil(height * self._zoom)))
+    self._layout.queue_draw()
+
+  def _level(self):
+    '''The pyramid level to draw at the current zoom, and how many screen
+    pixels a datum of that level covers.'''
+    level = 0
+    while (level+1 < self._pyramid.levels() and
+           self._zoom * 2**(level+1) <= 1.0):
+      level += 1
+    return level, self._zoom * 2**level
+
+  def _expose(self, layout, event):
+    if self._pyramid is None or event.window is not layout.bin_window:
+      return False
+    level, scale = self._level()
+    tiles_x, tiles_y = self._pyramid.tiles(level)
+    area = event.area
+    # The tiles (of this level) which intersect the exposed area.
+    span = TILE_SIZE * scale
+    first_x = int(area.x / span)
+    first_y = int(area.y / span)
+    last_x = min(int((area.x + area.width) / span), tiles_x-1)
+    last_y = min(int((area.y + area.height) / span), tiles_y-1)
+    for ty in xrange(first_y, last_y+1):
+      for tx in xrange(first_x, last_x+1):
+        x, y = int(round(tx * span)), int(round(ty * span))
+        layout.bin_window.draw_pixbuf(None, self._tile(level, tx, ty, scale),
+                                      0, 0, x, y)
+    return True
+
+  def _tile(self, level, tx, ty, scale):
+    '''A pixbuf of the given tile, colored and scaled for the screen.'''
+    # Lines appended to the pyramid change the bottom tiles' version, and a
+    # new data range changes the color of all of them.
+    key = ("tile", self._pyramid.serial, level, tx, ty, scale,
+           self._pyramid.version(level, ty), self._pyramid.minmax())
+    entry = self._cache.get(key)
+    if entry is None:
+      data = self._pyramid.tile(level, tx, ty)
+      height, width = data.shape
+      rgb = colormap.rgb(data, (width, height), self._pyramid.minmax())
+      pb = gtk.gdk.pixbuf_new_from_array(rgb, gtk.gdk.COLORSPACE_RGB, 8)
+      if scale != 1.0:
+        # Scale the edges of the tile rather than its size, so that
+        # neighbouring tiles meet exactly.
+        x0 = int(round(tx * TILE_SIZE * scale))
+        y0 = int(round(ty * TILE_SIZE * scale))
+        x1 = int(round((tx * TILE_SIZE + width) * scale))
+        y1 = int(round((ty * TILE_SIZE + height) * scale))
+        pb = pb.scale_simple(max(x1-x0, 1), max(y1-y0, 1),
+                             gtk.gdk.INTERP_NEAREST)
+      entry = _Sized(pb, pb.get_rowstride() * pb.get_height())
+      self._cache.put(key, entry)
+    return entry.pixbuf
+
+  def _scroll(self, layout, event):
+    '''Ctrl+wheel zooms; plain scrolling is left to the ScrolledWindow.'''
+    if not event.state & gtk.gdk.CONTROL_MASK: return False
+    if event.direction == gtk.gdk.SCROLL_UP: self.zoom_in()
+    elif event.direction == gtk.gdk.SCROLL_DOWN: self.zoom_out()
+    return True
+
+class _Sized:
+  '''A pixbuf, and the number of bytes it uses, for the LRU cache.'''
+  def __init__(self, pixbuf, nbytes):
+    self.pixbuf = pixbuf
+    self.nbytes = nbytes